@@ -2,6 +2,7 @@ import os
 import shutil
 import sys
 import logging
+import multiprocessing
 from PyQt5 import QtGui, QtWidgets, QtCore
 import gui.resources
 from gui.mainwindow import *
@@ -70,6 +71,9 @@ def load_cfg(cfg_root_path):
 
 if __name__ == '__main__':
 
+    # fitting runs in worker processes, which re-launch the frozen app bundle
+    multiprocessing.freeze_support()
+
     # need to get this done right away so log file can be written
     os.makedirs(pcgl.get_root(), exist_ok=True)
 
@@ -0,0 +1,160 @@
+#######################################################################################################################
+# Copyright (C) 2016  Regents of the University of California
+#
+# This is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License (GNU GPL) as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# A copy of the GNU General Public License can be found in LICENSE.TXT in the root of the source code repository.
+# Additionally, it can be found at http://www.gnu.org/licenses/.
+#
+# NOTES: Per GNU GPLv3 terms:
+#   * This notice must be kept in this source file
+#   * Changes to the source must be clearly noted with date & time of change
+#
+# If you use this software in a product, an explicit acknowledgment in the product documentation of the contribution
+# by Project IDA, Institute of Geophysics and Planetary Physics, UCSD would be appreciated but is not required.
+#######################################################################################################################
+
+import logging
+import os.path
+import sys
+import timeit
+from math import floor, sqrt
+from numpy import abs, convolve, logspace, log10, pi, asarray, clongdouble, longdouble, newaxis
+from numpy.random import RandomState
+import ida.calibration.cross
+import ida.signals.paz
+import ida.signals.utils
+
+"""Timing comparisons of the vectorized calibration routines against their reference implementations.
+
+Run as a script to print the results, optionally with PAZ files to time the response evaluators on:
+
+    python -m ida.calibration.benchmarks [paz.ida ...]
+"""
+
+BENCH_SPCMAT_SIZES = [2000, 10000, 40000]
+BENCH_RESPONSE_FREQ_CNTS = [1000, 100000, 1000000]
+
+
+def _synthetic_cal_pair(size, seed=0):
+    """Random binary like input with a smoothed, noisy output for benchmarking."""
+
+    rng = RandomState(seed)
+    ts1 = rng.choice([-1.0, 1.0], size)
+    ts2 = convolve(ts1, [0.5, 0.3, 0.2], mode='same') + 0.1 * rng.standard_normal(size)
+    ts1 -= ts1.mean()
+    ts2 -= ts2.mean()
+
+    return ts1, ts2
+
+
+def benchmark_spcmat(sizes=BENCH_SPCMAT_SIZES, repeat=3, seed=0):
+    """Time spcmat() against the per-frequency loop spcmat_loop() using the cross_correlate() taper count.
+
+    :param sizes: Time series lengths to benchmark
+    :type sizes: [int]
+    :param repeat: Number of timings per implementation. Best time is reported.
+    :type repeat: int
+    :param seed: Random seed for synthetic time series
+    :type seed: int
+    :return: List of (size, taper_cnt, loop_secs, vectorized_secs, speedup, max_rel_diff) tuples
+    :rtype: [(int, int, float, float, float, float)]
+    """
+
+    results = []
+    for size in sizes:
+        ts1, ts2 = _synthetic_cal_pair(size, seed)
+        taper_cnt = floor(floor((3.0 + 0.3 * sqrt(size))) * sqrt(2.0))
+
+        loop_secs = min(timeit.repeat(lambda: ida.calibration.cross.spcmat_loop(ts1, ts2, taper_cnt),
+                                      number=1, repeat=repeat))
+        vect_secs = min(timeit.repeat(lambda: ida.calibration.cross.spcmat(ts1, ts2, taper_cnt),
+                                      number=1, repeat=repeat))
+
+        sxy_loop, _ = ida.calibration.cross.spcmat_loop(ts1, ts2, taper_cnt)
+        sxy_vect, _ = ida.calibration.cross.spcmat(ts1, ts2, taper_cnt)
+        max_rel_diff = abs(sxy_vect - sxy_loop).max() / abs(sxy_loop).max()
+
+        logging.debug('spcmat benchmark size: {} tapers: {} loop: {:.4f}s vectorized: {:.4f}s'.format(
+            size, taper_cnt, loop_secs, vect_secs))
+        results.append((size, taper_cnt, loop_secs, vect_secs, loop_secs / vect_secs, max_rel_diff))
+
+    return results
+
+
+def _response_longdouble(freqs, paz, mode):
+    """Factored form response of paz in extended precision, as the reference for benchmark_response()."""
+
+    s = 2j * pi * freqs.astype(longdouble)[newaxis, :]
+    zeros = paz.zeros(units='rad', mode=mode).astype(clongdouble)[:, newaxis]
+    poles = paz.poles(units='rad', mode=mode).astype(clongdouble)[:, newaxis]
+
+    return asarray(paz.h0).flat[0] * (s - zeros).prod(axis=0) / (s - poles).prod(axis=0)
+
+
+def benchmark_response(paz_fnames, freq_cnts=BENCH_RESPONSE_FREQ_CNTS, mode='vel', repeat=3):
+    """Time compute_response_zpk() against the zpk2tf() + freqs() path compute_response_tf() for PAZ files,
+    e.g. the *_full.ida responses, on log-spaced grids from 1e-4 hz to 50 hz.
+
+    Precision is reported as the max relative difference of each path from the factored form evaluated in
+    extended precision.
+
+    :param paz_fnames: IDA format PAZ files
+    :type paz_fnames: [str]
+    :param freq_cnts: Frequency grid sizes to benchmark
+    :type freq_cnts: [int]
+    :param mode: Response mode
+    :type mode: str ['disp', 'vel', 'acc']
+    :param repeat: Number of timings per implementation. Best time is reported.
+    :type repeat: int
+    :return: List of (file name, root count, freq count, tf_secs, zpk_secs, speedup, tf max rel diff,
+        zpk max rel diff) tuples
+    :rtype: [(str, int, int, float, float, float, float, float)]
+    """
+
+    results = []
+    for paz_fname in paz_fnames:
+        paz = ida.signals.paz.PAZ('vel', 'hz', pzfilename=paz_fname, fileformat='ida')
+        for freq_cnt in freq_cnts:
+            freqs = logspace(-4, log10(50.0), freq_cnt)
+
+            tf_secs = min(timeit.repeat(lambda: ida.signals.utils.compute_response_tf(freqs, paz, mode=mode),
+                                        number=1, repeat=repeat))
+            zpk_secs = min(timeit.repeat(lambda: ida.signals.utils.compute_response_zpk(freqs, paz, mode=mode),
+                                         number=1, repeat=repeat))
+
+            resp_ref = _response_longdouble(freqs, paz, mode)
+            resp_tf = ida.signals.utils.compute_response_tf(freqs, paz, mode=mode)
+            resp_zpk = ida.signals.utils.compute_response_zpk(freqs, paz, mode=mode)
+            tf_rel_diff = (abs(resp_tf - resp_ref) / abs(resp_ref)).max()
+            zpk_rel_diff = (abs(resp_zpk - resp_ref) / abs(resp_ref)).max()
+
+            logging.debug('response benchmark {} freqs: {} tf: {:.4f}s zpk: {:.4f}s'.format(
+                paz_fname, freq_cnt, tf_secs, zpk_secs))
+            results.append((os.path.basename(paz_fname), paz.num_poles + paz.num_zeros, freq_cnt,
+                            tf_secs, zpk_secs, tf_secs / zpk_secs, tf_rel_diff, zpk_rel_diff))
+
+    return results
+
+
+if __name__ == '__main__':
+
+    print('{:>10} {:>8} {:>12} {:>12} {:>10} {:>14}'.format('size', 'tapers', 'loop (s)', 'vector (s)',
+                                                             'speedup', 'max rel diff'))
+    for res in benchmark_spcmat():
+        print('{:>10} {:>8} {:>12.4f} {:>12.4f} {:>10.1f} {:>14.3e}'.format(*res))
+
+    # PAZ files, e.g. the *_full.ida responses, are given on the command line
+    if len(sys.argv) > 1:
+        print()
+        print('{:>24} {:>6} {:>10} {:>10} {:>10} {:>8} {:>12} {:>12}'.format('paz', 'roots', 'freqs', 'tf (s)',
+                                                                            'zpk (s)', 'speedup', 'tf rel diff',
+                                                                            'zpk rel diff'))
+        for res in benchmark_response(sys.argv[1:]):
+            print('{:>24} {:>6} {:>10} {:>10.4f} {:>10.4f} {:>8.1f} {:>12.3e} {:>12.3e}'.format(*res))
@@ -20,52 +20,191 @@
 # by Project IDA, Institute of Geophysics and Planetary Physics, UCSD would be appreciated but is not required.
 #######################################################################################################################
 
-from math import floor, atan2, sqrt
+from math import floor, ceil
 import logging
-from numpy import ndarray, pi, sqrt, array, zeros, float64, concatenate
-from numpy.fft import fft
+from numpy import ndarray, pi, sqrt, zeros, float64, complex128, concatenate, arange, empty, \
+    add, dot, exp, int64, flatnonzero, einsum, log, maximum, minimum, finfo, convolve, rint, clip, asarray, \
+    divide, arctan2, multiply
+from ida.signals.fft import fft, ifft, rfft, next_fast_len, zeros_buffer, empty_buffer
 
 """Python port of subst of cross.f Fortran code tailored with IDA-specific
 parameter values.
 """
 
-def cross_correlate(sampling_rate, ts1, ts2):
+# approx number of (frequency, taper) pairs evaluated at once by spcmat()
+SPCMAT_BLOCK_SIZE = 2 ** 18
+
+# fixed: single taper count from series length (original cross.py behavior), the default
+# adaptive: per frequency optimal taper count (cross.f kopt), opt in
+TAPER_MODE_FIXED = 'fixed'
+TAPER_MODE_ADAPTIVE = 'adaptive'
+TAPER_MODES = [TAPER_MODE_FIXED, TAPER_MODE_ADAPTIVE]
+
+# adaptive taper counts are limited to ADAPTIVE_TAPER_MIN..ADAPTIVE_TAPER_MAX_FACTOR * fixed taper count
+ADAPTIVE_TAPER_MIN = 4
+ADAPTIVE_TAPER_MAX_FACTOR = 2
+ADAPTIVE_TAPER_ITERATIONS = 1
+
+# cross_correlate_stream() defaults: samples per block read by array_blocks(), segment overlap fraction
+STREAM_BLOCK_LEN = 2 ** 20
+STREAM_OVERLAP = 0.5
+
+
+def cross_correlate(sampling_rate, ts1, ts2, band=None, bin_mask=None, taper_mode=TAPER_MODE_FIXED,
+                    dtype=float64, workspace=None, lag=False):
     """
     Compute coherence of and transfer function between two time series
 
+    If band or bin_mask is given, the cross spectral matrix is only evaluated at those frequencies
+    and only those frequencies are returned. Normalization is unchanged, so the returned values
+    match the corresponding frequencies of the full band result.
+
     :param sampling_rate: Digitizing sampling rate
     :type sampling_rate: float
     :param ts1: First time series
     :type ts1: numpy.ndarry
     :param ts2: Second time series
     :type ts2: numpy.ndarray
+    :param band: (low, high) frequencies (inclusive) to compute. (Optional)
+    :type band: (float, float)
+    :param bin_mask: Boolean mask of frequency bins to compute, one per frequency of the full band result. (Optional)
+    :type bin_mask: ndarray
+    :param taper_mode: TAPER_MODE_FIXED (default) for a single count, TAPER_MODE_ADAPTIVE for per frequency counts
+    :type taper_mode: str
+    :param dtype: dtype of gain, phase and coh, e.g. float32 when results are only plotted. freqs are always float64.
+    :type dtype: numpy.dtype
+    :param workspace: Transform buffers and FFT backend to reuse across calls (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :param lag: If True, also return the coherence weighted phase slope delay. See coh_gain_phase()
+    :type lag: bool
     :return: Tuple of
         freqs: ndarray of frequencies,
         gain: ndarray of transfer function gain values at freqs frequencies
         phase: ndarray of transfer function phase values (in degrees) at freqs frequencies
         coh: ndarray of square of coherence between the two time series at freqs frequencies
-    :rtype: (ndarray, ndarray, ndarray, ndarray)
+        lag: delay of ts2 relative to ts1 in seconds (only if lag is True)
+    :rtype: (ndarray, ndarray, ndarray, ndarray) or (ndarray, ndarray, ndarray, ndarray, float)
     """
 
-    deg_per_rad = 180.0 / pi
-
     if (type(ts1) != ndarray) or (type(ts2) != ndarray):
         msg = 'ERROR: Timeseries need to be of type list or numpy.ndarray.'
         raise TypeError(msg)
 
+    results = cross_correlate_multi(sampling_rate, ts1, [ts2], band=band, bin_mask=bin_mask,
+                                    taper_mode=taper_mode, dtype=dtype, workspace=workspace, lag=lag)
+
+    if lag:
+        freqs, gain, phase, coh, lags = results
+        return freqs, gain[0], phase[0], coh[0], lags[0]
+
+    freqs, gain, phase, coh = results
+    return freqs, gain[0], phase[0], coh[0]
+
+
+def cross_correlate_multi(sampling_rate, input, outputs, band=None, bin_mask=None, taper_mode=TAPER_MODE_FIXED,
+                          dtype=float64, workspace=None, lag=False):
+    """
+    Compute coherence of and transfer function between an input time series and each of several
+    output time series (e.g. the 3 components of a calibration), sharing the input spectrum.
+
+    The input is copied, de-meaned and transformed once. The cross spectral matrix for every output
+    is accumulated in the same pass over the tapers, so the input part (sxy[:, 0]) is only computed once.
+
+    :param sampling_rate: Digitizing sampling rate
+    :type sampling_rate: float
+    :param input: Input time series
+    :type input: numpy.ndarray
+    :param outputs: Output time series, each the same length as input
+    :type outputs: [numpy.ndarray]
+    :param band: (low, high) frequencies (inclusive) to compute. (Optional)
+    :type band: (float, float)
+    :param bin_mask: Boolean mask of frequency bins to compute, one per frequency of the full band result. (Optional)
+    :type bin_mask: ndarray
+    :param taper_mode: TAPER_MODE_FIXED (default) for a single count, TAPER_MODE_ADAPTIVE for per frequency counts
+    :type taper_mode: str
+    :param dtype: dtype of gain, phase and coh, e.g. float32 when results are only plotted. freqs are always float64.
+    :type dtype: numpy.dtype
+    :param workspace: Transform buffers and FFT backend to reuse across calls (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :param lag: If True, also return the coherence weighted phase slope delay. See coh_gain_phase()
+    :type lag: bool
+    :return: Tuple of
+        freqs: ndarray of frequencies,
+        gain: (len(outputs) x freqs.size) ndarray of transfer function gain values, one row per output
+        phase: (len(outputs) x freqs.size) ndarray of transfer function phase values (in degrees)
+        coh: (len(outputs) x freqs.size) ndarray of square of coherence between input and each output
+        lags: ndarray of delay of each output relative to input in seconds (only if lag is True)
+    :rtype: (ndarray, ndarray, ndarray, ndarray) or (ndarray, ndarray, ndarray, ndarray, ndarray)
+    """
+
+    if (type(input) != ndarray) or any([type(ts2) != ndarray for ts2 in outputs]):
+        msg = 'ERROR: Timeseries need to be of type list or numpy.ndarray.'
+        raise TypeError(msg)
+
+    if any([ts2.size != input.size for ts2 in outputs]):
+        msg = 'ERROR: Output timeseries must be the same length as input timeseries.'
+        raise ValueError(msg)
+
+    if taper_mode not in TAPER_MODES:
+        msg = "Invalid taper mode: '{}'. Valid values: {}".format(taper_mode, TAPER_MODES)
+        raise ValueError(msg)
+
+    freqs, sxys = cross_spectral_matrices(sampling_rate, input, outputs, band=band, bin_mask=bin_mask,
+                                          taper_mode=taper_mode, workspace=workspace)
+
+    gain = empty((len(outputs), freqs.size), dtype=dtype)
+    coh = empty((len(outputs), freqs.size), dtype=dtype)
+    phase = empty((len(outputs), freqs.size), dtype=dtype)
 
-    logging.debug('Making copies of time series...')
-    ts1_data = ts1.copy()
-    ts2_data = ts2.copy()
+    lags = empty(len(outputs), dtype=float64)
+    for outndx, sxy in enumerate(sxys):
+        res = coh_gain_phase(sxy, gain=gain[outndx], phase=phase[outndx], coh=coh[outndx],
+                             freqs=freqs if lag else None)
+        if lag:
+            lags[outndx] = res[3]
+
+    del sxys
+
+    if lag:
+        return freqs, gain, phase, coh, lags
+
+    return freqs, gain, phase, coh
+
+
+def cross_spectral_matrices(sampling_rate, input, outputs, band=None, bin_mask=None, taper_mode=TAPER_MODE_FIXED,
+                            workspace=None):
+    """
+    Normalized cross spectral matrices between an input time series and each of several output time series.
+
+    This is the spectral estimation part of cross_correlate_multi() without the coherence, gain and phase
+    assembly. Matrices of equal length records can be summed (see CrossSpectralAccumulator).
+
+    :param sampling_rate: Digitizing sampling rate
+    :type sampling_rate: float
+    :param input: Input time series
+    :type input: numpy.ndarray
+    :param outputs: Output time series, each the same length as input
+    :type outputs: [numpy.ndarray]
+    :param band: (low, high) frequencies (inclusive) to compute. (Optional)
+    :type band: (float, float)
+    :param bin_mask: Boolean mask of frequency bins to compute, one per frequency of the full band result. (Optional)
+    :type bin_mask: ndarray
+    :param taper_mode: TAPER_MODE_FIXED (default) for a single count, TAPER_MODE_ADAPTIVE for per frequency counts
+    :type taper_mode: str
+    :param workspace: Transform buffers and FFT backend to reuse across calls (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :return: freqs and list of (freqs.size x 4) cross spectral matrices, one per output
+    :rtype: (ndarray, [ndarray])
+    """
+
+    logging.debug('Making copy of input time series...')
+    ts1_data = input.copy()
 
     logging.debug('De-mean timeseries and capture variance...')
     # remove mean then calc variance
     ts1_mean = ts1_data.mean()
     ts1_data.__isub__(ts1_mean)
     ts1_var = ts1_data.var()
-    ts2_mean = ts2_data.mean()
-    ts2_data.__isub__(ts2_mean)
-    # ts2_var = ts2_data.var()
 
     smoothing_factor = 2.0
     # calculate number of tapers
@@ -77,19 +216,44 @@ def cross_correlate(sampling_rate, ts1, ts2):
     #     for r in range(ts_info['ts1']['data'].size):
     #         ofl.write('{} {}\n'.format(ts_info['ts1']['data'][r], ts_info['ts2']['data'][r]))
 
+    opt_len = int((ts1_data.size // 2) * 2)
+    fft_usable_len = opt_len // 2
+    freq_bin_size = (sampling_rate / 2.0) / (fft_usable_len - 1)
+    freq_ndxs = band_freq_ndxs(fft_usable_len, freq_bin_size, band=band, bin_mask=bin_mask)
+
+    if taper_mode == TAPER_MODE_ADAPTIVE:
+        margin = min(ADAPTIVE_TAPER_MAX_FACTOR * taper_cnt, opt_len // 2)
+    else:
+        margin = taper_cnt
+
     logging.debug('calling spcmat...')
 
-    sxy, fft_usable_len = spcmat(ts1_data, ts2_data, taper_cnt)
+    # only bins -margin..(opt_len + margin) of the padded spectra are ever referenced
+    ts1_fft = padded_spectrum(ts1_data, opt_len, margin, workspace=workspace)
+    ts2_ffts = []
+    for ts2 in outputs:
+        ts2_data = ts2.copy()
+        ts2_data.__isub__(ts2_data.mean())
+        ts2_ffts.append(padded_spectrum(ts2_data, opt_len, margin, workspace=workspace))
+        del ts2_data
 
-    logging.debug('calling spcmat... complete (fft-len: ' + str(fft_usable_len) + ')')
+    if taper_mode == TAPER_MODE_ADAPTIVE:
+        taper_cnts = adaptive_taper_cnts(ts1_fft, ts2_ffts, taper_cnt, freq_ndxs, fft_usable_len, margin)
+    else:
+        taper_cnts = taper_cnt
 
-    power = 0.5 * (sxy[0, 0] + sxy[-1, 0]) + sxy[1:fft_usable_len - 1, 0].sum()
-    # for ndx in range(1,ts_info['fft_usable_len']-1):
-    #     power += sxy[ndx, 0]
+    sxys = taper_average_multi(ts1_fft, ts2_ffts, taper_cnts, freq_ndxs, margin=margin)
+    del ts2_ffts
 
-    const = ts1_var / (power * (sampling_rate * 0.5 / (fft_usable_len - 1)))
+    logging.debug('calling spcmat... complete (fft-len: ' + str(fft_usable_len) +
+                  ', bins computed: ' + str(freq_ndxs.size) + ')')
 
-    sxy *= const
+    # trapezoidal sum of sxy[:, 0] over full band. The parabolic weights sum to one for any
+    # taper count, so the fixed count power also normalizes adaptive estimates.
+    power = taper_power(ts1_data, ts1_fft, taper_cnt, margin=margin, workspace=workspace)
+    del ts1_fft
+
+    const = ts1_var / (power * (sampling_rate * 0.5 / (fft_usable_len - 1)))
 
     #      fNyq=0.5/dt
     #      df=fNyq/(nf - 1)
@@ -107,38 +271,363 @@ def cross_correlate(sampling_rate, ts1, ts2):
     # 1700   continue
     # 1750 continue
 
-    freq_bin_size = (sampling_rate / 2.0) / (fft_usable_len - 1)
+    freqs = freq_ndxs * freq_bin_size
+    for sxy in sxys:
+        sxy *= const
+
+    del ts1_data
 
-    freqs = array([freq_bin_size * ndx for ndx in range(fft_usable_len)], dtype=float64)
-    gain = zeros(fft_usable_len, dtype=float64)
-    coh = zeros(fft_usable_len, dtype=float64)
-    phase = zeros(fft_usable_len, dtype=float64)
+    return freqs, sxys
 
-    for freqndx in range(fft_usable_len):
-        coh[freqndx] = (sxy[freqndx, 2] ** 2 + sxy[freqndx, 3] ** 2) / (sxy[freqndx, 0] * sxy[freqndx, 1])
-        gain[freqndx] = sqrt(coh[freqndx] * sxy[freqndx, 1] / sxy[freqndx, 0])
-        phase[freqndx] = deg_per_rad * atan2(sxy[freqndx, 3], sxy[freqndx, 2])
-        # gain[freqndx] = np.sqrt(coh[freqndx] * sxy[freqndx, 1] / sxy[freqndx, 0])
-        # phase[freqndx] = DEG_PER_RAD * np.arctan(sxy[freqndx, 3] / sxy[freqndx, 2])
-        #     ofl.write('{:>15.9f} {:>15.9f} {:>15.9f} {:>15.9f} {:>15.9f} {:>15.9f} {:>15.9f} {:>15.9f}\n'.format(
-        #         freqs[freqndx ],
-        #         sxy[freqndx, 0], sxy[freqndx, 1], sxy[freqndx, 2], sxy[freqndx, 3],
-        #         gain[freqndx], coh[freqndx], phase[freqndx]
-        #     ))
-        # ofl.write('\n')
-
-        # lag(ts_info, freqndx, phase, gamsq)
-
-    # if not getattr(sys, 'frozen', False):
-    #     logging.debug('Writing cross results for file system...')
-    #     with open('pycross-output-' + str(sampling_rate) + 'hz.txt', 'wt') as cfl:
-    #         for freqndx in range(fft_usable_len):
-    #             cfl.write('{:12.4e} {:12.4e} {:12.4e} {:12.4e}\n'.format(freqs[freqndx],
-    #                                                                      gain[freqndx],
-    #                                                                      phase[freqndx],
-    #                                                                      coh[freqndx]))
-    #     logging.debug('Writing cross results for file system... complete')
 
+class CrossSpectralAccumulator(object):
+    """
+    Running average of normalized cross spectral matrices of equal length segments.
+
+    Each segment is de-meaned, transformed and normalized on its own (see cross_spectral_matrices()),
+    so memory use is bounded by the segment length however long the record is. Results have the
+    frequency resolution of a single segment.
+    """
+
+    def __init__(self, sampling_rate, band=None, bin_mask=None, taper_mode=TAPER_MODE_FIXED, workspace=None):
+        """
+        :param sampling_rate: Digitizing sampling rate
+        :type sampling_rate: float
+        :param band: (low, high) frequencies (inclusive) to compute. (Optional)
+        :type band: (float, float)
+        :param bin_mask: Boolean mask of frequency bins to compute, one per frequency of a full band segment result.
+        :type bin_mask: ndarray
+        :param taper_mode: TAPER_MODE_FIXED (default) for a single count, TAPER_MODE_ADAPTIVE for per frequency counts
+        :type taper_mode: str
+        :param workspace: Transform buffers and FFT backend reused for every segment (Optional)
+        :type workspace: ida.signals.fft.FFTWorkspace
+        """
+
+        if taper_mode not in TAPER_MODES:
+            msg = "Invalid taper mode: '{}'. Valid values: {}".format(taper_mode, TAPER_MODES)
+            raise ValueError(msg)
+
+        self.sampling_rate = sampling_rate
+        self.band = band
+        self.bin_mask = bin_mask
+        self.taper_mode = taper_mode
+        self.workspace = workspace
+
+        self.segment_len = None
+        self.segment_cnt = 0
+        self.freqs = None
+        self._sxy_sums = None
+
+    def add(self, input, outputs):
+        """
+        Add the cross spectral matrices of one segment.
+
+        :param input: Input segment
+        :type input: numpy.ndarray
+        :param outputs: Output segments, each the same length as input
+        :type outputs: [numpy.ndarray]
+        """
+
+        if any([ts2.size != input.size for ts2 in outputs]):
+            msg = 'ERROR: Output segments must be the same length as input segment.'
+            raise ValueError(msg)
+
+        if (self.segment_len is not None) and (input.size != self.segment_len):
+            msg = 'Segment length {} differs from previous segments ({}).'.format(input.size, self.segment_len)
+            logging.error(msg)
+            raise ValueError(msg)
+
+        if (self._sxy_sums is not None) and (len(outputs) != len(self._sxy_sums)):
+            msg = 'Output count {} differs from previous segments ({}).'.format(len(outputs), len(self._sxy_sums))
+            logging.error(msg)
+            raise ValueError(msg)
+
+        freqs, sxys = cross_spectral_matrices(self.sampling_rate,
+                                              asarray(input, dtype=float64),
+                                              [asarray(ts2, dtype=float64) for ts2 in outputs],
+                                              band=self.band, bin_mask=self.bin_mask, taper_mode=self.taper_mode,
+                                              workspace=self.workspace)
+
+        if self._sxy_sums is None:
+            self.segment_len = input.size
+            self.freqs = freqs
+            self._sxy_sums = sxys
+        else:
+            for sxy_sum, sxy in zip(self._sxy_sums, sxys):
+                sxy_sum += sxy
+
+        self.segment_cnt += 1
+
+    def add_record(self, input, outputs, segment_len, overlap=STREAM_OVERLAP):
+        """
+        Add all overlapping segments of one complete record, e.g. one calibration run.
+
+        :param input: Input time series
+        :type input: numpy.ndarray
+        :param outputs: Output time series, each the same length as input
+        :type outputs: [numpy.ndarray]
+        :param segment_len: Samples per segment. Must match segments already accumulated.
+        :type segment_len: int
+        :param overlap: Fraction of segment_len shared by consecutive segments, 0 <= overlap < 1
+        :type overlap: float
+        :return: Number of segments added
+        :rtype: int
+        """
+
+        start_cnt = self.segment_cnt
+        for segment in stream_segments(array_blocks([input] + list(outputs)), segment_len, overlap=overlap):
+            self.add(segment[0], segment[1:])
+
+        return self.segment_cnt - start_cnt
+
+    def merge(self, other):
+        """
+        Add the segments accumulated by another accumulator with the same segment length and frequencies.
+
+        :param other: Accumulator to merge
+        :type other: CrossSpectralAccumulator
+        """
+
+        if other.segment_cnt == 0:
+            return
+
+        if self.segment_cnt == 0:
+            self.segment_len = other.segment_len
+            self.freqs = other.freqs.copy()
+            self._sxy_sums = [sxy_sum.copy() for sxy_sum in other._sxy_sums]
+            self.segment_cnt = other.segment_cnt
+            return
+
+        if (other.segment_len != self.segment_len) or (other.freqs.size != self.freqs.size) or \
+                (len(other._sxy_sums) != len(self._sxy_sums)):
+            msg = 'Cannot merge accumulators with different segment lengths, frequencies or output counts.'
+            logging.error(msg)
+            raise ValueError(msg)
+
+        for sxy_sum, other_sum in zip(self._sxy_sums, other._sxy_sums):
+            sxy_sum += other_sum
+        self.segment_cnt += other.segment_cnt
+
+    def cross_spectral_matrices(self):
+        """
+        Segment averaged cross spectral matrices.
+
+        :return: list of (freqs.size x 4) cross spectral matrices, one per output
+        :rtype: [ndarray]
+        """
+
+        if self.segment_cnt == 0:
+            msg = 'No segments have been accumulated.'
+            logging.error(msg)
+            raise ValueError(msg)
+
+        return [sxy_sum / self.segment_cnt for sxy_sum in self._sxy_sums]
+
+    def result(self, dtype=float64, lag=False):
+        """
+        Coherence and transfer function from the segment averaged cross spectral matrices.
+
+        :param dtype: dtype of gain, phase and coh
+        :type dtype: numpy.dtype
+        :param lag: If True, also return the delay of each output. See coh_gain_phase()
+        :type lag: bool
+        :return: Tuple of freqs, gain, phase, coh (and lags) as returned by cross_correlate_multi()
+        :rtype: (ndarray, ndarray, ndarray, ndarray) or (ndarray, ndarray, ndarray, ndarray, ndarray)
+        """
+
+        sxys = self.cross_spectral_matrices()
+
+        gain = empty((len(sxys), self.freqs.size), dtype=dtype)
+        coh = empty((len(sxys), self.freqs.size), dtype=dtype)
+        phase = empty((len(sxys), self.freqs.size), dtype=dtype)
+
+        lags = empty(len(sxys), dtype=float64)
+        for outndx, sxy in enumerate(sxys):
+            res = coh_gain_phase(sxy, gain=gain[outndx], phase=phase[outndx], coh=coh[outndx],
+                                 freqs=self.freqs if lag else None)
+            if lag:
+                lags[outndx] = res[3]
+
+        if lag:
+            return self.freqs.copy(), gain, phase, coh, lags
+
+        return self.freqs.copy(), gain, phase, coh
+
+
+def array_blocks(series, block_len=STREAM_BLOCK_LEN):
+    """
+    Iterate over equal length time series (ndarray or numpy.memmap) in blocks.
+
+    Blocks are slices, so a memmap is only read as each block is consumed.
+
+    :param series: Input time series followed by output time series
+    :type series: [numpy.ndarray]
+    :param block_len: Samples per block
+    :type block_len: int
+    :return: Generator of lists of block slices, one per series
+    :rtype: generator
+    """
+
+    if any([ts.size != series[0].size for ts in series]):
+        msg = 'ERROR: Output timeseries must be the same length as input timeseries.'
+        raise ValueError(msg)
+
+    for start in range(0, series[0].size, block_len):
+        yield [ts[start:start + block_len] for ts in series]
+
+
+def stream_segments(blocks, segment_len, overlap=STREAM_OVERLAP):
+    """
+    Rebuffer blocks of any length into overlapping segments of segment_len samples.
+
+    At most segment_len + one block of samples per series is held at a time. Trailing samples
+    that do not fill a segment are dropped.
+
+    :param blocks: Iterable of lists of equal length arrays: input block followed by output blocks
+    :type blocks: iterable
+    :param segment_len: Samples per segment
+    :type segment_len: int
+    :param overlap: Fraction of segment_len shared by consecutive segments, 0 <= overlap < 1
+    :type overlap: float
+    :return: Generator of lists of float64 segments, one per series
+    :rtype: generator
+    """
+
+    if not (0.0 <= overlap < 1.0):
+        msg = 'Segment overlap must be in the range [0, 1): {}'.format(overlap)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    step = max(1, segment_len - int(round(overlap * segment_len)))
+
+    buf = None
+    for block in blocks:
+        block = [asarray(ts, dtype=float64) for ts in block]
+        if any([ts.size != block[0].size for ts in block]):
+            msg = 'ERROR: Output blocks must be the same length as input block.'
+            raise ValueError(msg)
+
+        if buf is None:
+            buf = block
+        else:
+            buf = [concatenate((ts_buf, ts)) for ts_buf, ts in zip(buf, block)]
+
+        start = 0
+        while buf[0].size - start >= segment_len:
+            yield [ts[start:start + segment_len] for ts in buf]
+            start += step
+
+        buf = [ts[start:].copy() for ts in buf]
+
+    if (buf is not None) and (buf[0].size > 0):
+        logging.debug('Dropped {} trailing samples not filling a segment.'.format(buf[0].size))
+
+
+def cross_correlate_stream(sampling_rate, blocks, segment_len, overlap=STREAM_OVERLAP, band=None, bin_mask=None,
+                           taper_mode=TAPER_MODE_FIXED, dtype=float64, workspace=None, lag=False):
+    """
+    Compute coherence of and transfer function between two long time series in bounded memory.
+
+    The series are consumed in blocks (e.g. from array_blocks() over memmaps, or a generator reading
+    records from disk) and rebuffered into overlapping segments. The cross spectral matrix of each
+    segment is added to a CrossSpectralAccumulator, so memory is bounded by segment_len and the
+    block size rather than the record length.
+
+    :param sampling_rate: Digitizing sampling rate
+    :type sampling_rate: float
+    :param blocks: Iterable of (ts1 block, ts2 block) pairs of equal length
+    :type blocks: iterable
+    :param segment_len: Samples per segment. Sets the frequency resolution of the result.
+    :type segment_len: int
+    :param overlap: Fraction of segment_len shared by consecutive segments, 0 <= overlap < 1
+    :type overlap: float
+    :param band: (low, high) frequencies (inclusive) to compute. (Optional)
+    :type band: (float, float)
+    :param bin_mask: Boolean mask of frequency bins to compute, one per frequency of a full band segment result.
+    :type bin_mask: ndarray
+    :param taper_mode: TAPER_MODE_FIXED (default) for a single count, TAPER_MODE_ADAPTIVE for per frequency counts
+    :type taper_mode: str
+    :param dtype: dtype of gain, phase and coh, e.g. float32 when results are only plotted. freqs are always float64.
+    :type dtype: numpy.dtype
+    :param workspace: Transform buffers and FFT backend to reuse across calls (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :param lag: If True, also return the coherence weighted phase slope delay. See coh_gain_phase()
+    :type lag: bool
+    :return: Tuple of freqs, gain, phase, coh (and lag) as returned by cross_correlate()
+    :rtype: (ndarray, ndarray, ndarray, ndarray)
+    """
+
+    accum = CrossSpectralAccumulator(sampling_rate, band=band, bin_mask=bin_mask, taper_mode=taper_mode,
+                                     workspace=workspace)
+
+    logging.debug('Accumulating cross spectral matrices of {} sample segments...'.format(segment_len))
+    for segment in stream_segments(blocks, segment_len, overlap=overlap):
+        accum.add(segment[0], segment[1:])
+    logging.debug('Accumulating cross spectral matrices of {} sample segments... complete ({} segments)'.format(
+        segment_len, accum.segment_cnt))
+
+    results = accum.result(dtype=dtype, lag=lag)
+
+    if lag:
+        freqs, gain, phase, coh, lags = results
+        return freqs, gain[0], phase[0], coh[0], lags[0]
+
+    freqs, gain, phase, coh = results
+    return freqs, gain[0], phase[0], coh[0]
+
+
+def coh_gain_phase(sxy, gain=None, phase=None, coh=None, dtype=float64, freqs=None):
+    """Coherence squared, transfer function gain and phase from a normalized cross spectral matrix, and
+    optionally the delay between the two series (cross.f lag()).
+
+    Results are written into gain, phase and coh when given (e.g. rows of preallocated 2-D arrays),
+    otherwise new arrays of the given dtype are returned. Intermediates are float64 regardless of dtype.
+
+    With freqs, the delay is the coherence weighted mean phase slope, converted to seconds. Phase steps larger
+    than 200 degrees (phase wraps) and steps across gaps in band/bin_mask selections are excluded. Each step
+    is weighted by the sum of the coherence at its two frequencies.
+
+    :param sxy: Cross spectral matrix (nfreqs x 4)
+    :type sxy: ndarray
+    :param gain: Output array for gain (Optional)
+    :type gain: ndarray
+    :param phase: Output array for phase (Optional)
+    :type phase: ndarray
+    :param coh: Output array for coherence squared (Optional)
+    :type coh: ndarray
+    :param dtype: dtype of arrays allocated for outputs not given
+    :type dtype: numpy.dtype
+    :param freqs: Frequencies in hz of the rows of sxy. If given, the delay is also returned. (Optional)
+    :type freqs: ndarray
+    :return: gain, phase (in degrees), coh and, with freqs, the delay of output relative to input in seconds
+        (positive when output lags, nan if there are no usable phase steps)
+    :rtype: (ndarray, ndarray, ndarray) or (ndarray, ndarray, ndarray, float)
+    """
+
+    deg_per_rad = 180.0 / pi
+
+    freq_cnt = sxy.shape[0]
+    if gain is None:
+        gain = empty(freq_cnt, dtype=dtype)
+    if phase is None:
+        phase = empty(freq_cnt, dtype=dtype)
+    if coh is None:
+        coh = empty(freq_cnt, dtype=dtype)
+
+    # sxy(j,3)**2 + sxy(j,4)**2
+    cross_sq = sxy[:, 2] * sxy[:, 2]
+    cross_sq += sxy[:, 3] * sxy[:, 3]
+
+    # gamsq=(sxy(j,3)**2 + sxy(j,4)**2)/(sxy(j,1)*sxy(j,2))
+    divide(cross_sq, sxy[:, 0] * sxy[:, 1], out=coh)
+
+    # gain=sqrt(gamsq*sxy(j,2)/sxy(j,1)) == sqrt(sxy(j,3)**2 + sxy(j,4)**2)/sxy(j,1)
+    sqrt(cross_sq, out=cross_sq)
+    divide(cross_sq, sxy[:, 0], out=gain)
+
+    # phase=deg* atan2( sxy(j,4),  sxy(j,3))
+    arctan2(sxy[:, 3], sxy[:, 2], out=phase)
+    phase *= deg_per_rad
 
     # # kmin=nf
     # #     kmax=0
@@ -158,11 +647,83 @@ def cross_correlate(sampling_rate, ts1, ts2):
     # # 2000 continue
     # #     kbar=kbar/nf
 
-    del sxy
-    del ts1_data
-    del ts2_data
+    if freqs is None:
+        return gain, phase, coh
 
-    return freqs, gain, phase, coh
+    # lag(ts_info, freqndx, phase, gamsq), vectorized over all frequencies
+    if freqs.size < 2:
+        return gain, phase, coh, float('nan')
+
+    # x = phase - pho; w = gamsq + gmo
+    dphase = phase[1:] - phase[:-1]
+    dfreq = freqs[1:] - freqs[:-1]
+    wts = coh[1:] + coh[:-1]
+
+    # Exclude phase wrap: abs(x) .le. 200.0, and steps spanning more than one bin
+    usable = (abs(dphase) <= 200.0) & (dfreq <= 1.5 * dfreq.min())
+    sw = wts[usable].sum(dtype=float64)
+    if sw <= 0.0:
+        return gain, phase, coh, float('nan')
+
+    # phase = swx/sw, here as degrees per hz
+    swx = dot(wts[usable].astype(float64), dphase[usable] / dfreq[usable])
+
+    return gain, phase, coh, -(swx / sw) / 360.0
+
+
+def log_lag(lag_secs, sampling_rate, label):
+    """Log a coh_gain_phase() delay estimate, as a warning if it exceeds half a sample.
+
+    :param lag_secs: Delay in seconds
+    :type lag_secs: float
+    :param sampling_rate: Sampling rate of the series
+    :type sampling_rate: float
+    :param label: Name of the series (e.g. component) for the log message
+    :type label: str
+    """
+
+    msg = 'Phase slope lag ({}): {:.6f} s ({:.3f} samples)'.format(label, lag_secs, lag_secs * sampling_rate)
+    if abs(lag_secs * sampling_rate) > 0.5:
+        logging.warning(msg + ' - time series may not be synchronized')
+    else:
+        logging.debug(msg)
+
+
+def band_freq_ndxs(fft_usable_len, freq_bin_size, band=None, bin_mask=None):
+    """Frequency indices to evaluate for a cross_correlate() band or bin mask.
+
+    :param fft_usable_len: Number of frequencies in full band result
+    :type fft_usable_len: int
+    :param freq_bin_size: Frequency spacing in hz
+    :type freq_bin_size: float
+    :param band: (low, high) frequencies (inclusive). (Optional)
+    :type band: (float, float)
+    :param bin_mask: Boolean mask of length fft_usable_len. (Optional)
+    :type bin_mask: ndarray
+    :return: Sorted frequency indices. All indices if neither band nor bin_mask given.
+    :rtype: ndarray
+    """
+
+    if (band is not None) and (bin_mask is not None):
+        msg = 'Only one of band or bin_mask may be specified.'
+        logging.error(msg)
+        raise ValueError(msg)
+
+    if band is not None:
+        # small tolerance so band edges falling exactly on a bin are kept despite rounding
+        lo_ndx = max(0, int(ceil(band[0] / freq_bin_size - 1e-9)))
+        hi_ndx = min(fft_usable_len - 1, int(floor(band[1] / freq_bin_size + 1e-9)))
+        freq_ndxs = arange(lo_ndx, hi_ndx + 1)
+    elif bin_mask is not None:
+        if len(bin_mask) != fft_usable_len:
+            msg = 'bin_mask length ({}) must match number of frequencies ({}).'.format(len(bin_mask), fft_usable_len)
+            logging.error(msg)
+            raise ValueError(msg)
+        freq_ndxs = flatnonzero(bin_mask)
+    else:
+        freq_ndxs = arange(fft_usable_len)
+
+    return freq_ndxs
 
 
 # def lag(ts_info, fndx, phase, gamsq):
@@ -212,8 +773,384 @@ def cross_correlate(sampling_rate, ts1, ts2):
 #
 
 
-def spcmat(ts1, ts2, taper_cnt):
-    """Python implementation of the cross.f spcmat() routine with IDA fixed parameters"""
+def _chirp_spectrum(ts, opt_len, nbins, workspace=None):
+    """Bins 0..nbins-1 of the 2*opt_len point DFT of ts[0:opt_len] using Bluestein's chirp-z algorithm,
+    with the convolution done at a fast (5-smooth) transform length."""
+
+    pad_len = 2 * opt_len
+    fast_len = next_fast_len(opt_len + nbins - 1)
+
+    # chirp exponent m**2 reduced modulo 2*pad_len in integer math to retain precision for long series
+    ndx = arange(max(opt_len, nbins), dtype=int64)
+    chirp = exp((-1j * pi / pad_len) * ((ndx * ndx) % (2 * pad_len)))
+
+    seq = zeros_buffer(fast_len, complex128, 'chirp_seq', workspace=workspace)
+    seq[:opt_len] = ts[:opt_len] * chirp[:opt_len]
+    kernel = zeros_buffer(fast_len, complex128, 'chirp_kernel', workspace=workspace)
+    kernel[:nbins] = chirp[:nbins].conjugate()
+    kernel[fast_len - opt_len + 1:] = chirp[opt_len - 1:0:-1].conjugate()
+
+    spec = ifft(fft(seq, workspace=workspace) * fft(kernel, workspace=workspace), workspace=workspace)[:nbins]
+    spec *= chirp[:nbins]
+
+    return spec
+
+
+def padded_spectrum(ts, opt_len, margin, workspace=None):
+    """Conjugated spectrum of ts[0:opt_len] zero padded to 2*opt_len, as used by spcmat(), restricted to the bins
+    -margin..(opt_len + margin).
+
+    A real-input transform is used and the negative and above-Nyquist bins in the margins are filled in by
+    conjugate symmetry, so neither the zero padding nor the redundant half of the full complex FFT is
+    materialized. If 2*opt_len is not a fast transform length, the bins are computed with a chirp-z transform
+    at a fast composite length instead.
+
+    :param ts: Time series
+    :type ts: ndarray
+    :param opt_len: Number of samples of ts to use. Transform length is 2*opt_len.
+    :type opt_len: int
+    :param margin: Number of bins needed beyond each end of 0..opt_len. Must be <= opt_len.
+    :type margin: int
+    :param workspace: Transform buffers and FFT backend (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :return: Array of length opt_len + 2*margin + 1. Element [j + margin] holds conjugated bin j.
+    :rtype: ndarray
+    """
+
+    pad_len = 2 * opt_len
+    if next_fast_len(pad_len) == pad_len:
+        spec = rfft(ts[:opt_len], pad_len, workspace=workspace)
+    else:
+        spec = _chirp_spectrum(ts, opt_len, opt_len + 1, workspace=workspace)
+
+    spec_ext = empty(opt_len + 2 * margin + 1, dtype=complex128)
+    spec_ext[margin:margin + opt_len + 1] = spec.conjugate()
+    if margin > 0:
+        # bins -margin..-1 and opt_len+1..opt_len+margin by conjugate symmetry of real input transform
+        spec_ext[:margin] = spec[margin:0:-1]
+        spec_ext[margin + opt_len + 1:] = spec[opt_len - 1:opt_len - margin - 1:-1]
+
+    return spec_ext
+
+
+def taper_weights(taper_cnt):
+    """Parabolic taper weights, including the cross.f exact normalization factor, for tapers 1..taper_cnt.
+
+    :param taper_cnt: Number of tapers
+    :type taper_cnt: int
+    :return: Weights for tapers 1..taper_cnt
+    :rtype: ndarray
+    """
+
+    klim = taper_cnt
+    ck = 1.0 / klim ** 2
+    wt = 6.0 * klim / (4 * klim ** 2 + 3 * klim - 1)
+
+    return wt * (1.0 - ck * (arange(klim) ** 2))
+
+
+def taper_average(ts1_fft, ts2_fft, taper_cnt, freq_ndxs, margin=None, block_size=SPCMAT_BLOCK_SIZE):
+    """Unnormalized cross spectral matrix rows for the requested frequency indices, averaged over sine tapers
+    with parabolic weights. See taper_average_multi().
+
+    :param ts1_fft: Spectrum of first time series from padded_spectrum()
+    :type ts1_fft: ndarray
+    :param ts2_fft: Spectrum of second time series from padded_spectrum()
+    :type ts2_fft: ndarray
+    :param taper_cnt: Number of sine tapers to average at each frequency
+    :type taper_cnt: int
+    :param freq_ndxs: Frequency indices (0..fft_usable_len-1) at which to evaluate the matrix
+    :type freq_ndxs: ndarray
+    :param margin: margin used with padded_spectrum(). Must be >= taper_cnt. Defaults to taper_cnt.
+    :type margin: int
+    :param block_size: Approximate number of (frequency, taper) pairs evaluated per block. Bounds temp memory.
+    :type block_size: int
+    :return: Unnormalized cross spectral matrix (freq_ndxs.size x 4)
+    :rtype: ndarray
+    """
+
+    return taper_average_multi(ts1_fft, [ts2_fft], taper_cnt, freq_ndxs, margin=margin, block_size=block_size)[0]
+
+
+def taper_average_multi(ts1_fft, ts2_ffts, taper_cnt, freq_ndxs, margin=None, block_size=SPCMAT_BLOCK_SIZE,
+                        cross_terms=True):
+    """Unnormalized cross spectral matrix rows between one input spectrum and each of several output spectra
+    for the requested frequency indices, averaged over sine tapers with parabolic weights.
+
+    The taper averaging is done as array operations over blocks of frequencies. The j1/j2 index
+    offsets and the parabolic taper weights are built once and reused for every block, and the
+    input differences and power are computed once per block for all outputs.
+
+    taper_cnt may also be an array with a taper count per frequency (see adaptive_taper_cnts()). The parabolic
+    weight 1 - (k-1)**2 / K**2 is zero at k = K + 1 and negative beyond, so clipping it at zero gives the
+    weights for all of a block's frequencies as one (freqs x max K) array, with no per-frequency loop or
+    masking. A variable count per frequency then costs about the same as a fixed count equal to the largest
+    count in each block.
+
+    :param ts1_fft: Spectrum of input time series from padded_spectrum()
+    :type ts1_fft: ndarray
+    :param ts2_ffts: Spectra of output time series from padded_spectrum(), same margin as ts1_fft
+    :type ts2_ffts: [ndarray]
+    :param taper_cnt: Number of sine tapers to average at each frequency, or array of counts for each freq_ndxs
+    :type taper_cnt: int or ndarray
+    :param freq_ndxs: Frequency indices (0..fft_usable_len-1) at which to evaluate the matrix
+    :type freq_ndxs: ndarray
+    :param margin: margin used with padded_spectrum(). Must be >= taper_cnt. Defaults to max taper_cnt.
+    :type margin: int
+    :param block_size: Approximate number of (frequency, taper) pairs evaluated per block. Bounds temp memory.
+    :type block_size: int
+    :param cross_terms: If False, only the power columns sxy[:, 0] and sxy[:, 1] are computed
+    :type cross_terms: bool
+    :return: Unnormalized cross spectral matrices (freq_ndxs.size x 4), one per output spectrum
+    :rtype: [ndarray]
+    """
+
+    adaptive = isinstance(taper_cnt, ndarray)
+    kmax = int(taper_cnt.max()) if adaptive else taper_cnt
+    if margin is None:
+        margin = kmax
+
+    # parabolic weights and j1/j2 offsets from 2 * freqndx. Offset by margin to index into the
+    # padded_spectrum() arrays, so no modulo is needed.
+    tapers = arange(1, kmax + 1)
+    j1_offsets = margin - tapers
+    j2_offsets = margin + tapers
+    if adaptive:
+        taper_sqs = (tapers - 1) ** 2
+    else:
+        taper_wts = taper_weights(kmax)
+
+    freq_cnt = freq_ndxs.size
+    blk_len = max(1, min(freq_cnt, block_size // kmax))
+    j1 = empty((blk_len, kmax), dtype=int64)
+    j2 = empty((blk_len, kmax), dtype=int64)
+
+    sxys = [zeros([freq_cnt, 4], dtype=float64) for _ in ts2_ffts]
+
+    for blk_start in range(0, freq_cnt, blk_len):
+        blk_end = min(blk_start + blk_len, freq_cnt)
+        cnt = blk_end - blk_start
+        freqndx2 = 2 * freq_ndxs[blk_start:blk_end]
+
+        if adaptive:
+            blk_cnts = taper_cnt[blk_start:blk_end]
+            klim = int(blk_cnts.max())
+            blk_wts = 6.0 * blk_cnts / (4 * blk_cnts ** 2 + 3 * blk_cnts - 1)
+            blk_cks = 1.0 / blk_cnts ** 2
+
+            blk_taper_wts = blk_wts.reshape(-1, 1) * maximum(0.0, 1.0 - blk_cks.reshape(-1, 1) * taper_sqs[:klim])
+
+            def taper_sum(vals):
+                return einsum('ij,ij->i', vals, blk_taper_wts)
+        else:
+            klim = kmax
+
+            def taper_sum(vals):
+                return dot(vals, taper_wts)
+
+        blk_j1 = j1[:cnt, :klim]
+        blk_j2 = j2[:cnt, :klim]
+        add.outer(freqndx2, j1_offsets[:klim], out=blk_j1)
+        add.outer(freqndx2, j2_offsets[:klim], out=blk_j2)
+
+        z1 = ts1_fft[blk_j1] - ts1_fft[blk_j2]
+        pow1 = taper_sum(z1.real ** 2 + z1.imag ** 2)
+
+        for ts2_fft, sxy in zip(ts2_ffts, sxys):
+            z2 = ts2_fft[blk_j1] - ts2_fft[blk_j2]
+
+            sxy[blk_start:blk_end, 0] = pow1
+            sxy[blk_start:blk_end, 1] = taper_sum(z2.real ** 2 + z2.imag ** 2)
+            if not cross_terms:
+                continue
+            # z1 * conj(z2) holds both cross terms: real => sxy[:, 2], imag => sxy[:, 3]
+            z2 = z1 * z2.conjugate()
+            cross = taper_sum(z2)
+            sxy[blk_start:blk_end, 2] = cross.real
+            sxy[blk_start:blk_end, 3] = cross.imag
+
+    return sxys
+
+
+def riedsid_taper_cnts(psds, smooth_len, min_cnt, max_cnt):
+    """Riedel-Sidorenko optimal taper count at each frequency for parabolic weighted sine tapers.
+
+    Minimizing the mean square error (spectral bias from curvature + variance) gives
+        kopt = 3.437 * |S / S''|**0.4
+    with S'' taken with respect to frequency index. S''/S = (ln S)'' + ((ln S)')**2, with the derivatives
+    of ln S estimated by a least squares quadratic over +/- smooth_len bins (a fixed kernel convolution).
+    Where several psds are given, the largest curvature (fewest tapers) is used. As in cross.f, the count
+    may not change by more than one from one frequency to the next, which is enforced with a forward and
+    backward running minimum.
+
+    :param psds: Power spectral density estimates on a contiguous run of frequency indices
+    :type psds: [ndarray]
+    :param smooth_len: Half width, in bins, of derivative estimation window
+    :type smooth_len: int
+    :param min_cnt: Minimum taper count
+    :type min_cnt: int
+    :param max_cnt: Maximum taper count
+    :type max_cnt: int
+    :return: taper count for each frequency
+    :rtype: ndarray
+    """
+
+    freq_cnt = psds[0].size
+    smooth_len = max(1, min(smooth_len, freq_cnt - 2))
+    if freq_cnt < 3:
+        return zeros(freq_cnt, dtype=int64) + max_cnt
+
+    # orthogonal least squares quadratic on -smooth_len..smooth_len
+    offsets = arange(-smooth_len, smooth_len + 1, dtype=float64)
+    d1_kernel = offsets / (offsets ** 2).sum()
+    centered_sqs = offsets ** 2 - (offsets ** 2).mean()
+    d2_kernel = 2.0 * centered_sqs / (centered_sqs ** 2).sum()
+
+    curvature = zeros(freq_cnt, dtype=float64)
+    for psd in psds:
+        log_psd = log(maximum(abs(psd), finfo(float64).tiny))
+        # psd is even about its end points (0 hz and nyquist), so reflect for derivatives at the ends
+        padded = concatenate((log_psd[smooth_len:0:-1], log_psd, log_psd[-2:-smooth_len - 2:-1]))
+        d1 = convolve(padded, d1_kernel[::-1], mode='valid')
+        d2 = convolve(padded, d2_kernel, mode='valid')
+        maximum(curvature, abs(d2 + d1 ** 2), out=curvature)
+
+    # 3.437 = 480**0.2
+    kopt = 3.437 / (curvature + finfo(float64).tiny) ** 0.4
+    kopt = rint(clip(kopt, min_cnt, max_cnt))
+
+    # limit change to one taper per bin: kopt[j] = min(kopt[i] + |i - j|)
+    ndxs = arange(freq_cnt)
+    kopt = minimum(kopt, ndxs + minimum.accumulate(kopt - ndxs))
+    kopt = minimum(kopt, minimum.accumulate((kopt + ndxs)[::-1])[::-1] - ndxs)
+
+    return kopt.astype(int64)
+
+
+def adaptive_taper_cnts(ts1_fft, ts2_ffts, taper_cnt, freq_ndxs, fft_usable_len, margin,
+                        iterations=ADAPTIVE_TAPER_ITERATIONS):
+    """Adaptive (cross.f kopt) taper count for each of freq_ndxs.
+
+    Starting from a pilot estimate using the fixed taper_cnt, the input and output power spectra are
+    re-estimated with riedsid_taper_cnts() counts for the given number of iterations. The pilot is computed
+    over freq_ndxs extended by enough bins that the counts match those of a full band computation.
+
+    :param ts1_fft: Spectrum of input time series from padded_spectrum()
+    :type ts1_fft: ndarray
+    :param ts2_ffts: Spectra of output time series from padded_spectrum(), same margin as ts1_fft
+    :type ts2_ffts: [ndarray]
+    :param taper_cnt: Fixed (pilot) taper count. Also used as derivative smoothing half width.
+    :type taper_cnt: int
+    :param freq_ndxs: Sorted frequency indices at which taper counts are needed
+    :type freq_ndxs: ndarray
+    :param fft_usable_len: Number of frequencies in full band
+    :type fft_usable_len: int
+    :param margin: margin used with padded_spectrum(). Also the maximum taper count.
+    :type margin: int
+    :param iterations: Number of re-estimation passes
+    :type iterations: int
+    :return: Taper count for each of freq_ndxs
+    :rtype: ndarray
+    """
+
+    min_cnt = min(ADAPTIVE_TAPER_MIN, taper_cnt)
+    max_cnt = margin
+    smooth_len = taper_cnt
+
+    ext_len = iterations * (smooth_len + max_cnt)
+    ext_ndxs = arange(max(0, freq_ndxs[0] - ext_len), min(fft_usable_len, freq_ndxs[-1] + ext_len + 1))
+
+    cnts = taper_cnt
+    for _ in range(iterations):
+        sxys = taper_average_multi(ts1_fft, ts2_ffts, cnts, ext_ndxs, margin=margin, cross_terms=False)
+        psds = [sxys[0][:, 0]] + [sxy[:, 1] for sxy in sxys]
+        cnts = riedsid_taper_cnts(psds, smooth_len, min_cnt, max_cnt)
+        del sxys
+
+    cnts = cnts[freq_ndxs - ext_ndxs[0]]
+    logging.debug('Adaptive taper cnt min: {} mean: {:.1f} max: {}'.format(cnts.min(), cnts.mean(), cnts.max()))
+
+    return cnts
+
+
+def taper_power(ts, ts_fft, taper_cnt, margin=None, workspace=None):
+    """Trapezoidal sum of the unnormalized taper averaged power spectrum of ts over ALL fft_usable_len
+    frequencies, i.e. the cross_correlate() normalization power, without evaluating the spectrum at every bin.
+
+    For sine taper k, the sum over the even bins of the full padded spectrum of |Y(j-k) - Y(j+k)|**2
+    reduces by Parseval's theorem to 2N * sum(ts**2 * (1 - cos(2 pi k n / N))), i.e. one real FFT of ts**2.
+    Conjugate symmetry folds that onto the fft_usable_len bins, leaving only end point corrections
+    taken from ts_fft.
+
+    :param ts: De-meaned time series used to compute ts_fft
+    :type ts: ndarray
+    :param ts_fft: Spectrum of ts from padded_spectrum()
+    :type ts_fft: ndarray
+    :param taper_cnt: Number of sine tapers
+    :type taper_cnt: int
+    :param margin: margin used with padded_spectrum(). Must be >= taper_cnt. Defaults to taper_cnt.
+    :type margin: int
+    :param workspace: Transform buffers and FFT backend (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :return: power
+    :rtype: float
+    """
+
+    klim = taper_cnt
+    if margin is None:
+        margin = klim
+    opt_len = ts_fft.size - 2 * margin - 1
+
+    tapers = arange(1, klim + 1)
+    sq = multiply(ts[:opt_len], ts[:opt_len], out=empty_buffer(opt_len, float64, 'taper_power', workspace=workspace))
+    sq_fft = rfft(sq, workspace=workspace)
+    even_bin_sums = 2 * opt_len * (sq_fft[0].real - sq_fft[1:klim + 1].real)
+
+    # |Y(j-k) - Y(j+k)|**2 at j = opt_len (folding point) and j = opt_len - 2 (last usable bin)
+    end_terms = abs(ts_fft[margin + opt_len - tapers] - ts_fft[margin + opt_len + tapers]) ** 2 + \
+                abs(ts_fft[margin + opt_len - 2 - tapers] - ts_fft[margin + opt_len - 2 + tapers]) ** 2
+
+    return 0.5 * dot(taper_weights(klim), even_bin_sums - end_terms)
+
+
+def spcmat(ts1, ts2, taper_cnt, block_size=SPCMAT_BLOCK_SIZE, workspace=None):
+    """Vectorized implementation of the cross.f spcmat() routine with IDA fixed parameters.
+    Results match spcmat_loop() to floating point tolerance.
+
+    :param ts1: First (de-meaned) time series
+    :type ts1: ndarray
+    :param ts2: Second (de-meaned) time series
+    :type ts2: ndarray
+    :param taper_cnt: Number of sine tapers to average at each frequency
+    :type taper_cnt: int
+    :param block_size: Approximate number of (frequency, taper) pairs evaluated per block. Bounds temp memory.
+    :type block_size: int
+    :param workspace: Transform buffers and FFT backend (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :return: Unnormalized cross spectral matrix (fft_usable_len x 4), fft_usable_len
+    :rtype: (ndarray, int)
+    """
+
+    opt_len = int((ts1.size // 2) * 2)
+    fft_usable_len = opt_len // 2
+
+    logging.debug('cross.spcmat() fft_usable_len: ' + str(fft_usable_len))
+
+    # only bins -taper_cnt..(opt_len + taper_cnt) of the padded spectra are ever referenced
+    ts1_fft = padded_spectrum(ts1, opt_len, taper_cnt, workspace=workspace)
+    ts2_fft = padded_spectrum(ts2, opt_len, taper_cnt, workspace=workspace)
+
+    sxy = taper_average(ts1_fft, ts2_fft, taper_cnt, arange(fft_usable_len), block_size=block_size)
+
+    return sxy, fft_usable_len
+
+
+def spcmat_loop(ts1, ts2, taper_cnt):
+    """Python implementation of the cross.f spcmat() routine with IDA fixed parameters.
+
+    Original per-frequency loop implementation. Retained for regression comparison and benchmarking
+    of the vectorized spcmat().
+    """
 
     opt_len = int((ts1.size // 2) * 2)
     # opt_len = 139968  # just for testing aginst cross.f
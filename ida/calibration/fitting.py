@@ -0,0 +1,944 @@
+#######################################################################################################################
+# Copyright (C) 2016  Regents of the University of California
+#
+# This is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License (GNU GPL) as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# A copy of the GNU General Public License can be found in LICENSE.TXT in the root of the source code repository.
+# Additionally, it can be found at http://www.gnu.org/licenses/.
+#
+# NOTES: Per GNU GPLv3 terms:
+#   * This notice must be kept in this source file
+#   * Changes to the source must be clearly noted with date & time of change
+#
+# If you use this software in a product, an explicit acknowledgment in the product documentation of the contribution
+# by Project IDA, Institute of Geophysics and Planetary Physics, UCSD would be appreciated but is not required.
+#######################################################################################################################
+
+import logging
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from inspect import signature
+from numpy import pi, empty, zeros, ones, float64, complex128, asarray, flatnonzero, subtract, multiply, divide, add, \
+    array_equal, concatenate, diff, floor, log10, clip, int64, argmin, std, repeat, arange, tile, maximum, \
+    minimum, bincount, inf, percentile, ceil, newaxis, dot, ravel, sqrt, median, finfo
+from numpy.random import RandomState
+from scipy.optimize import least_squares
+from scipy.optimize._numdiff import approx_derivative
+from scipy.sparse import csr_matrix
+from scipy.stats import norm
+import ida.signals.utils
+
+"""Response fitting kernels used by ida.calibration.process"""
+
+# log frequency grid density of the decimated fitting target (see log_bin_tf()). Fits use every frequency bin
+# unless decimation is asked for, e.g. fit_bins_per_decade=FIT_BINS_PER_DECADE.
+FIT_BINS_PER_DECADE = 100
+
+# coarse to fine fit_paz() stages: each fits the target decimated to this many bins per decade (None: every
+# bin), starting from the previous stage's result
+FIT_STAGES_COARSE_TO_FINE = (10, 30, None)
+
+# coherence squared is clipped below 1.0 so coh/(1 - coh) weights stay finite
+LOG_BIN_MAX_COH = 0.999999
+
+# bootstrap_tasks() residual block length in frequency bins. Taper averaging correlates neighbouring bins, so
+# residuals are resampled in contiguous blocks rather than individually.
+BOOTSTRAP_BLOCK_BINS = 32
+
+
+def log_bin_tf(freqs, tf, coh, bins_per_decade=FIT_BINS_PER_DECADE):
+    """Decimate a measured transfer function onto a log spaced frequency grid.
+
+    Bins are 1/bins_per_decade decades wide. Within a bin the transfer function and frequency are averaged
+    with weights coh/(1 - coh), the inverse of the relative variance of a transfer function estimate.
+    Low frequency bins containing a single FFT frequency keep it unchanged; empty bins are dropped.
+
+    The bin mean's variance is the inverse of the sum of its weights, so each bin's residual weight is the
+    square root of that sum. It is taken relative to the median frequency's weight, so a bin counts as the
+    number of typical FFT frequencies it stands for: wide high frequency bins are not outweighed by single
+    frequency low frequency bins, as they would be with equal weights.
+
+    :param freqs: Frequencies in hz, ascending and > 0
+    :type freqs: ndarray
+    :param tf: Complex transfer function at freqs
+    :type tf: ndarray
+    :param coh: Square of coherence at freqs
+    :type coh: ndarray
+    :param bins_per_decade: Log frequency grid density
+    :type bins_per_decade: float
+    :return: bin frequencies, bin transfer function, bin residual weights
+    :rtype: (ndarray, ndarray, ndarray)
+    """
+
+    bin_ids = floor(log10(freqs) * bins_per_decade).astype(int64)
+    starts = concatenate(([0], flatnonzero(diff(bin_ids)) + 1))
+
+    coh = clip(coh, 0.0, LOG_BIN_MAX_COH)
+    wts = coh / (1.0 - coh)
+    wt_sums = add.reduceat(wts, starts)
+    used = wt_sums > 0.0
+    wt_sums = wt_sums[used]
+
+    bin_freqs = add.reduceat(wts * freqs, starts)[used] / wt_sums
+    bin_tf = add.reduceat(wts * tf, starts)[used] / wt_sums
+    bin_wts = sqrt(wt_sums / max(median(wts), finfo(float64).tiny))
+
+    logging.debug('Log binned {} frequencies to {} ({} per decade)'.format(freqs.size, bin_freqs.size,
+                                                                           bins_per_decade))
+
+    return bin_freqs, bin_tf, bin_wts
+
+
+class PAZResidualKernel(object):
+    """
+    Residuals (and jacobian) of resp_cost() for a fixed frequency vector and pack_paz() flag layout.
+
+    The pack_paz() flags are compiled once into index maps, so each evaluation maps the parameter vector
+    directly to pole and zero values and evaluates the product form of the response into preallocated
+    buffers, with no PAZ instance, polynomial expansion or normalization search per call.
+
+    The returned residual and jacobian arrays are copies of the internal buffers because least_squares()
+    keeps references to earlier results while it evaluates trial steps.
+    """
+
+    def __init__(self, paz_partial_flags, freqs, normfreq, tf_target, resp_pert0, weights=None, norm_at=None):
+        """
+        :param paz_partial_flags: pack_paz() flags
+        :type paz_partial_flags: ([str], [str])
+        :param freqs: Fitting frequencies in hz
+        :type freqs: ndarray
+        :param normfreq: Normalization frequency in hz. The first frequency >= normfreq is used.
+        :type normfreq: float
+        :param tf_target: Measured normalized transfer function as concatenate((tf.real, tf.imag))
+        :type tf_target: ndarray
+        :param resp_pert0: Response of the starting PAZ at freqs
+        :type resp_pert0: ndarray
+        :param weights: Per frequency residual weights, e.g. from log_bin_tf() (Optional)
+        :type weights: ndarray
+        :param norm_at: Frequency at which the model is normalized, i.e. where tf_target was normalized.
+            Defaults to the first of freqs >= normfreq, as in resp_cost().
+        :type norm_at: float
+        """
+
+        freqs = asarray(freqs, dtype=float64)
+        if norm_at is None:
+            norm_at = freqs[ida.signals.utils.frequency_index(freqs, normfreq)]
+
+        self.flags = paz_partial_flags
+        self.freqs = freqs
+        self.freq_cnt = freqs.size
+        self.normfreq = normfreq
+        self.norm_at = norm_at
+        self.weights = None if weights is None else asarray(weights, dtype=float64)
+
+        pole_map, zero_map = ida.signals.utils.pack_paz_index_map(paz_partial_flags)
+        # roots sharing index -1 read the trailing 0.0 of the extended parameter vector
+        self._re_ndxs = list(pole_map[:, 0]) + list(zero_map[:, 0])
+        self._im_ndxs = list(pole_map[:, 1]) + list(zero_map[:, 1])
+        self._im_signs = list(pole_map[:, 2]) + list(zero_map[:, 2])
+        self._pole_cnt = pole_map.shape[0]
+        self.param_cnt = max([-1] + self._re_ndxs + self._im_ndxs) + 2  # h0 is last
+        self._p_ext = zeros(self.param_cnt + 1, dtype=float64)
+
+        # model is evaluated at freqs plus norm_at, which is last
+        freq_cnt = self.freq_cnt
+        self._s = 2j * pi * concatenate((freqs, [norm_at]))
+        self._inv_resp0 = ones(freq_cnt + 1, dtype=complex128)
+        self._inv_resp0[:freq_cnt] /= asarray(resp_pert0, dtype=complex128)
+        self._tf_target_re = asarray(tf_target[:freq_cnt], dtype=float64)
+        self._tf_target_im = asarray(tf_target[freq_cnt:], dtype=float64)
+
+        self._roots = empty(len(self._re_ndxs), dtype=complex128)
+        self._tf = empty(freq_cnt + 1, dtype=complex128)
+        self._tmp = empty(freq_cnt + 1, dtype=complex128)
+        self._tmp2 = empty(freq_cnt + 1, dtype=complex128)
+        self._resid = empty(2 * freq_cnt, dtype=float64)
+        self._dlnh = empty((self.param_cnt, freq_cnt + 1), dtype=complex128)
+        self._jac = empty((2 * freq_cnt, self.param_cnt), dtype=float64)
+        self._tf_p = None
+
+    def _update_roots(self, p):
+        """Poles followed by zeros in rad from pack_paz() data vector p."""
+
+        self._p_ext[:-1] = p
+        for ndx in range(self._roots.size):
+            self._roots[ndx] = 2 * pi * complex(self._p_ext[self._re_ndxs[ndx]],
+                                                self._im_signs[ndx] * self._p_ext[self._im_ndxs[ndx]])
+
+    def _update_tf(self, p):
+        """Normalized response of p divided by resp_pert0, into self._tf. Skipped if p is unchanged."""
+
+        if (self._tf_p is not None) and array_equal(p, self._tf_p):
+            return
+
+        self._update_roots(p)
+        tf = self._tf
+        tf.fill(p[-1])
+        for ndx in range(self._roots.size):
+            subtract(self._s, self._roots[ndx], out=self._tmp)
+            if ndx < self._pole_cnt:
+                divide(tf, self._tmp, out=tf)
+            else:
+                multiply(tf, self._tmp, out=tf)
+
+        tf /= abs(tf[-1])
+        multiply(tf, self._inv_resp0, out=tf)
+
+        self._tf_p = p.copy()
+
+    def residuals(self, p):
+        """Same result as resp_cost(p, flags, freqs, normfreq, tf_target, resp_pert0) when no weights or norm_at
+        are given.
+
+        :param p: pack_paz() data vector
+        :type p: ndarray
+        :return: Residuals, real parts followed by imaginary parts
+        :rtype: ndarray
+        """
+
+        self._update_tf(p)
+
+        freq_cnt = self.freqs.size
+        subtract(self._tf.real[:freq_cnt], self._tf_target_re, out=self._resid[:freq_cnt])
+        subtract(self._tf.imag[:freq_cnt], self._tf_target_im, out=self._resid[freq_cnt:])
+        if self.weights is not None:
+            self._resid[:freq_cnt] *= self.weights
+            self._resid[freq_cnt:] *= self.weights
+
+        return self._resid.copy()
+
+    def jacobian(self, p, *args):
+        """Same result as resp_cost_jac(p, flags, freqs, normfreq, tf_target, resp_pert0).
+        Extra positional args (least_squares() passes the residuals) are ignored.
+
+        :param p: pack_paz() data vector
+        :type p: ndarray
+        :return: (2 * freqs.size x p.size) jacobian, real part rows followed by imaginary part rows
+        :rtype: ndarray
+        """
+
+        self._update_tf(p)
+
+        # rows of d ln H/dp: 2*pi/(s - P) for poles, -2*pi/(s - Z) for zeros, times j for imaginary parts
+        dlnh = self._dlnh
+        dlnh.fill(0)
+        for ndx in range(self._roots.size):
+            re_ndx = self._re_ndxs[ndx]
+            if re_ndx < 0:
+                continue
+            subtract(self._s, self._roots[ndx], out=self._tmp)
+            divide(2 * pi if ndx < self._pole_cnt else -2 * pi, self._tmp, out=self._tmp)
+            add(dlnh[re_ndx], self._tmp, out=dlnh[re_ndx])
+            im_ndx = self._im_ndxs[ndx]
+            if im_ndx >= 0:
+                multiply(self._tmp, 1j * self._im_signs[ndx], out=self._tmp2)
+                add(dlnh[im_ndx], self._tmp2, out=dlnh[im_ndx])
+
+        # d ln|H(normfreq)|/dp = Re(d ln H(normfreq)/dp); d tf/dp = tf * d ln(tf)/dp
+        for row in range(self.param_cnt):
+            dlnh[row] -= dlnh[row, -1].real
+            multiply(dlnh[row], self._tf, out=dlnh[row])
+            if self.weights is not None:
+                dlnh[row, :-1] *= self.weights
+
+        freq_cnt = self.freqs.size
+        self._jac[:freq_cnt] = dlnh[:, :freq_cnt].real.T
+        self._jac[freq_cnt:] = dlnh[:, :freq_cnt].imag.T
+
+        return self._jac.copy()
+
+
+# fit_paz() jacobian: closed form (PAZResidualKernel.jacobian), or a least_squares() finite difference scheme
+FIT_JAC_ANALYTIC = 'analytic'
+FIT_JAC_MODES = [FIT_JAC_ANALYTIC, '2-point', '3-point']
+
+# least_squares() relative finite difference step
+FIT_DIFF_STEP = 0.001
+
+# least_squares() takes an iteration callback in newer scipy
+LSQ_HAS_CALLBACK = 'callback' in signature(least_squares).parameters
+
+# One least squares fit of a partial PAZ to a normalized measured TF and its coherence. Tasks hold only
+# picklable values so they can be run in worker processes (see run_fit_tasks()). start_paz is an optional
+# partial PAZ with the same layout as paz, e.g. from a previous calibration, to start the fit from. stages
+# lists the log_bin_tf() bins per decade of each fitting stage, None or 0 fitting every frequency.
+PAZFitTask = namedtuple('PAZFitTask', ['label', 'paz', 'norm_freq', 'freqs', 'tf', 'coh', 'norm_at', 'jac',
+                                       'start_paz', 'stages'])
+
+# fit_paz() result: fitted partial PAZ plus least_squares() summary. nfev, njev and secs are totals over all
+# stages, cost, status, message and active_mask (-1/0/1: at lower bound/free/at upper bound) are those of the
+# last stage.
+PAZFitResult = namedtuple('PAZFitResult', ['label', 'paz', 'x', 'cost', 'nfev', 'njev', 'status', 'message',
+                                           'stages', 'lb', 'ub', 'active_mask', 'secs'])
+
+# summary of one fit_paz() stage. costs holds the cost of the starting point and of every accepted iterate
+# (see CostTrajectory).
+PAZFitStage = namedtuple('PAZFitStage', ['bins_per_decade', 'freq_cnt', 'nfev', 'njev', 'cost', 'secs',
+                                         'initial_cost', 'costs', 'status', 'message'])
+
+# run_multi_start_fits() result for one task: lowest cost fit, plus final cost of every start and the standard
+# deviation of each fitted parameter across starts
+PAZMultiStartResult = namedtuple('PAZMultiStartResult', ['best', 'results', 'costs', 'x_std'])
+
+
+def paz_fit_params(paz):
+    """pack_paz() parameter vector, flags and fitting bounds of a partial PAZ.
+
+    Every pole and zero is bounded to +/- 50% of its value.
+
+    :param paz: Partial PAZ
+    :type paz: PAZ
+    :return: (parameters, flags, lower bounds, upper bounds)
+    :rtype: (ndarray, ([str], [str]), ndarray, ndarray)
+    """
+
+    paz_flat, paz_flags = ida.signals.utils.unpack_paz(paz, (list(range(0, paz.num_poles)),
+                                                             list(range(0, paz.num_zeros))))
+    paz_lb = paz_flat - 0.5 * abs(paz_flat)
+    paz_ub = paz_flat + 0.5 * abs(paz_flat)
+
+    return paz_flat, paz_flags, paz_lb, paz_ub
+
+
+def _fit_start(task, paz_flat, paz_flags, paz_lb, paz_ub):
+    """Starting parameters of task: task.start_paz clipped to the bounds, with the nominal h0, if its layout
+    matches, else nominal."""
+
+    if task.start_paz is None:
+        return paz_flat
+
+    start_flat, start_flags = ida.signals.utils.unpack_paz(task.start_paz,
+                                                           (list(range(0, task.start_paz.num_poles)),
+                                                            list(range(0, task.start_paz.num_zeros))))
+    if start_flags != paz_flags:
+        logging.warning('{} starting PAZ layout {} does not match nominal {}, '
+                        'starting from nominal.'.format(task.label, start_flags, paz_flags))
+        return paz_flat
+
+    paz_x0 = clip(start_flat, paz_lb, paz_ub)
+    # h0 is normalized out of the fit: start from the nominal h0, whatever gain the start_paz (e.g. a history
+    # response) was stored with
+    paz_x0[-1] = paz_flat[-1]
+    logging.debug('{} fit starting from: {}'.format(task.label, paz_x0))
+
+    return paz_x0
+
+
+def _stage_kernel(task, paz_flags, bins_per_decade):
+    """PAZResidualKernel of task with its target decimated to bins_per_decade (None or 0: every frequency)."""
+
+    if bins_per_decade:
+        fit_f, fit_tf, fit_wts = log_bin_tf(task.freqs, task.tf, task.coh, bins_per_decade)
+    else:
+        fit_f, fit_tf, fit_wts = task.freqs, task.tf, None
+
+    # initial response of paz over freq band of interest
+    resp0 = ida.signals.utils.compute_response(fit_f, task.paz)
+
+    return PAZResidualKernel(paz_flags, fit_f, task.norm_freq, concatenate((fit_tf.real, fit_tf.imag)), resp0,
+                             weights=fit_wts, norm_at=task.norm_at)
+
+
+class CostTrajectory(object):
+    """
+    Records the cost, 0.5 * sum(residuals ** 2), of the starting point and of each accepted least_squares()
+    iterate of a kernel's fit. Residuals evaluated at rejected trial steps and finite difference probes are
+    not recorded.
+
+    Where least_squares() takes an iteration callback, accepted costs come from it. Otherwise the jacobian is
+    wrapped: the trf method evaluates it once at the starting point and at each accepted iterate, where the
+    residuals were just evaluated. Finite difference jacobians are then computed by the wrapper, probing the
+    unwrapped residual function.
+    """
+
+    def __init__(self, kernel, jac, lb, ub, diff_step=FIT_DIFF_STEP):
+        """
+        :param kernel: Residual kernel, with residuals() and jacobian(), and an optional sparsity
+        :type kernel: PAZResidualKernel
+        :param jac: FIT_JAC_ANALYTIC or a least_squares() finite difference scheme
+        :type jac: str
+        :param lb: Parameter lower bounds
+        :type lb: ndarray
+        :param ub: Parameter upper bounds
+        :type ub: ndarray
+        :param diff_step: Relative finite difference step
+        :type diff_step: float
+        """
+
+        self.kernel = kernel
+        self.jac = jac
+        self.bounds = (lb, ub)
+        self.diff_step = diff_step
+        self.costs = []
+        self._last_x = None
+        self._last_resid = None
+
+    @staticmethod
+    def _cost(resid):
+
+        return 0.5 * float(dot(resid, resid))
+
+    def residuals(self, p):
+        resid = self.kernel.residuals(p)
+        if LSQ_HAS_CALLBACK:
+            if not self.costs:
+                self.costs.append(self._cost(resid))
+        else:
+            self._last_x = p.copy()
+            self._last_resid = resid
+        return resid
+
+    def callback(self, intermediate_result):
+        """least_squares() iteration callback."""
+
+        # an iteration that runs out of evaluations ends without accepting a step, accepted steps lower the cost
+        if intermediate_result.cost < self.costs[-1]:
+            self.costs.append(float(intermediate_result.cost))
+
+    def jacobian(self, p):
+        """Jacobian at an accepted iterate, without an iteration callback."""
+
+        if self._last_x is None or not array_equal(p, self._last_x):
+            self.residuals(p)
+        self.costs.append(self._cost(self._last_resid))
+
+        if self.jac == FIT_JAC_ANALYTIC:
+            return self.kernel.jacobian(p)
+
+        # the finite difference jacobian least_squares() would compute, without passing the probes through
+        # residuals()
+        return approx_derivative(self.kernel.residuals, p, method=self.jac, rel_step=self.diff_step,
+                                 f0=self._last_resid, bounds=self.bounds,
+                                 sparsity=getattr(self.kernel, 'sparsity', None))
+
+    def least_squares_args(self):
+        """least_squares() residual function, jacobian, jacobian sparsity and callback arguments.
+
+        :return: Keyword arguments
+        :rtype: dict
+        """
+
+        if not LSQ_HAS_CALLBACK:
+            return {'fun': self.residuals, 'jac': self.jacobian}
+
+        if self.jac == FIT_JAC_ANALYTIC:
+            return {'fun': self.residuals, 'jac': self.kernel.jacobian, 'callback': self.callback}
+
+        return {'fun': self.residuals, 'jac': self.jac, 'jac_sparsity': getattr(self.kernel, 'sparsity', None),
+                'callback': self.callback}
+
+
+def _fit_stages(label, stage_bins, stage_kernel, paz_x0, paz_lb, paz_ub, jac):
+    """Run one least_squares() fit per entry of stage_bins, each starting from the previous result.
+
+    stage_kernel(bins_per_decade) returns the stage's kernel. A kernel with a sparsity attribute has a block
+    sparse jacobian, which is passed as jac_sparsity to finite difference jacobians.
+    """
+
+    if jac not in FIT_JAC_MODES:
+        msg = "Invalid jacobian mode: '{}'. Valid values: {}".format(jac, FIT_JAC_MODES)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    if not stage_bins:
+        msg = '{} fit has no stages.'.format(label)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    logging.info('Fitting new {} response...'.format(label))
+    paz_x = paz_x0
+    stages = []
+    for bins_per_decade in stage_bins:
+        stage_start = time.perf_counter()
+        kernel = stage_kernel(bins_per_decade)
+        # '3-point' jac matches MATLAB FiniteDifferenceType='central'
+        trajectory = CostTrajectory(kernel, jac, paz_lb, paz_ub)
+
+        res = least_squares(x0=paz_x,
+                            bounds=(paz_lb, paz_ub),  # lb, ub for each parameter
+                            method='trf',
+                            xtol=1e-6,
+                            ftol=1e-4,
+                            diff_step=FIT_DIFF_STEP,
+                            max_nfev=300,  # max number of function evaluations
+                            verbose=0,
+                            **trajectory.least_squares_args())
+        paz_x = res.x
+        freq_cnt = kernel.freq_cnt
+        stages.append(PAZFitStage(bins_per_decade, freq_cnt, res.nfev, res.njev, res.cost,
+                                  time.perf_counter() - stage_start, trajectory.costs[0], trajectory.costs,
+                                  res.status, res.message))
+        logging.debug('{} fitting stage {}: {} freqs, evaluations (fun, jac): {}, {}, cost: {}, '
+                      'secs: {:.3f}'.format(label, len(stages), freq_cnt, res.nfev, res.njev, res.cost,
+                                            stages[-1].secs))
+
+    logging.info('{} fitting termination: {}'.format(label, res.message))
+    logging.debug('{} fitting evaluations (fun, jac): {}, {}'.format(label,
+                                                                     sum([stage.nfev for stage in stages]),
+                                                                     sum([stage.njev for stage in stages])))
+    logging.debug('{} fitting paz results: {}'.format(label, res.x))
+
+    return res, stages
+
+
+def fit_paz(task):
+    """Fit the poles and zeros of task.paz to the normalized transfer function task.tf.
+
+    Every pole and zero of the partial PAZ is perturbed, bounded to +/- 50% of its nominal value. If
+    task.start_paz is set the fit starts from its values (clipped to the bounds) instead of the nominal ones.
+
+    The fit runs once per entry of task.stages, each stage fitting the target decimated to that grid density
+    and starting from the previous stage's result. Coarse stages are cheap and get close to the solution, so
+    the dense stages only refine it.
+
+    :param task: Fit definition
+    :type task: PAZFitTask
+    :return: Fit result, with the fitted partial PAZ in paz
+    :rtype: PAZFitResult
+    """
+
+    paz_flat, paz_flags, paz_lb, paz_ub = paz_fit_params(task.paz)
+    paz_x0 = _fit_start(task, paz_flat, paz_flags, paz_lb, paz_ub)
+
+    res, stages = _fit_stages(task.label, task.stages,
+                              lambda bins_per_decade: _stage_kernel(task, paz_flags, bins_per_decade),
+                              paz_x0, paz_lb, paz_ub, task.jac)
+
+    return PAZFitResult(task.label, ida.signals.utils.pack_paz(res.x, paz_flags), res.x, res.cost,
+                        sum([stage.nfev for stage in stages]), sum([stage.njev for stage in stages]),
+                        res.status, res.message, stages, paz_lb, paz_ub, res.active_mask,
+                        sum([stage.secs for stage in stages]))
+
+
+def joint_param_ndxs(paz_flags, shared_map, comp_cnt):
+    """Map the pack_paz() parameters of comp_cnt components onto one joint parameter vector.
+
+    Parameters of the roots in shared_map are common to all components and come first in the joint vector,
+    followed by the remaining parameters of each component in turn. h0 is never shared.
+
+    :param paz_flags: pack_paz() flags, the same for every component
+    :type paz_flags: ([str], [str])
+    :param shared_map: Indices of the shared poles and zeros in the partial PAZ
+    :type shared_map: ([int], [int])
+    :param comp_cnt: Component count
+    :type comp_cnt: int
+    :return: Joint index of each parameter of each component, and the joint parameter count
+    :rtype: ([ndarray], int)
+    """
+
+    pole_map, zero_map = ida.signals.utils.pack_paz_index_map(paz_flags)
+    param_cnt = max([-1] + list(pole_map[:, :2].ravel()) + list(zero_map[:, :2].ravel())) + 2  # h0 is last
+
+    shared = set()
+    for ndx in shared_map[0]:
+        shared.update(pole_map[ndx, :2])
+    for ndx in shared_map[1]:
+        shared.update(zero_map[ndx, :2])
+    shared.discard(-1)
+    shared = sorted(shared)
+    own = [ndx for ndx in range(param_cnt) if ndx not in shared]
+
+    param_ndxs = []
+    joint_cnt = len(shared)
+    for _ in range(comp_cnt):
+        ndxs = empty(param_cnt, dtype=int64)
+        ndxs[shared] = range(len(shared))
+        ndxs[own] = range(joint_cnt, joint_cnt + len(own))
+        joint_cnt += len(own)
+        param_ndxs.append(ndxs)
+
+    return param_ndxs, joint_cnt
+
+
+class JointPAZResidualKernel(object):
+    """
+    Stacked residuals of several PAZResidualKernel, e.g. one per component, whose parameters are taken from
+    one joint parameter vector (see joint_param_ndxs()).
+
+    Each component's residuals depend only on the shared parameters and its own, so the jacobian is block
+    sparse. jacobian() returns it as a sparse matrix and sparsity holds its structure for finite difference
+    jacobians.
+    """
+
+    def __init__(self, kernels, param_ndxs, joint_cnt):
+        """
+        :param kernels: Kernel of each component
+        :type kernels: [PAZResidualKernel]
+        :param param_ndxs: Joint index of each parameter of each component, from joint_param_ndxs()
+        :type param_ndxs: [ndarray]
+        :param joint_cnt: Joint parameter count
+        :type joint_cnt: int
+        """
+
+        self.kernels = kernels
+        self.param_ndxs = param_ndxs
+        self.param_cnt = joint_cnt
+        self.freq_cnt = sum([kernel.freq_cnt for kernel in kernels])
+
+        rows = []
+        cols = []
+        row_offset = 0
+        for kernel, ndxs in zip(kernels, param_ndxs):
+            resid_cnt = 2 * kernel.freq_cnt
+            rows.append(repeat(arange(row_offset, row_offset + resid_cnt), ndxs.size))
+            cols.append(tile(ndxs, resid_cnt))
+            row_offset += resid_cnt
+        self._rows = concatenate(rows)
+        self._cols = concatenate(cols)
+        self._shape = (row_offset, joint_cnt)
+        self.sparsity = csr_matrix((ones(self._rows.size), (self._rows, self._cols)), shape=self._shape)
+
+    def residuals(self, p):
+        return concatenate([kernel.residuals(p[ndxs]) for kernel, ndxs in zip(self.kernels, self.param_ndxs)])
+
+    def jacobian(self, p, *args):
+        data = concatenate([kernel.jacobian(p[ndxs]).ravel()
+                            for kernel, ndxs in zip(self.kernels, self.param_ndxs)])
+        return csr_matrix((data, (self._rows, self._cols)), shape=self._shape)
+
+
+# Joint fit of the same partial PAZ of several components (see fit_paz_joint()). shared_map holds the indices
+# of the poles and zeros of the partial PAZ common to all components.
+JointPAZFitTask = namedtuple('JointPAZFitTask', ['label', 'tasks', 'shared_map'])
+
+
+def fit_paz_joint(task):
+    """Fit the partial PAZ of several components in one least_squares() problem, with the poles and zeros in
+    task.shared_map common to all components.
+
+    The component tasks must have the same PAZ layout. Jacobian mode and stages are those of the first task.
+    Shared parameters start from the mean of the components' starting values, within the intersection of
+    their bounds.
+
+    :param task: Joint fit definition
+    :type task: JointPAZFitTask
+    :return: Fit result of each component. cost, nfev and njev are those of the joint fit.
+    :rtype: [PAZFitResult]
+    """
+
+    params = [paz_fit_params(comp_task.paz) for comp_task in task.tasks]
+    paz_flags = params[0][1]
+    for comp_task, (_, comp_flags, _, _) in zip(task.tasks, params):
+        if comp_flags != paz_flags:
+            msg = '{} PAZ layout {} does not match {}: {}'.format(comp_task.label, comp_flags,
+                                                                  task.tasks[0].label, paz_flags)
+            logging.error(msg)
+            raise ValueError(msg)
+
+    param_ndxs, joint_cnt = joint_param_ndxs(paz_flags, task.shared_map, len(task.tasks))
+    joint_x0 = zeros(joint_cnt, dtype=float64)
+    joint_lb = empty(joint_cnt, dtype=float64)
+    joint_ub = empty(joint_cnt, dtype=float64)
+    joint_lb.fill(-inf)
+    joint_ub.fill(inf)
+    for comp_task, ndxs, (paz_flat, _, paz_lb, paz_ub) in zip(task.tasks, param_ndxs, params):
+        joint_x0[ndxs] += _fit_start(comp_task, paz_flat, paz_flags, paz_lb, paz_ub)
+        joint_lb[ndxs] = maximum(joint_lb[ndxs], paz_lb)
+        joint_ub[ndxs] = minimum(joint_ub[ndxs], paz_ub)
+    joint_x0 /= bincount(concatenate(param_ndxs), minlength=joint_cnt)
+    joint_x0 = clip(joint_x0, joint_lb, joint_ub)
+
+    def stage_kernel(bins_per_decade):
+        return JointPAZResidualKernel([_stage_kernel(comp_task, paz_flags, bins_per_decade)
+                                       for comp_task in task.tasks], param_ndxs, joint_cnt)
+
+    res, stages = _fit_stages(task.label, task.tasks[0].stages, stage_kernel, joint_x0, joint_lb, joint_ub,
+                              task.tasks[0].jac)
+    nfev = sum([stage.nfev for stage in stages])
+    njev = sum([stage.njev for stage in stages])
+    secs = sum([stage.secs for stage in stages])
+
+    return [PAZFitResult(comp_task.label, ida.signals.utils.pack_paz(res.x[ndxs], paz_flags), res.x[ndxs],
+                         res.cost, nfev, njev, res.status, res.message, stages, joint_lb[ndxs], joint_ub[ndxs],
+                         res.active_mask[ndxs], secs)
+            for comp_task, ndxs in zip(task.tasks, param_ndxs)]
+
+
+def run_fit_tasks(func, tasks, max_workers=None, executor=None):
+    """Run func on each of tasks, concurrently in an executor.
+
+    Results are returned in task order regardless of completion order, and an exception raised by any task is
+    re-raised here. The fits are CPU bound and do not release the GIL for long, so tasks run in a process pool:
+    the supplied executor, which callers making several calls should share (see process_qcal_data()), or
+    else a ProcessPoolExecutor created for this call. max_workers == 1 runs the tasks in this process.
+
+    :param func: Picklable (module level) callable taking one task, e.g. fit_paz()
+    :type func: callable
+    :param tasks: Task arguments
+    :type tasks: list
+    :param max_workers: Worker process count when no executor is given. None (default) uses the CPU count,
+        1 runs the tasks in this process.
+    :type max_workers: int
+    :param executor: Executor to submit the tasks to (Optional). It is not shut down.
+    :type executor: concurrent.futures.Executor
+    :return: func result for each task
+    :rtype: list
+    """
+
+    if (max_workers is not None) and (max_workers < 1):
+        msg = 'max_workers must be >= 1: {}'.format(max_workers)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    if executor is not None:
+        return list(executor.map(func, tasks))
+
+    if (max_workers == 1) or (len(tasks) < 2):
+        return [func(task) for task in tasks]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(func, tasks))
+
+
+def multi_start_tasks(task, start_cnt, seed=None):
+    """Copies of task starting from points spread over the fitting bounds.
+
+    The first task is task itself, so its nominal (or warm) start is always tried. The others start from a
+    Latin hypercube sample of the paz_fit_params() bounds, which covers each parameter's range evenly with
+    few samples.
+
+    :param task: Fit definition
+    :type task: PAZFitTask
+    :param start_cnt: Number of starting points, including task's own
+    :type start_cnt: int
+    :param seed: Random seed, for reproducible starting points (Optional)
+    :type seed: int
+    :return: start_cnt fit tasks
+    :rtype: [PAZFitTask]
+    """
+
+    if start_cnt < 1:
+        msg = 'start_cnt must be >= 1: {}'.format(start_cnt)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    paz_flat, paz_flags, paz_lb, paz_ub = paz_fit_params(task.paz)
+
+    # latin hypercube: one sample in each of start_cnt - 1 equal strata of every parameter, strata shuffled
+    # independently per parameter
+    rand = RandomState(seed)
+    sample_cnt = start_cnt - 1
+    tasks = [task]
+    samples = empty((sample_cnt, paz_flat.size), dtype=float64)
+    for ndx in range(paz_flat.size):
+        samples[:, ndx] = (rand.permutation(sample_cnt) + rand.random_sample(sample_cnt)) / max(sample_cnt, 1)
+    for sample in samples:
+        start_x = paz_lb + sample * (paz_ub - paz_lb)
+        start_x[-1] = paz_flat[-1]  # h0 is normalized out of the fit
+        tasks.append(task._replace(start_paz=ida.signals.utils.pack_paz(start_x, paz_flags)))
+
+    return tasks
+
+
+def run_multi_start_fits(tasks, start_cnt=1, seed=None, max_workers=None, executor=None):
+    """Fit each of tasks from start_cnt starting points (see multi_start_tasks()) and keep the lowest cost fit.
+
+    All fits of all tasks are run together by run_fit_tasks(), so extra starts cost wall time only when
+    workers are idle.
+
+    :param tasks: Fit definitions
+    :type tasks: [PAZFitTask]
+    :param start_cnt: Number of starting points per task. 1 fits each task from its own start only.
+    :type start_cnt: int
+    :param seed: Random seed, for reproducible starting points (Optional)
+    :type seed: int
+    :param max_workers: Worker process count. See run_fit_tasks().
+    :type max_workers: int
+    :param executor: Executor to run the fits in (Optional). See run_fit_tasks().
+    :type executor: concurrent.futures.Executor
+    :return: Multi-start result for each task
+    :rtype: [PAZMultiStartResult]
+    """
+
+    all_tasks = []
+    for ndx, task in enumerate(tasks):
+        all_tasks.extend(multi_start_tasks(task, start_cnt, seed=None if seed is None else seed + ndx))
+
+    all_results = run_fit_tasks(fit_paz, all_tasks, max_workers=max_workers, executor=executor)
+
+    ms_results = []
+    for ndx, task in enumerate(tasks):
+        results = all_results[ndx * start_cnt:(ndx + 1) * start_cnt]
+        costs = asarray([result.cost for result in results], dtype=float64)
+        x_std = std(asarray([result.x for result in results], dtype=float64), axis=0)
+        best = results[int(argmin(costs))]
+        if start_cnt > 1:
+            logging.info('{} multi-start: best cost {} of {} starts, costs {} - {}'.format(
+                task.label, best.cost, start_cnt, costs.min(), costs.max()))
+            logging.debug('{} multi-start parameter std: {}'.format(task.label, x_std))
+        ms_results.append(PAZMultiStartResult(best, results, costs, x_std))
+
+    return ms_results
+
+
+def bootstrap_tasks(task, replicate_cnt, block_bins=BOOTSTRAP_BLOCK_BINS, seed=None):
+    """Residual block bootstrap replicates of a completed fit.
+
+    task.start_paz must hold the fitted partial PAZ. The residuals of that fit against task.tf are resampled in
+    contiguous blocks of block_bins frequencies (moving block bootstrap) and added back to the fitted TF to
+    make each replicate's target. The TF estimate variance scales with (1 - coh) / coh, so residuals are
+    standardized by it before resampling and rescaled to the noise level of the bins they are moved to.
+    Replicates start from the fitted PAZ, so refits converge in a few evaluations.
+
+    :param task: Fit definition, with the fitted partial PAZ in start_paz
+    :type task: PAZFitTask
+    :param replicate_cnt: Number of replicates
+    :type replicate_cnt: int
+    :param block_bins: Residual block length in frequency bins
+    :type block_bins: int
+    :param seed: Random seed, for reproducible replicates (Optional)
+    :type seed: int
+    :return: replicate_cnt fit tasks
+    :rtype: [PAZFitTask]
+    """
+
+    if task.start_paz is None:
+        msg = '{} bootstrap needs the fitted PAZ in start_paz.'.format(task.label)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    paz_flat, paz_flags, paz_lb, paz_ub = paz_fit_params(task.paz)
+    paz_x = _fit_start(task, paz_flat, paz_flags, paz_lb, paz_ub)
+
+    # residuals are model - target, at every frequency
+    resid = _stage_kernel(task, paz_flags, None).residuals(paz_x)
+    freq_cnt = task.freqs.size
+    resid = resid[:freq_cnt] + 1j * resid[freq_cnt:]
+    fit_tf = task.tf + resid
+    coh = clip(task.coh, 1.0 - LOG_BIN_MAX_COH, LOG_BIN_MAX_COH)
+    noise_scale = (1.0 - coh) / coh
+    noise_scale **= 0.5
+    resid /= noise_scale
+
+    rand = RandomState(seed)
+    block_bins = max(1, min(block_bins, freq_cnt))
+    block_cnt = int(ceil(freq_cnt / block_bins))
+    block_offsets = arange(block_bins)
+    tasks = []
+    for ndx in range(replicate_cnt):
+        block_starts = rand.randint(0, freq_cnt - block_bins + 1, size=block_cnt)
+        resid_ndxs = (block_starts[:, newaxis] + block_offsets).ravel()[:freq_cnt]
+        tasks.append(task._replace(label='{} bootstrap {}'.format(task.label, ndx + 1),
+                                   tf=fit_tf - resid[resid_ndxs] * noise_scale))
+
+    return tasks
+
+
+def percentile_intervals(samples, level=0.95, estimate=None):
+    """Two sided percentile confidence intervals of bootstrap samples.
+
+    With the original estimate given, the percentiles are bias corrected (BC percentile interval): they are
+    shifted by the normal quantile of the fraction of samples below the estimate. Replicates offset from the
+    estimate then give an interval around the bias corrected estimate rather than around the replicates, which
+    misses the estimate only when the bias exceeds the interval half width (see bootstrap_bias()).
+    Plain percentiles otherwise.
+
+    :param samples: Samples, one row per replicate. Complex values get intervals for real and imaginary parts.
+    :type samples: ndarray
+    :param level: Confidence level
+    :type level: float
+    :param estimate: Estimate from the original data, one value per column of samples (Optional)
+    :type estimate: ndarray
+    :return: Lower and upper interval bounds, one per column of samples
+    :rtype: (ndarray, ndarray)
+    """
+
+    samples = asarray(samples)
+    if samples.dtype.kind == 'c':
+        est_re = est_im = None
+        if estimate is not None:
+            estimate = asarray(estimate)
+            est_re, est_im = estimate.real, estimate.imag
+        lo_re, hi_re = percentile_intervals(samples.real, level, est_re)
+        lo_im, hi_im = percentile_intervals(samples.imag, level, est_im)
+        return lo_re + 1j * lo_im, hi_re + 1j * hi_im
+
+    tail = 0.5 * (1.0 - level)
+    if estimate is None:
+        lo, hi = percentile(samples, [100.0 * tail, 100.0 * (1.0 - tail)], axis=0)
+        return lo, hi
+
+    # bias correction z0 from the fraction of samples below the estimate, kept finite when all samples
+    # fall on one side of it
+    sample_cnt = samples.shape[0]
+    below = (samples < estimate).mean(axis=0)
+    z0 = norm.ppf(clip(below, 0.5 / sample_cnt, 1.0 - 0.5 / sample_cnt))
+    z_tail = norm.ppf(tail)
+    lo_q = 100.0 * norm.cdf(2 * z0 + z_tail)
+    hi_q = 100.0 * norm.cdf(2 * z0 - z_tail)
+
+    # corrected percentiles differ per column
+    cols = samples.reshape(sample_cnt, -1)
+    lo = asarray([percentile(col, q) for col, q in zip(cols.T, ravel(lo_q))], dtype=float64)
+    hi = asarray([percentile(col, q) for col, q in zip(cols.T, ravel(hi_q))], dtype=float64)
+    return lo.reshape(samples.shape[1:]), hi.reshape(samples.shape[1:])
+
+
+def bootstrap_bias(samples, estimate):
+    """Bootstrap estimate of the bias of an estimate: mean of the samples less the original estimate.
+
+    :param samples: Samples, one row per replicate
+    :type samples: ndarray
+    :param estimate: Estimate from the original data, one value per column of samples
+    :type estimate: ndarray
+    :return: Bias, one per column of samples
+    :rtype: ndarray
+    """
+
+    return asarray(samples).mean(axis=0) - estimate
+
+
+def fit_diagnostics(result, ms_result=None):
+    """JSON serializable diagnostics record of a fit.
+
+    Top level initial_cost is that of the first stage and cost that of the last. Stages fit different grids,
+    so each stage also reports its own initial and final cost and the cost at every accepted iterate.
+
+    :param result: Fit result
+    :type result: PAZFitResult
+    :param ms_result: Multi-start result whose best fit is result, adds the spread of the starts (Optional)
+    :type ms_result: PAZMultiStartResult
+    :return: Diagnostics record
+    :rtype: dict
+    """
+
+    bound_names = {-1: 'lower', 1: 'upper'}
+    record = {
+        'label': result.label,
+        'status': int(result.status),
+        'message': result.message,
+        'secs': float(result.secs),
+        'nfev': int(result.nfev),
+        'njev': int(result.njev),
+        'initial_cost': float(result.stages[0].initial_cost),
+        'cost': float(result.cost),
+        'x': [float(val) for val in result.x],
+        'active_bounds': [{'param': ndx, 'bound': bound_names[int(mask)], 'value': float(result.x[ndx])}
+                          for ndx, mask in enumerate(result.active_mask) if mask != 0],
+        'stages': [{
+            'bins_per_decade': stage.bins_per_decade,
+            'freq_cnt': int(stage.freq_cnt),
+            'secs': float(stage.secs),
+            'nfev': int(stage.nfev),
+            'njev': int(stage.njev),
+            'initial_cost': float(stage.initial_cost),
+            'cost': float(stage.cost),
+            'status': int(stage.status),
+            'message': stage.message,
+            'costs': [float(cost) for cost in stage.costs],
+        } for stage in result.stages],
+    }
+    if ms_result is not None:
+        record['multi_start'] = {
+            'costs': [float(cost) for cost in ms_result.costs],
+            'x_std': [float(val) for val in ms_result.x_std],
+        }
+
+    return record
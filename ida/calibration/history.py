@@ -0,0 +1,183 @@
+#######################################################################################################################
+# Copyright (C) 2016  Regents of the University of California
+#
+# This is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License (GNU GPL) as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# A copy of the GNU General Public License can be found in LICENSE.TXT in the root of the source code repository.
+# Additionally, it can be found at http://www.gnu.org/licenses/.
+#
+# NOTES: Per GNU GPLv3 terms:
+#   * This notice must be kept in this source file
+#   * Changes to the source must be clearly noted with date & time of change
+#
+# If you use this software in a product, an explicit acknowledgment in the product documentation of the contribution
+# by Project IDA, Institute of Geophysics and Planetary Physics, UCSD would be appreciated but is not required.
+#######################################################################################################################
+
+import logging
+import json
+import os.path
+import sqlite3
+import time
+from numpy import asarray
+import ida.signals.paz
+
+"""Local store of fitted calibration responses, used to warm start later fits of the same sensor"""
+
+CAL_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cal_fits (
+    id INTEGER PRIMARY KEY,
+    sta TEXT NOT NULL,
+    loc TEXT NOT NULL,
+    chan TEXT NOT NULL,
+    serial TEXT NOT NULL,
+    seis_model TEXT NOT NULL,
+    cal_time REAL NOT NULL,
+    accepted INTEGER NOT NULL,
+    mode TEXT NOT NULL,
+    units TEXT NOT NULL,
+    h0 REAL NOT NULL,
+    poles TEXT NOT NULL,
+    zeros TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cal_fits_sensor_ndx ON cal_fits (sta, loc, chan, serial, cal_time);
+"""
+
+
+def _roots_to_json(roots):
+    return json.dumps([[root.real, root.imag] for root in roots])
+
+
+def _roots_from_json(txt):
+    return [complex(re, im) for re, im in json.loads(txt)]
+
+
+class CalHistory(object):
+    """
+    SQLite store of fitted full responses, indexed by station, location, channel and sensor serial number.
+
+    Each analysis adds one row per component. Rows are flagged accepted (e.g. the result was in spec) so that
+    latest() only offers responses that are sensible fitting starting points.
+    """
+
+    def __init__(self, db_path):
+        """
+        :param db_path: SQLite database filename. Created if it does not exist.
+        :type db_path: str
+        """
+
+        self.db_path = os.path.abspath(os.path.expanduser(db_path))
+        self._conn = sqlite3.connect(self.db_path)
+        self._conn.executescript(CAL_HISTORY_SCHEMA)
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def add(self, sta, loc, chan, serial, seis_model, paz, cal_time=None, accepted=True):
+        """Record a fitted response.
+
+        :param sta: Station code
+        :type sta: str
+        :param loc: Location code
+        :type loc: str
+        :param chan: Channel code
+        :type chan: str
+        :param serial: Sensor serial number
+        :type serial: str
+        :param seis_model: Seismometer model key
+        :type seis_model: str
+        :param paz: Fitted full response
+        :type paz: PAZ
+        :param cal_time: Calibration time, epoch seconds. Defaults to now.
+        :type cal_time: float
+        :param accepted: Whether the result may be used to warm start later fits
+        :type accepted: bool
+        :return: Row id
+        :rtype: int
+        """
+
+        if cal_time is None:
+            cal_time = time.time()
+
+        cur = self._conn.execute(
+            'INSERT INTO cal_fits (sta, loc, chan, serial, seis_model, cal_time, accepted, mode, units, h0, '
+            'poles, zeros) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (sta, loc, chan, serial, seis_model, float(cal_time), int(bool(accepted)), paz.mode, paz.units,
+             float(asarray(paz.h0).flat[0]),  # merged PAZ carry h0 as a 1 element array
+             _roots_to_json(paz.poles()), _roots_to_json(paz.zeros())))
+        self._conn.commit()
+        logging.debug('Calibration history: added {}.{}.{} ({}) fit id {}'.format(sta, loc, chan, serial,
+                                                                                cur.lastrowid))
+
+        return cur.lastrowid
+
+    def set_accepted(self, fit_id, accepted):
+        """Change the accepted flag of a recorded fit.
+
+        :param fit_id: Row id returned by add()
+        :type fit_id: int
+        :param accepted: New flag value
+        :type accepted: bool
+        """
+
+        self._conn.execute('UPDATE cal_fits SET accepted = ? WHERE id = ?', (int(bool(accepted)), fit_id))
+        self._conn.commit()
+
+    def latest(self, sta, loc, chan, serial, seis_model=None, before=None):
+        """Most recent accepted response of a sensor.
+
+        :param sta: Station code
+        :type sta: str
+        :param loc: Location code
+        :type loc: str
+        :param chan: Channel code
+        :type chan: str
+        :param serial: Sensor serial number
+        :type serial: str
+        :param seis_model: Only consider fits of this seismometer model (Optional)
+        :type seis_model: str
+        :param before: Only consider fits with cal_time before this, epoch seconds (Optional)
+        :type before: float
+        :return: Fitted full response, or None if the sensor has no accepted fit
+        :rtype: PAZ
+        """
+
+        query = 'SELECT mode, units, h0, poles, zeros FROM cal_fits ' \
+                'WHERE sta = ? AND loc = ? AND chan = ? AND serial = ? AND accepted = 1'
+        params = [sta, loc, chan, serial]
+        if seis_model is not None:
+            query += ' AND seis_model = ?'
+            params.append(seis_model)
+        if before is not None:
+            query += ' AND cal_time < ?'
+            params.append(float(before))
+        query += ' ORDER BY cal_time DESC, id DESC LIMIT 1'
+
+        row = self._conn.execute(query, params).fetchone()
+        if row is None:
+            return None
+
+        mode, units, h0, poles, zeros = row
+        paz = ida.signals.paz.PAZ(mode, units)
+        for pole in _roots_from_json(poles):
+            paz.add_pole(pole)
+        for zero in _roots_from_json(zeros):
+            paz.add_zero(zero)
+        paz.h0 = h0
+
+        return paz
@@ -24,18 +24,21 @@ import logging
 import os.path
 from numpy import ndarray, complex128, pi, ceil, sin, cos, angle, abs, linspace, multiply, \
     logical_and, less_equal, polyfit, polyval, \
-    divide, subtract, median, concatenate
-from numpy.fft import rfft, irfft
+    divide, subtract, median, concatenate, array_equal, float64, isclose, empty
+from ida.signals.fft import rfft, irfft, empty_buffer
 from scipy.signal import tukey
-from scipy.optimize import least_squares
 import ida.calibration.qcal_utils
-from ida.calibration.cross import cross_correlate
+import ida.calibration.cross
+from ida.calibration.fitting import PAZFitTask, JointPAZFitTask, run_multi_start_fits, run_fit_tasks, \
+    fit_paz, fit_paz_joint, bootstrap_tasks, fit_diagnostics, FIT_JAC_ANALYTIC, FIT_JAC_MODES, \
+    BOOTSTRAP_BLOCK_BINS, FIT_BINS_PER_DECADE
 import ida.signals.paz
 import ida.signals.utils
 from ida.instruments import *
 
 """utility functions for processing of IDA Random Binary calibration data"""
 
+
 def nominal_sys_sens_1hz(sens_resp_at_1hz, seis_model):
     """Compute system sensitivity in velocity units at 1hz given sensor response (in vel), sensor model and
     assuming a Q330 digitizer. This calculation DOES NOT include absolute gcalib adjustment for sensor,
@@ -94,11 +97,9 @@ def compare_component_response(freqs, paz1, paz2, norm_freq=0.05, mode='vel', ph
         logging.error(msg)
         raise Exception(msg)
 
-    resp1 = ida.signals.utils.compute_response(freqs, paz1, mode=mode)
-    resp1_norm, _, _ = ida.signals.utils.normalize_response(resp1, freqs, norm_freq)
-
-    resp2 = ida.signals.utils.compute_response(freqs, paz2, mode=mode)
-    resp2_norm, _, _ = ida.signals.utils.normalize_response(resp2, freqs, norm_freq)
+    # nominal responses repeat across components and stations: served from the shared response cache
+    resp1_norm = ida.signals.utils.cached_response(freqs, paz1, mode=mode, norm_freq=norm_freq)
+    resp2_norm = ida.signals.utils.cached_response(freqs, paz2, mode=mode, norm_freq=norm_freq)
 
     if phase_detrend:
         freq_range = less_equal(freqs, 0.9 * freqs[-1])  # 90% of nyquist
@@ -114,7 +115,10 @@ def compare_component_response(freqs, paz1, paz2, norm_freq=0.05, mode='vel', ph
         amp = abs(resp2_norm)
         pha = angle(resp2_norm) - trend_vals
         resp2_norm = amp * complex128(cos(pha) + 1j*sin(pha))
-
+    else:
+        # the cached responses are shared and read only, callers get their own
+        resp1_norm = resp1_norm.copy()
+        resp2_norm = resp2_norm.copy()
 
     # calculate percentage deviations
     resp2_a_dev = (divide(abs(resp2_norm[1:]), abs(resp1_norm[1:])) - 1.0) * 100.0
@@ -126,46 +130,348 @@ def compare_component_response(freqs, paz1, paz2, norm_freq=0.05, mode='vel', ph
     return resp1_norm, resp2_norm, resp2_a_dev, resp2_p_dev, resp2_a_dev_max, resp2_p_dev_max
 
 
-def analyze_cal_component(full_paz, lf_paz_pert_map, hf_paz_pert_map,
-                          lf_sr, hf_sr, operating_sr, lfinput, hfinput, lfmeas, hfmeas):
-    """Analyze both high and low frequency calibration component timeseries output with calibration input
-    using starting paz fitting_paz.
+def cal_fit_bands(operating_sr):
+    """Frequency bands used when fitting LF and HF calibration transfer functions.
 
-    Find improved PAZ fit to reduce transfer function based on fitting_paz between input/output time series using a least_squares minimization
-    approach.
+    :param operating_sr: Operational Sampling rate of channels
+    :type operating_sr: float
+    :return: (lf low, lf high), (hf low, hf high) band limits in hz
+    :rtype: ((float, float), (float, float))
+    """
 
-    :param full_paz: Full model response for fitting (note: may be different then resp used to convolve w/input)
+    lf_band = (1e-04, 0.3)
+    hf_band = (0.3, operating_sr * 0.45)  # e.g. 18hz for 40hz channels
+
+    return lf_band, hf_band
+
+
+def cross_correlate_components(sampling_rate, inputs, outputs, band=None,
+                               taper_mode=ida.calibration.cross.TAPER_MODE_FIXED, workspace=None, lag=False):
+    """Cross correlate each component output timeseries with its calibration input timeseries.
+    Components with identical input timeseries (the usual case when all components are convolved with the same
+    response) share a single cross_correlate_multi() call, so each distinct input is only transformed once.
+    The phase slope lag of each component is logged.
+
+    :param sampling_rate: Sampling rate of timeseries
+    :type sampling_rate: float
+    :param inputs: Calibration input timeseries for each component
+    :type inputs: ComponentsTpl
+    :param outputs: Measured output timeseries for each component
+    :type outputs: ComponentsTpl
+    :param band: (low, high) frequencies (inclusive) to compute. (Optional)
+    :type band: (float, float)
+    :param taper_mode: Taper count mode. See cross_correlate()
+    :type taper_mode: str
+    :param workspace: Transform buffers and FFT backend shared by the spectral computations (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :param lag: If True, append the lag in seconds to each component tuple
+    :type lag: bool
+    :return: (freqs, gain, phase, coh) or (freqs, gain, phase, coh, lag) tuple for each component.
+        See cross_correlate()
+    :rtype: ComponentsTpl
+    """
+
+    # group components by input timeseries
+    groups = []
+    for comp in ComponentsTpl._fields:
+        comp_input = getattr(inputs, comp)
+        for grp_input, grp_comps in groups:
+            if (grp_input is comp_input) or array_equal(grp_input, comp_input):
+                grp_comps.append(comp)
+                break
+        else:
+            groups.append((comp_input, [comp]))
+
+    results = {}
+    for grp_input, grp_comps in groups:
+        logging.debug('Compute coherence for components: ' + ', '.join(grp_comps))
+        freqs, gain, phase, coh, lags = ida.calibration.cross.cross_correlate_multi(sampling_rate, grp_input,
+                                                                                    [getattr(outputs, comp)
+                                                                                     for comp in grp_comps],
+                                                                                    band=band,
+                                                                                    taper_mode=taper_mode,
+                                                                                    workspace=workspace,
+                                                                                    lag=True)
+        for ndx, comp in enumerate(grp_comps):
+            ida.calibration.cross.log_lag(lags[ndx], sampling_rate, comp)
+            if lag:
+                results[comp] = (freqs, gain[ndx], phase[ndx], coh[ndx], lags[ndx])
+            else:
+                results[comp] = (freqs, gain[ndx], phase[ndx], coh[ndx])
+
+    return ComponentsTpl(**results)
+
+
+class CalRunStack(object):
+    """
+    Cross spectral estimates of repeated calibration runs of one sensor, stacked per component.
+
+    Each run's prepared input and output timeseries are cut into overlapping segments of segment_len samples
+    and the normalized cross spectral matrices of the segments are summed, so only the running sums are kept
+    between runs. Results have the same form as cross_correlate_components() and can be passed to
+    analyze_cal_component() as lf_cross or hf_cross.
+    """
+
+    def __init__(self, sampling_rate, segment_len, band=None, overlap=ida.calibration.cross.STREAM_OVERLAP,
+                 taper_mode=ida.calibration.cross.TAPER_MODE_FIXED, workspace=None):
+        """
+        :param sampling_rate: Sampling rate of all runs
+        :type sampling_rate: float
+        :param segment_len: Samples per segment. Sets the frequency resolution of the stacked result.
+        :type segment_len: int
+        :param band: (low, high) frequencies (inclusive) to compute. (Optional)
+        :type band: (float, float)
+        :param overlap: Fraction of segment_len shared by consecutive segments of a run
+        :type overlap: float
+        :param taper_mode: Taper count mode. See cross_correlate()
+        :type taper_mode: str
+        :param workspace: Transform buffers and FFT backend shared by the spectral computations (Optional)
+        :type workspace: ida.signals.fft.FFTWorkspace
+        """
+
+        self.sampling_rate = sampling_rate
+        self.segment_len = int(segment_len)
+        self.overlap = overlap
+        self.run_cnt = 0
+
+        accums = {}
+        for comp in ComponentsTpl._fields:
+            accums[comp] = ida.calibration.cross.CrossSpectralAccumulator(sampling_rate, band=band,
+                                                                          taper_mode=taper_mode,
+                                                                          workspace=workspace)
+        self._accums = ComponentsTpl(**accums)
+
+    def add_run(self, sampling_rate, inputs, outputs):
+        """
+        Add the cross spectra of one run.
+
+        :param sampling_rate: Sampling rate of the run
+        :type sampling_rate: float
+        :param inputs: Calibration input timeseries for each component
+        :type inputs: ComponentsTpl
+        :param outputs: Measured output timeseries for each component
+        :type outputs: ComponentsTpl
+        :raises ValueError: If any component of the run is shorter than segment_len. Nothing is stacked then.
+        """
+
+        if not isclose(sampling_rate, self.sampling_rate):
+            msg = 'Run sampling rate {} differs from stack sampling rate {}.'.format(sampling_rate, self.sampling_rate)
+            logging.error(msg)
+            raise ValueError(msg)
+
+        # a run is stacked into every component or none, so run_cnt counts runs in every component's estimate
+        for comp in ComponentsTpl._fields:
+            run_len = min(getattr(inputs, comp).size, getattr(outputs, comp).size)
+            if run_len < self.segment_len:
+                msg = 'Run {} component has {} samples, too short for a {} sample segment. ' \
+                      'Use a segment length no longer than the shortest run.'.format(comp, run_len, self.segment_len)
+                logging.error(msg)
+                raise ValueError(msg)
+
+        for comp in ComponentsTpl._fields:
+            getattr(self._accums, comp).add_record(getattr(inputs, comp), [getattr(outputs, comp)],
+                                                   self.segment_len, overlap=self.overlap)
+
+        self.run_cnt += 1
+        logging.debug('Stacked run {} ({} segments per component).'.format(self.run_cnt,
+                                                                           self._accums.vertical.segment_cnt))
+
+    def result(self):
+        """
+        Coherence and transfer function of each component from all runs added.
+
+        :return: (freqs, gain, phase, coh) tuple for each component. See cross_correlate()
+        :rtype: ComponentsTpl
+        """
+
+        results = {}
+        for comp in ComponentsTpl._fields:
+            freqs, gain, phase, coh, lags = getattr(self._accums, comp).result(lag=True)
+            ida.calibration.cross.log_lag(lags[0], self.sampling_rate, comp)
+            results[comp] = (freqs, gain[0], phase[0], coh[0])
+
+        return ComponentsTpl(**results)
+
+
+def stack_cal_runs(data_dir, runs, seis_model, lf_paz_tpl, hf_paz_tpl, operating_sr,
+                   lf_segment_len=None, hf_segment_len=None,
+                   taper_mode=ida.calibration.cross.TAPER_MODE_FIXED, workspace=None):
+    """Stack the cross spectra of repeated qcal runs of one sensor into one coherence/transfer function
+    estimate per component and band.
+
+    Runs are read and prepared one at a time (see prepare_cal_data()); only the stacked cross spectral
+    sums are kept between runs.
+
+    :param data_dir: Directory path where miniseed and qcal log files are found
+    :type data_dir: str
+    :param runs: (lf_fnames, hf_fnames) for each run. See prepare_cal_data()
+    :type runs: [((str, str), (str, str))]
+    :param seis_model: Seismometer model key
+    :type seis_model: str
+    :param lf_paz_tpl: ComponentTpl with starting LF model with which to convolve the calibration input signal.
+    :type lf_paz_tpl: ComponentTpl
+    :param hf_paz_tpl: ComponentTpl with starting HF model with which to convolve the calibration input signal.
+    :type hf_paz_tpl: ComponentTpl
+    :param operating_sr: Operational Sampling rate of channels. Sets the fitting bands.
+    :type operating_sr: float
+    :param lf_segment_len: LF samples per segment. Defaults to the prepared length of the first run. A run
+        shorter than this raises ValueError.
+    :type lf_segment_len: int
+    :param hf_segment_len: HF samples per segment. Defaults to the prepared length of the first run. A run
+        shorter than this raises ValueError.
+    :type hf_segment_len: int
+    :param taper_mode: Taper count mode. See cross_correlate()
+    :type taper_mode: str
+    :param workspace: Transform buffers and FFT backend shared by the spectral computations (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :return: LF sampling rate, LF results, HF sampling rate, HF results.
+        Results are ComponentsTpl of (freqs, gain, phase, coh) as from cross_correlate_components()
+    :rtype: (float, ComponentsTpl, float, ComponentsTpl)
+    """
+
+    if len(runs) == 0:
+        msg = 'At least one calibration run is required.'
+        logging.error(msg)
+        raise ValueError(msg)
+
+    lf_band, hf_band = cal_fit_bands(operating_sr)
+    lf_stack = None
+    hf_stack = None
+
+    for lf_fnames, hf_fnames in runs:
+        logging.debug('Stacking cal run: {}, {}...'.format(lf_fnames[0], hf_fnames[0]))
+
+        samp_rate_lf, _, lfinput, lfmeas, \
+        samp_rate_hf, _, hfinput, hfmeas, \
+        _, _, _, _ = prepare_cal_data(data_dir, lf_fnames, hf_fnames, seis_model, lf_paz_tpl, hf_paz_tpl,
+                                      workspace=workspace)
+
+        if lf_stack is None:
+            lf_stack = CalRunStack(samp_rate_lf, lf_segment_len or lfinput.vertical.size, band=lf_band,
+                                   taper_mode=taper_mode, workspace=workspace)
+            hf_stack = CalRunStack(samp_rate_hf, hf_segment_len or hfinput.vertical.size, band=hf_band,
+                                   taper_mode=taper_mode, workspace=workspace)
+
+        lf_stack.add_run(samp_rate_lf, lfinput, lfmeas)
+        hf_stack.add_run(samp_rate_hf, hfinput, hfmeas)
+        del lfinput, lfmeas, hfinput, hfmeas
+
+        logging.debug('Stacking cal run: {}, {}... complete.'.format(lf_fnames[0], hf_fnames[0]))
+
+    return lf_stack.sampling_rate, lf_stack.result(), hf_stack.sampling_rate, hf_stack.result()
+
+
+def resp_cost(p, paz_partial_flags, freqs, normfreq, tf_target, resp_pert0):
+    """least_squares() residuals of the transfer function of perturbed PAZ parameters p relative to the
+    starting response resp_pert0, against the measured tf_target.
+
+    Reference implementation of PAZResidualKernel.residuals(), which fit_paz() uses.
+
+    :param p: pack_paz() data vector
+    :type p: ndarray
+    :param paz_partial_flags: pack_paz() flags
+    :type paz_partial_flags: ([str], [str])
+    :param freqs: Fitting frequencies in hz
+    :type freqs: ndarray
+    :param normfreq: Normalization frequency in hz
+    :type normfreq: float
+    :param tf_target: Measured normalized transfer function as concatenate((tf.real, tf.imag))
+    :type tf_target: ndarray
+    :param resp_pert0: Response of the starting PAZ at freqs
+    :type resp_pert0: ndarray
+    :return: Residuals, real parts followed by imaginary parts
+    :rtype: ndarray
+    """
+
+    # pack up into PAZ instances
+    paz_pert = ida.signals.utils.pack_paz(p, paz_partial_flags)
+
+    # compute perturbed response andnormalize
+    resp = ida.signals.utils.compute_response(freqs, paz_pert)
+    resp_norm, scale, ndx = ida.signals.utils.normalize_response(resp, freqs, normfreq)
+
+    # calc new TF
+    new_tf = divide(resp_norm, resp_pert0)
+    # simple dif for residuals array. Assuems tf_target is np.concatenate((tf_target.real, tf_target.imag))
+    new_real_imag_tf = concatenate((new_tf.real, new_tf.imag))
+    resid = subtract(new_real_imag_tf, tf_target)
+
+    return resid
+
+
+def resp_cost_jac(p, paz_partial_flags, freqs, normfreq, tf_target, resp_pert0):
+    """Closed form jacobian of resp_cost(), taking the same arguments.
+    Reference implementation of PAZResidualKernel.jacobian().
+
+    With new_tf = H / (|H(normfreq)| * resp_pert0), d new_tf/dp = new_tf * (d ln H/dp - Re(d ln H(normfreq)/dp)),
+    see ida.signals.utils.compute_response_derivatives(). The h0 column is zero since h0 cancels on normalization.
+
+    :return: (2 * freqs.size x p.size) jacobian, real part rows followed by imaginary part rows
+    :rtype: ndarray
+    """
+
+    paz_pert = ida.signals.utils.pack_paz(p, paz_partial_flags)
+
+    resp = ida.signals.utils.compute_response(freqs, paz_pert)
+    resp_norm, scale, ndx = ida.signals.utils.normalize_response(resp, freqs, normfreq)
+    new_tf = divide(resp_norm, resp_pert0)
+
+    dlnh = ida.signals.utils.compute_response_derivatives(freqs, paz_pert,
+                                                          ida.signals.utils.pack_paz_index_map(paz_partial_flags),
+                                                          p.size)
+    # d ln|H(normfreq)|/dp = Re(d ln H(normfreq)/dp)
+    dlnh -= dlnh[ndx].real
+    dlnh *= new_tf[:, None]
+
+    return concatenate((dlnh.real, dlnh.imag))
+
+
+def cal_fit_tasks(label, full_paz, lf_paz_pert_map, hf_paz_pert_map, operating_sr, lf_cross, hf_cross,
+                  jac=FIT_JAC_ANALYTIC, fit_bins_per_decade=None, start_paz=None, fit_stages=None):
+    """Build the HF and LF fit definitions for one component from its coherence results.
+
+    :param label: Component label used in log messages
+    :type label: str
+    :param full_paz: Full model response for fitting
     :type full_paz: PAZ
     :param lf_paz_pert_map: paz map of which LF poles/zeros to perturb for fitting
     :type ([], [])
     :param hf_paz_pert_map: paz map of which HF poles/zeros to perturb for fitting
     :type ([], [])
-    :param lf_sr: Low frequency sampling rate
-    :type lf_sr: float
-    :param hf_sr: High frequency sampling rate
-    :type hf_sr: float
     :param operating_sr: Operational Sampling rate of channels
     :type operating_sr: float
-    :param lfinput: Low frequency calibration input signal timeseries
-    :type lfinput: ndarray
-    :param hfinput: High frequency calibration input signal timeseries
-    :type hfinput: ndarray
-    :param lfmeas: Low frequency measured component output timeseries
-    :type lfmeas: ndarray
-    :param hfmeas: High frequency measured component output timeseries
-    :type hfmeas: ndarray
-    :return: New PAZ with improved response fit
-    :rtype: PAZ
+    :param lf_cross: LF (freqs, gain, phase, coh[, lag]) covering the LF fitting band
+    :type lf_cross: (ndarray, ndarray, ndarray, ndarray)
+    :param hf_cross: HF (freqs, gain, phase, coh[, lag]) covering the HF fitting band
+    :type hf_cross: (ndarray, ndarray, ndarray, ndarray)
+    :param jac: FIT_JAC_ANALYTIC or a least_squares() finite difference scheme
+    :type jac: str
+    :param fit_bins_per_decade: Log frequency grid density of the fitting targets. None (default) or 0 fits every bin.
+    :type fit_bins_per_decade: float
+    :param start_paz: Full response to start the fits from, e.g. CalHistory.latest(). Bounds are still
+        derived from full_paz. (Optional)
+    :type start_paz: PAZ
+    :param fit_stages: Bins per decade of each coarse to fine fitting stage, e.g. FIT_STAGES_COARSE_TO_FINE.
+        Overrides fit_bins_per_decade. (Optional)
+    :type fit_stages: [float]
+    :return: HF and LF fit tasks
+    :rtype: (ida.calibration.fitting.PAZFitTask, ida.calibration.fitting.PAZFitTask)
     """
 
-    # generate coherence info for each component
-    logging.debug('Compute coherence for LF time series...')
-    lfmeas_f, lfmeas_amp, lfmeas_pha, lfmeas_coh     = ida.calibration.cross.cross_correlate(lf_sr, lfinput, lfmeas)
-    logging.debug('Compute coherence for LF time series... complete.')
+    if jac not in FIT_JAC_MODES:
+        msg = "Invalid jacobian mode: '{}'. Valid values: {}".format(jac, FIT_JAC_MODES)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    prefix = label + ' ' if label else ''
 
-    logging.debug('Compute coherence for HF time series...')
-    hfmeas_f, hfmeas_amp, hfmeas_pha, hfmeas_coh     = ida.calibration.cross.cross_correlate(hf_sr, hfinput, hfmeas)
-    logging.debug('Compute coherence for HF time series... complete.')
+    # trim freqs and norm freqs
+    (lflo, lfhi), (hflo, hfhi) = cal_fit_bands(operating_sr)
+    lf_norm_freq = 0.05
+    hf_norm_freq = 1.0
+
+    lfmeas_f, lfmeas_amp, lfmeas_pha, lfmeas_coh = lf_cross[:4]
+    hfmeas_f, hfmeas_amp, hfmeas_pha, hfmeas_coh = hf_cross[:4]
 
     lfmeas_pha_rad = lfmeas_pha * pi / 180
     hfmeas_pha_rad = hfmeas_pha * pi / 180
@@ -174,14 +480,6 @@ def analyze_cal_component(full_paz, lf_paz_pert_map, hf_paz_pert_map,
     hfmeas_tf = multiply(hfmeas_amp, (cos(hfmeas_pha_rad) + 1j * sin(hfmeas_pha_rad)))
     lfmeas_tf = multiply(lfmeas_amp, (cos(lfmeas_pha_rad) + 1j * sin(lfmeas_pha_rad)))
 
-    # trim freqs and norm freqs
-    lflo = 1e-04
-    lfhi = 0.3
-    hflo = 0.3
-    hfhi = operating_sr * 0.45  # e.g. 18hz for 40hz channels
-    lf_norm_freq = 0.05
-    hf_norm_freq = 1.0
-
     lf_range = logical_and(lfmeas_f <= lfhi, lfmeas_f > lflo)
     hf_range = logical_and(hfmeas_f <= hfhi, hfmeas_f > hflo)
     lfmeas_f_t = lfmeas_f[lf_range]
@@ -191,122 +489,97 @@ def analyze_cal_component(full_paz, lf_paz_pert_map, hf_paz_pert_map,
     lfmeas_coh = lfmeas_coh[lf_range]
     hfmeas_coh = hfmeas_coh[hf_range]
 
-    logging.debug('LF TF Amp Max:' + str(abs(lfmeas_tf).max()))
-    logging.debug('LF TF Amp Min:' + str(abs(lfmeas_tf).min()))
-    logging.debug('LF TF Pha Max:' + str(angle(lfmeas_tf).max()))
-    logging.debug('LF TF Pha Min:' + str(angle(lfmeas_tf).min()))
-    logging.debug('HF TF Amp Max:' + str(abs(hfmeas_tf).max()))
-    logging.debug('HF TF Amp Min:' + str(abs(hfmeas_tf).min()))
-    logging.debug('HF TF Pha Max:' + str(angle(hfmeas_tf).max()))
-    logging.debug('HF TF Pha Min:' + str(angle(hfmeas_tf).min()))
-
-    hfmeas_tf_norm, _, _ = ida.signals.utils.normalize_response(hfmeas_tf, hfmeas_f_t, hf_norm_freq)
-    lfmeas_tf_norm, _, _ = ida.signals.utils.normalize_response(lfmeas_tf, lfmeas_f_t, lf_norm_freq)
-
-    logging.debug('LF TF Amp Max (normed):' + str(abs(lfmeas_tf_norm).max()))
-    logging.debug('LF TF Amp Min (normed):' + str(abs(lfmeas_tf_norm).min()))
-    logging.debug('LF TF Pha Max (normed):' + str(angle(lfmeas_tf_norm).max()))
-    logging.debug('LF TF Pha Min (normed):' + str(angle(lfmeas_tf_norm).min()))
-    logging.debug('HF TF Amp Max (normed):' + str(abs(hfmeas_tf_norm).max()))
-    logging.debug('HF TF Amp Min (normed):' + str(abs(hfmeas_tf_norm).min()))
-    logging.debug('HF TF Pha Max (normed):' + str(angle(hfmeas_tf_norm).max()))
-    logging.debug('HF TF Pha Min (normed):' + str(angle(hfmeas_tf_norm).min()))
-
-    logging.debug('LF Coh2 Median:' + str(median(lfmeas_coh)))
-    logging.debug('HF Coh2 Median:' + str(median(hfmeas_coh)))
+    logging.debug(prefix + 'LF TF Amp Max:' + str(abs(lfmeas_tf).max()))
+    logging.debug(prefix + 'LF TF Amp Min:' + str(abs(lfmeas_tf).min()))
+    logging.debug(prefix + 'LF TF Pha Max:' + str(angle(lfmeas_tf).max()))
+    logging.debug(prefix + 'LF TF Pha Min:' + str(angle(lfmeas_tf).min()))
+    logging.debug(prefix + 'HF TF Amp Max:' + str(abs(hfmeas_tf).max()))
+    logging.debug(prefix + 'HF TF Amp Min:' + str(abs(hfmeas_tf).min()))
+    logging.debug(prefix + 'HF TF Pha Max:' + str(angle(hfmeas_tf).max()))
+    logging.debug(prefix + 'HF TF Pha Min:' + str(angle(hfmeas_tf).min()))
+
+    hfmeas_tf_norm, _, hf_norm_ndx = ida.signals.utils.normalize_response(hfmeas_tf, hfmeas_f_t, hf_norm_freq)
+    lfmeas_tf_norm, _, lf_norm_ndx = ida.signals.utils.normalize_response(lfmeas_tf, lfmeas_f_t, lf_norm_freq)
+
+    logging.debug(prefix + 'LF TF Amp Max (normed):' + str(abs(lfmeas_tf_norm).max()))
+    logging.debug(prefix + 'LF TF Amp Min (normed):' + str(abs(lfmeas_tf_norm).min()))
+    logging.debug(prefix + 'LF TF Pha Max (normed):' + str(angle(lfmeas_tf_norm).max()))
+    logging.debug(prefix + 'LF TF Pha Min (normed):' + str(angle(lfmeas_tf_norm).min()))
+    logging.debug(prefix + 'HF TF Amp Max (normed):' + str(abs(hfmeas_tf_norm).max()))
+    logging.debug(prefix + 'HF TF Amp Min (normed):' + str(abs(hfmeas_tf_norm).min()))
+    logging.debug(prefix + 'HF TF Pha Max (normed):' + str(angle(hfmeas_tf_norm).max()))
+    logging.debug(prefix + 'HF TF Pha Min (normed):' + str(angle(hfmeas_tf_norm).min()))
+
+    logging.debug(prefix + 'LF Coh2 Median:' + str(median(lfmeas_coh)))
+    logging.debug(prefix + 'HF Coh2 Median:' + str(median(hfmeas_coh)))
+
+    # fitting targets are reduced to coherence weighted log spaced bins in each stage
+    if fit_stages is None:
+        fit_stages = (fit_bins_per_decade,)
+    fit_stages = tuple(fit_stages)
 
     #TODO need to move this to be sensor dependent in instruments.py
     # for sts2.5 ONLY
     logging.debug('Setting paz perturbation map and splitting...')
     hf_paz_pert = full_paz.make_partial(hf_paz_pert_map, hf_norm_freq)
     lf_paz_pert = full_paz.make_partial(lf_paz_pert_map, lf_norm_freq)
+    if start_paz is not None:
+        hf_paz_start = start_paz.make_partial(hf_paz_pert_map, hf_norm_freq)
+        lf_paz_start = start_paz.make_partial(lf_paz_pert_map, lf_norm_freq)
+    else:
+        hf_paz_start = lf_paz_start = None
+    logging.debug('Setting paz perturbation map and splitting... complete.')
 
-    logging.debug('Computing response of perturbed paz...')
-    # initial response of paz_pert over freq_band of interest
-    hf_resp0 = ida.signals.utils.compute_response(hfmeas_f_t, hf_paz_pert)
-    lf_resp0 = ida.signals.utils.compute_response(lfmeas_f_t, lf_paz_pert)
-    logging.debug('Computing response of perturbed paz... complete.')
+    # models are normalized at the frequency where the measured TFs were normalized, which may not be on the grid
+    hf_task = PAZFitTask(prefix + 'HF', hf_paz_pert, hf_norm_freq, hfmeas_f_t, hfmeas_tf_norm, hfmeas_coh,
+                         hfmeas_f_t[hf_norm_ndx], jac, hf_paz_start, fit_stages)
+    lf_task = PAZFitTask(prefix + 'LF', lf_paz_pert, lf_norm_freq, lfmeas_f_t, lfmeas_tf_norm, lfmeas_coh,
+                         lfmeas_f_t[lf_norm_ndx], jac, lf_paz_start, fit_stages)
 
-    logging.debug('Setting paz perturbation map and splitting... complete.')
-    hf_paz_pert_flat, hf_paz_pert_flags = ida.signals.utils.unpack_paz(hf_paz_pert,
-                                                                       (list(range(0, hf_paz_pert.num_poles)),
-                                                                        list(range(0, hf_paz_pert.num_zeros))))
-
-    lf_paz_pert_flat, lf_paz_pert_flags = ida.signals.utils.unpack_paz(lf_paz_pert,
-                                                                       (list(range(0, lf_paz_pert.num_poles)),
-                                                                        list(range(0, lf_paz_pert.num_zeros))))
-
-    hf_pazpert_lb = hf_paz_pert_flat - 0.5 * abs(hf_paz_pert_flat)
-    hf_pazpert_ub = hf_paz_pert_flat + 0.5 * abs(hf_paz_pert_flat)
-    lf_pazpert_lb = lf_paz_pert_flat - 0.5 * abs(lf_paz_pert_flat)
-    lf_pazpert_ub = lf_paz_pert_flat + 0.5 * abs(lf_paz_pert_flat)
-
-
-    def resp_cost(p, paz_partial_flags, freqs, normfreq, tf_target, resp_pert0):
-
-        # pack up into PAZ instances
-        paz_pert = ida.signals.utils.pack_paz(p, paz_partial_flags)
-
-        # compute perturbed response andnormalize
-        resp = ida.signals.utils.compute_response(freqs, paz_pert)
-        resp_norm, scale, ndx = ida.signals.utils.normalize_response(resp, freqs, normfreq)
-
-        # calc new TF
-        new_tf = divide(resp_norm, resp_pert0)
-        # simple dif for residuals array. Assuems tf_target is np.concatenate((tf_target.real, tf_target.imag))
-        new_real_imag_tf = concatenate((new_tf.real, new_tf.imag))
-        resid = subtract(new_real_imag_tf, tf_target)
-
-        return resid
-
-
-    logging.info('Fitting new HF response...')
-
-    hf_res = least_squares(resp_cost,
-                           hf_paz_pert_flat,
-                           bounds=(hf_pazpert_lb,
-                                   hf_pazpert_ub),  # lb, ub for each parameter
-                           method='trf',
-                           jac='3-point',  # I think this matches MATLAB FiniteDifferenceType='central'
-                           xtol=1e-6,
-                           ftol=1e-4,
-                           diff_step=0.001,
-                           max_nfev=300,  # max number of function evaluations
-                           # list addl args to fittung fun
-                           args=(hf_paz_pert_flags,
-                                 hfmeas_f_t,
-                                 hf_norm_freq,
-                                 concatenate((hfmeas_tf_norm.real, hfmeas_tf_norm.imag)),
-                                 hf_resp0
-                                 ),
-                           verbose=0)
-    logging.info('HF fitting termination: ' + hf_res.message)
-    logging.debug('HF fitting paz results: ' + str(hf_res.x))
-
-    logging.info('Fitting new LF response...')
-    lf_res = least_squares(resp_cost,  # cost function
-                            lf_paz_pert_flat,  # initial values
-                            bounds=(lf_pazpert_lb,
-                                    lf_pazpert_ub),  # lb, ub for each parameter
-                            method='trf',
-                            jac='3-point',  # I think this matches MATLAB FiniteDifferenceType='central'
-                            xtol=1e-6,
-                            ftol=1e-4,
-                            diff_step=0.001,
-                            max_nfev=300,  # max number of function evaluations
-                            # list addl args to fittung fun
-                            args=(lf_paz_pert_flags,
-                                  lfmeas_f_t,
-                                  lf_norm_freq,
-                                  concatenate((lfmeas_tf_norm.real, lfmeas_tf_norm.imag)),
-                                  lf_resp0
-                                  ),
-                           verbose=0)
-    logging.info('LF fitting termination: ' + lf_res.message)
-    logging.debug('LF fitting paz results: ' + str(lf_res.x))
-
-    new_hf_paz_pert = ida.signals.utils.pack_paz(hf_res.x, hf_paz_pert_flags)
-    new_lf_paz_pert = ida.signals.utils.pack_paz(lf_res.x, lf_paz_pert_flags)
+    return hf_task, lf_task
+
+
+def partial_paz_map(paz_pert_map, paz_sub_map):
+    """Convert full response indices of a subset of the perturbed poles/zeros to indices into the partial PAZ
+    made from paz_pert_map.
+
+    :param paz_pert_map: paz map of the perturbed poles/zeros
+    :type paz_pert_map: ([], [])
+    :param paz_sub_map: paz map of a subset of paz_pert_map
+    :type paz_sub_map: ([], [])
+    :return: paz map into the partial PAZ
+    :rtype: ([], [])
+    """
+
+    for pert_ndxs, sub_ndxs in zip(paz_pert_map, paz_sub_map):
+        missing = [ndx for ndx in sub_ndxs if ndx not in pert_ndxs]
+        if missing:
+            msg = 'PAZ indices {} are not perturbed: {}'.format(missing, paz_pert_map)
+            logging.error(msg)
+            raise ValueError(msg)
+
+    return ([list(paz_pert_map[0]).index(ndx) for ndx in paz_sub_map[0]],
+            [list(paz_pert_map[1]).index(ndx) for ndx in paz_sub_map[1]])
+
+
+def merge_cal_fits(full_paz, lf_paz_pert_map, hf_paz_pert_map, new_lf_paz_pert, new_hf_paz_pert):
+    """Merge fitted LF and HF partial PAZ into a copy of full_paz.
+
+    :param full_paz: Full model response that was fit
+    :type full_paz: PAZ
+    :param lf_paz_pert_map: paz map of the perturbed LF poles/zeros
+    :type ([], [])
+    :param hf_paz_pert_map: paz map of the perturbed HF poles/zeros
+    :type ([], [])
+    :param new_lf_paz_pert: Fitted LF partial PAZ
+    :type new_lf_paz_pert: PAZ
+    :param new_hf_paz_pert: Fitted HF partial PAZ
+    :type new_hf_paz_pert: PAZ
+    :return: New PAZ with improved response fit
+    :rtype: PAZ
+    """
+
+    hf_norm_freq = 1.0
     new_paz = full_paz.copy()
     new_paz.merge_paz_partial(new_hf_paz_pert, hf_paz_pert_map, hf_norm_freq)
     new_paz.merge_paz_partial(new_lf_paz_pert, lf_paz_pert_map, hf_norm_freq)
@@ -314,7 +587,380 @@ def analyze_cal_component(full_paz, lf_paz_pert_map, hf_paz_pert_map,
     return new_paz
 
 
-def prepare_cal_data(data_dir, lf_fnames, hf_fnames, seis_model, lf_paz_tpl, hf_paz_tpl):
+def analyze_cal_component(full_paz, lf_paz_pert_map, hf_paz_pert_map,
+                          lf_sr, hf_sr, operating_sr, lfinput, hfinput, lfmeas, hfmeas,
+                          lf_cross=None, hf_cross=None, taper_mode=ida.calibration.cross.TAPER_MODE_FIXED,
+                          workspace=None, jac=FIT_JAC_ANALYTIC, fit_bins_per_decade=None,
+                          max_workers=None, executor=None, start_paz=None, fit_stages=None, fit_starts=1, seed=None,
+                          diagnostics=None):
+    """Analyze both high and low frequency calibration component timeseries output with calibration input
+    using starting paz fitting_paz.
+
+    Find improved PAZ fit to reduce transfer function based on fitting_paz between input/output time series using a least_squares minimization
+    approach.
+
+    Precomputed cross_correlate() results for the component (e.g. from cross_correlate_components()) may be
+    supplied in lf_cross and hf_cross, in which case the corresponding timeseries are not used.
+
+    :param full_paz: Full model response for fitting (note: may be different then resp used to convolve w/input)
+    :type full_paz: PAZ
+    :param lf_paz_pert_map: paz map of which LF poles/zeros to perturb for fitting
+    :type ([], [])
+    :param hf_paz_pert_map: paz map of which HF poles/zeros to perturb for fitting
+    :type ([], [])
+    :param lf_sr: Low frequency sampling rate
+    :type lf_sr: float
+    :param hf_sr: High frequency sampling rate
+    :type hf_sr: float
+    :param operating_sr: Operational Sampling rate of channels
+    :type operating_sr: float
+    :param lfinput: Low frequency calibration input signal timeseries
+    :type lfinput: ndarray
+    :param hfinput: High frequency calibration input signal timeseries
+    :type hfinput: ndarray
+    :param lfmeas: Low frequency measured component output timeseries
+    :type lfmeas: ndarray
+    :param hfmeas: High frequency measured component output timeseries
+    :type hfmeas: ndarray
+    :param lf_cross: Precomputed LF (freqs, gain, phase, coh[, lag]) covering the LF fitting band (Optional)
+    :type lf_cross: (ndarray, ndarray, ndarray, ndarray)
+    :param hf_cross: Precomputed HF (freqs, gain, phase, coh[, lag]) covering the HF fitting band (Optional)
+    :type hf_cross: (ndarray, ndarray, ndarray, ndarray)
+    :param taper_mode: Taper count mode used when computing coherence. See cross_correlate()
+    :type taper_mode: str
+    :param workspace: Transform buffers and FFT backend shared by the spectral computations (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :param jac: FIT_JAC_ANALYTIC for the closed form jacobian, or a least_squares() finite difference scheme
+        (e.g. '3-point')
+    :type jac: str
+    :param fit_bins_per_decade: Log frequency grid density the measured TFs are decimated to before fitting
+        (see ida.calibration.fitting.log_bin_tf(), e.g. FIT_BINS_PER_DECADE). None (default) or 0 fits every
+        frequency bin.
+    :type fit_bins_per_decade: float
+    :param max_workers: Worker process count for running the LF and HF fits concurrently. See run_fit_tasks().
+    :type max_workers: int
+    :param executor: Executor to run the LF and HF fits in (Optional). See run_fit_tasks().
+    :type executor: concurrent.futures.Executor
+    :param start_paz: Full response to start the fits from, e.g. the sensor's last accepted calibration from
+        ida.calibration.history.CalHistory.latest(). Bounds are still derived from full_paz. (Optional)
+    :type start_paz: PAZ
+    :param fit_stages: Bins per decade of each coarse to fine fitting stage, e.g.
+        ida.calibration.fitting.FIT_STAGES_COARSE_TO_FINE. Each stage starts from the previous stage's result.
+        Overrides fit_bins_per_decade. (Optional)
+    :type fit_stages: [float]
+    :param fit_starts: Number of starting points of each fit. Above 1, the LF and HF fits are also started
+        from points spread over the fitting bounds and the lowest cost fits are kept. See
+        ida.calibration.fitting.run_multi_start_fits().
+    :type fit_starts: int
+    :param seed: Random seed for the multi-start starting points (Optional)
+    :type seed: int
+    :param diagnostics: List the HF and LF fit diagnostics records are appended to, see
+        ida.calibration.fitting.fit_diagnostics() (Optional)
+    :type diagnostics: list
+    :return: New PAZ with improved response fit
+    :rtype: PAZ
+    """
+
+    if jac not in FIT_JAC_MODES:
+        msg = "Invalid jacobian mode: '{}'. Valid values: {}".format(jac, FIT_JAC_MODES)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    (lflo, lfhi), (hflo, hfhi) = cal_fit_bands(operating_sr)
+
+    # generate coherence info for each component, only within the fitting bands
+    if lf_cross is None:
+        logging.debug('Compute coherence for LF time series...')
+        lf_cross = ida.calibration.cross.cross_correlate(lf_sr, lfinput, lfmeas, band=(lflo, lfhi),
+                                                         taper_mode=taper_mode, workspace=workspace, lag=True)
+        ida.calibration.cross.log_lag(lf_cross[4], lf_sr, 'LF')
+        logging.debug('Compute coherence for LF time series... complete.')
+
+    if hf_cross is None:
+        logging.debug('Compute coherence for HF time series...')
+        hf_cross = ida.calibration.cross.cross_correlate(hf_sr, hfinput, hfmeas, band=(hflo, hfhi),
+                                                         taper_mode=taper_mode, workspace=workspace, lag=True)
+        ida.calibration.cross.log_lag(hf_cross[4], hf_sr, 'HF')
+        logging.debug('Compute coherence for HF time series... complete.')
+
+    hf_task, lf_task = cal_fit_tasks('', full_paz, lf_paz_pert_map, hf_paz_pert_map, operating_sr,
+                                     lf_cross, hf_cross, jac=jac, fit_bins_per_decade=fit_bins_per_decade,
+                                     start_paz=start_paz, fit_stages=fit_stages)
+    hf_res, lf_res = run_multi_start_fits([hf_task, lf_task], start_cnt=fit_starts, seed=seed,
+                                          max_workers=max_workers, executor=executor)
+    if diagnostics is not None:
+        diagnostics.extend([fit_diagnostics(ms_res.best, ms_res if fit_starts > 1 else None)
+                            for ms_res in [hf_res, lf_res]])
+
+    return merge_cal_fits(full_paz, lf_paz_pert_map, hf_paz_pert_map, lf_res.best.paz, hf_res.best.paz)
+
+
+def _fit_band_task(task):
+    """fit_paz_joint() of a JointPAZFitTask, else fit_paz() of a PAZFitTask (for run_fit_tasks())."""
+
+    if isinstance(task, JointPAZFitTask):
+        return fit_paz_joint(task)
+    return fit_paz(task)
+
+
+def analyze_cal_components(full_paz_tpl, lf_paz_pert_map, hf_paz_pert_map, operating_sr, lf_cross, hf_cross,
+                           jac=FIT_JAC_ANALYTIC, fit_bins_per_decade=None,
+                           max_workers=None, executor=None, start_paz_tpl=None, fit_stages=None,
+                           fit_starts=1, seed=None, paz_shared_maps=None, diagnostics=None):
+    """Fit improved responses for all three components, running the six LF and HF fits concurrently.
+
+    With paz_shared_maps, the components are instead fit jointly: one LF and one HF fit each stack the three
+    components' residuals, with the shared poles and zeros common to all components (see
+    ida.calibration.fitting.fit_paz_joint()).
+
+    The fits are independent, so they are submitted together to a process pool (or the supplied executor).
+    Results are merged in component order regardless of completion order, so output is identical to fitting
+    each component in turn with analyze_cal_component(). A failing fit raises its exception here.
+
+    :param full_paz_tpl: Full model response for fitting for each component
+    :type full_paz_tpl: ida.instruments.ComponentsTpl
+    :param lf_paz_pert_map: paz map of which LF poles/zeros to perturb for fitting
+    :type ([], [])
+    :param hf_paz_pert_map: paz map of which HF poles/zeros to perturb for fitting
+    :type ([], [])
+    :param operating_sr: Operational Sampling rate of channels
+    :type operating_sr: float
+    :param lf_cross: LF cross_correlate() results for each component, e.g. from cross_correlate_components()
+    :type lf_cross: ida.instruments.ComponentsTpl
+    :param hf_cross: HF cross_correlate() results for each component, e.g. from cross_correlate_components()
+    :type hf_cross: ida.instruments.ComponentsTpl
+    :param jac: FIT_JAC_ANALYTIC or a least_squares() finite difference scheme
+    :type jac: str
+    :param fit_bins_per_decade: Log frequency grid density of the fitting targets. None (default) or 0 fits every bin.
+    :type fit_bins_per_decade: float
+    :param max_workers: Worker process count. None (default) uses the CPU count, 1 fits sequentially in this
+        process. See ida.calibration.fitting.run_fit_tasks().
+    :type max_workers: int
+    :param executor: Executor to run the fits in (Optional). See run_fit_tasks().
+    :type executor: concurrent.futures.Executor
+    :param start_paz_tpl: Full response to start the fits from for each component, or None per component to
+        start from full_paz_tpl (Optional). Bounds are always derived from full_paz_tpl.
+    :type start_paz_tpl: ida.instruments.ComponentsTpl
+    :param fit_stages: Bins per decade of each coarse to fine fitting stage. See analyze_cal_component().
+    :type fit_stages: [float]
+    :param fit_starts: Number of starting points of each fit. See analyze_cal_component().
+    :type fit_starts: int
+    :param seed: Random seed for the multi-start starting points (Optional)
+    :type seed: int
+    :param paz_shared_maps: LF and HF paz maps of the perturbed poles/zeros shared by all components, e.g.
+        from SEISMOMETER_RESPONSES[seis_model]['shared'] (Optional). A band with no shared poles/zeros is fit
+        per component. Not supported with fit_starts > 1 if any are shared.
+    :type paz_shared_maps: (([], []), ([], []))
+    :param diagnostics: List the diagnostics records of the fits are appended to, HF and LF for each component
+        in turn. See ida.calibration.fitting.fit_diagnostics(). (Optional)
+    :type diagnostics: list
+    :return: New PAZ with improved response fit for each component
+    :rtype: ida.instruments.ComponentsTpl
+    """
+
+    tasks = []
+    for comp in ComponentsTpl._fields:
+        tasks.extend(cal_fit_tasks(comp.upper(), getattr(full_paz_tpl, comp),
+                                   lf_paz_pert_map, hf_paz_pert_map, operating_sr,
+                                   getattr(lf_cross, comp), getattr(hf_cross, comp),
+                                   jac=jac, fit_bins_per_decade=fit_bins_per_decade,
+                                   start_paz=getattr(start_paz_tpl, comp) if start_paz_tpl else None,
+                                   fit_stages=fit_stages))
+
+    # a band with nothing shared gains nothing from a joint fit, its components are fit independently
+    lf_shared = hf_shared = False
+    if paz_shared_maps is not None:
+        lf_shared, hf_shared = [any(len(ndxs) > 0 for ndxs in shared_map) for shared_map in paz_shared_maps]
+        for band, shared in [('LF', lf_shared), ('HF', hf_shared)]:
+            if not shared:
+                logging.info('No shared {} poles/zeros, fitting the {} components independently.'.format(band, band))
+
+    logging.debug('Fitting {} component responses...'.format(len(tasks)))
+    if not (lf_shared or hf_shared):
+        results = run_multi_start_fits(tasks, start_cnt=fit_starts, seed=seed,
+                                       max_workers=max_workers, executor=executor)
+        fit_pazs = [ms_res.best.paz for ms_res in results]
+        if diagnostics is not None:
+            diagnostics.extend([fit_diagnostics(ms_res.best, ms_res if fit_starts > 1 else None)
+                                for ms_res in results])
+    else:
+        if fit_starts > 1:
+            msg = 'Joint component fits do not support multiple starts.'
+            logging.error(msg)
+            raise ValueError(msg)
+
+        lf_shared_map, hf_shared_map = paz_shared_maps
+        # tasks alternate HF, LF per component
+        band_tasks = []
+        for label, comp_tasks, shared, pert_map, shared_map in [('HF', tasks[0::2], hf_shared,
+                                                                 hf_paz_pert_map, hf_shared_map),
+                                                                ('LF', tasks[1::2], lf_shared,
+                                                                 lf_paz_pert_map, lf_shared_map)]:
+            if shared:
+                band_tasks.append(JointPAZFitTask('JOINT ' + label, comp_tasks,
+                                                  partial_paz_map(pert_map, shared_map)))
+            else:
+                band_tasks.extend(comp_tasks)
+        band_results = run_fit_tasks(_fit_band_task, band_tasks, max_workers=max_workers, executor=executor)
+
+        # back to one result per task: a joint fit gives the results of all of its components
+        comp_cnt = len(ComponentsTpl._fields)
+        hf_results = band_results[0] if hf_shared else band_results[:comp_cnt]
+        lf_results = band_results[-1] if lf_shared else band_results[-comp_cnt:]
+        fit_pazs = [res.paz for comp_results in zip(hf_results, lf_results) for res in comp_results]
+        if diagnostics is not None:
+            diagnostics.extend([fit_diagnostics(res)
+                                for comp_results in zip(hf_results, lf_results) for res in comp_results])
+    logging.debug('Fitting {} component responses complete.'.format(len(tasks)))
+
+    new_pazs = []
+    for ndx, comp in enumerate(ComponentsTpl._fields):
+        new_pazs.append(merge_cal_fits(getattr(full_paz_tpl, comp), lf_paz_pert_map, hf_paz_pert_map,
+                                       fit_pazs[2 * ndx + 1], fit_pazs[2 * ndx]))
+
+    return ComponentsTpl(*new_pazs)
+
+
+def bootstrap_cal_components(full_paz_tpl, new_paz_tpl, lf_paz_pert_map, hf_paz_pert_map, operating_sr,
+                              lf_cross, hf_cross, replicate_cnt=100, jac=FIT_JAC_ANALYTIC,
+                              fit_bins_per_decade=FIT_BINS_PER_DECADE, fit_stages=None,
+                              block_bins=BOOTSTRAP_BLOCK_BINS, seed=None, max_workers=None, executor=None):
+    """Bootstrap replicates of the responses fitted by analyze_cal_components().
+
+    Each LF and HF fit is repeated replicate_cnt times against its fitted TF plus block resampled residuals
+    (see ida.calibration.fitting.bootstrap_tasks()), starting from the fitted response. Residuals are resampled
+    at every frequency bin, and each replicate is then refit on the log frequency grid of fit_bins_per_decade.
+    All refits run together in a process pool (or the supplied executor). The spread of the replicates gives
+    confidence intervals for the fitted poles/zeros and quantities derived from them (see
+    ida.calibration.fitting.percentile_intervals()).
+
+    :param full_paz_tpl: Full model response that was fit for each component
+    :type full_paz_tpl: ida.instruments.ComponentsTpl
+    :param new_paz_tpl: Fitted response of each component, from analyze_cal_components()
+    :type new_paz_tpl: ida.instruments.ComponentsTpl
+    :param lf_paz_pert_map: paz map of which LF poles/zeros were perturbed
+    :type ([], [])
+    :param hf_paz_pert_map: paz map of which HF poles/zeros were perturbed
+    :type ([], [])
+    :param operating_sr: Operational Sampling rate of channels
+    :type operating_sr: float
+    :param lf_cross: LF cross_correlate() results for each component
+    :type lf_cross: ida.instruments.ComponentsTpl
+    :param hf_cross: HF cross_correlate() results for each component
+    :type hf_cross: ida.instruments.ComponentsTpl
+    :param replicate_cnt: Number of bootstrap replicates
+    :type replicate_cnt: int
+    :param jac: FIT_JAC_ANALYTIC or a least_squares() finite difference scheme
+    :type jac: str
+    :param fit_bins_per_decade: Log frequency grid density the replicate targets are decimated to (default
+        FIT_BINS_PER_DECADE). None or 0 refits every bin.
+    :type fit_bins_per_decade: float
+    :param fit_stages: Bins per decade of each fitting stage (Optional). See analyze_cal_component().
+    :type fit_stages: [float]
+    :param block_bins: Residual block length in frequency bins
+    :type block_bins: int
+    :param seed: Random seed, for reproducible replicates (Optional)
+    :type seed: int
+    :param max_workers: Worker process count. See ida.calibration.fitting.run_fit_tasks().
+    :type max_workers: int
+    :param executor: Executor to run the refits in (Optional)
+    :type executor: concurrent.futures.Executor
+    :return: replicate_cnt full responses for each component
+    :rtype: ida.instruments.ComponentsTpl
+    """
+
+    # replicate tasks of each component: HF replicates, then LF replicates
+    tasks = []
+    for comp_ndx, comp in enumerate(ComponentsTpl._fields):
+        hf_task, lf_task = cal_fit_tasks(comp.upper(), getattr(full_paz_tpl, comp),
+                                         lf_paz_pert_map, hf_paz_pert_map, operating_sr,
+                                         getattr(lf_cross, comp), getattr(hf_cross, comp),
+                                         jac=jac, fit_bins_per_decade=fit_bins_per_decade,
+                                         start_paz=getattr(new_paz_tpl, comp), fit_stages=fit_stages)
+        for band_ndx, task in enumerate([hf_task, lf_task]):
+            tasks.extend(bootstrap_tasks(task, replicate_cnt, block_bins=block_bins,
+                                         seed=None if seed is None else seed + 2 * comp_ndx + band_ndx))
+
+    logging.info('Fitting {} bootstrap replicates...'.format(len(tasks)))
+    results = run_fit_tasks(fit_paz, tasks, max_workers=max_workers, executor=executor)
+    logging.info('Fitting {} bootstrap replicates complete.'.format(len(tasks)))
+
+    replicates = []
+    for comp_ndx, comp in enumerate(ComponentsTpl._fields):
+        hf_results = results[2 * comp_ndx * replicate_cnt:(2 * comp_ndx + 1) * replicate_cnt]
+        lf_results = results[(2 * comp_ndx + 1) * replicate_cnt:(2 * comp_ndx + 2) * replicate_cnt]
+        replicates.append([merge_cal_fits(getattr(full_paz_tpl, comp), lf_paz_pert_map, hf_paz_pert_map,
+                                          lf_res.paz, hf_res.paz)
+                           for hf_res, lf_res in zip(hf_results, lf_results)])
+
+    return ComponentsTpl(*replicates)
+
+
+def prepare_cal_band(cal_tpl, paz_tpl, taper_fraction=0.1, workspace=None):
+    """Prepare the input and component output time series of one calibration band for coherence analysis.
+
+    All components are processed together as rows of stacked 2-D arrays:
+        - the input is tapered and transformed once
+        - its transform is multiplied by the normalized (acc) response of each component's PAZ
+        - the rows are inverse transformed in one batched irfft
+    Input and output rows then have the taper portions trimmed off and are normed and de-meaned in place.
+    The returned time series are row views of the stacked arrays.
+
+    :param cal_tpl: Trimmed, polarity corrected cal traces with input, north, east and vertical attributes
+    :type cal_tpl: namedtuple
+    :param paz_tpl: ComponentsTpl with the starting model of each component to convolve the input with
+    :type paz_tpl: ComponentsTpl
+    :param taper_fraction: Tukey taper length at each end, as a fraction of the time series
+    :type taper_fraction: float
+    :param workspace: Transform buffers and FFT backend shared by the spectral computations (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
+    :return:
+        sampling rate,
+        time series start_time,
+        convolved input timeseries, in ComponentTpl
+        measured component output timeseries, in ComponentTpl
+        complex normalized paz responses in ComponentTpl, list of frequencies
+    :rtype: float, timestamp, ComponentTpl, ComponentTpl, ComponentTpl, ndarray
+    """
+
+    samp_rate = cal_tpl.input.sampling_rate
+    start_time = cal_tpl.input.starttime
+    npts = cal_tpl.input.npts
+    comps = ComponentsTpl._fields
+
+    taper = tukey(npts, alpha=taper_fraction * 2, sym=True)
+    taper_bin_cnt = int(ceil(npts * taper_fraction))
+
+    freqs = linspace(0, samp_rate/2, npts//2 + 1)  # count is to match behavior of np.fft.rfft below
+    freq_grid = ida.signals.utils.FrequencyGrid(freqs)
+    resps = []
+    for comp in comps:
+        resps.append(ida.signals.utils.cached_response(freq_grid, getattr(paz_tpl, comp), mode='acc', norm_freq=0.05))
+
+    # convolve input with each component's response: one rfft, batched irfft over component rows
+    input_fft = rfft(multiply(cal_tpl.input.data[:npts], taper,
+                              out=empty_buffer(npts, float64, 'tapered', workspace=workspace)),
+                     workspace=workspace)
+    inp_freqs_cnv_resp = empty_buffer((len(comps), input_fft.size), complex128, 'convolved', workspace=workspace)
+    for ndx, resp in enumerate(resps):
+        multiply(input_fft, resp, out=inp_freqs_cnv_resp[ndx])
+    inp_with_resp = irfft(inp_freqs_cnv_resp, npts, workspace=workspace)[:, taper_bin_cnt:-taper_bin_cnt]
+
+    # outputs are copied once, straight into the trimmed rows
+    meas = empty((len(comps), npts - 2 * taper_bin_cnt), dtype=float64)
+    for ndx, comp in enumerate(comps):
+        meas[ndx] = getattr(cal_tpl, comp).data[taper_bin_cnt:-taper_bin_cnt]
+
+    for stack in [inp_with_resp, meas]:
+        stack /= stack.std(axis=1, keepdims=True)
+        stack -= stack.mean(axis=1, keepdims=True)
+
+    # hand out copies, the cached responses stay read only for other callers
+    return samp_rate, start_time, ComponentsTpl(*inp_with_resp), ComponentsTpl(*meas), \
+           ComponentsTpl(*[resp.copy() for resp in resps]), freqs
+
+
+def prepare_cal_data(data_dir, lf_fnames, hf_fnames, seis_model, lf_paz_tpl, hf_paz_tpl, workspace=None):
     """Prepare low and high frequency miniseed files produced by qcal for analysis.
     It assumes all three observed Z12 coponents plus input signal will exist in each miniseed file.
     Each components is:
@@ -351,6 +997,8 @@ def prepare_cal_data(data_dir, lf_fnames, hf_fnames, seis_model, lf_paz_tpl, hf_
     :type lf_paz_tpl: ComponentTpl
     :param hf_paz_tpl: ComponentTpl with starting HF model with which to convolve the calibration input signal.
     :type hf_paz_tpl: ComponentTpl
+    :param workspace: Transform buffers and FFT backend shared by the spectral computations (Optional)
+    :type workspace: ida.signals.fft.FFTWorkspace
     :return:
         low freq sampling rate,
         low freq time series start_time,
@@ -416,125 +1064,22 @@ def prepare_cal_data(data_dir, lf_fnames, hf_fnames, seis_model, lf_paz_tpl, hf_
         cal_lf_tpl = cal_lf
         cal_hf_tpl = cal_hf
 
-    samp_rate_lf = cal_lf_tpl.input.sampling_rate
-    start_time_lf = cal_lf_tpl.input.starttime
-    samp_rate_hf = cal_hf_tpl.input.sampling_rate
-    start_time_hf = cal_hf_tpl.input.starttime
-    npts_lf = cal_lf_tpl.input.npts
-    npts_hf = cal_hf_tpl.input.npts
-
-    fraction = 0.1  # each side
-    logging.debug('Creating tapers...')
-    taper_lf = tukey(npts_lf, alpha=fraction * 2, sym=True)
-    taper_bin_cnt_lf = int(ceil(npts_lf * fraction))
-    taper_hf = tukey(npts_hf, alpha=fraction * 2, sym=True)
-    taper_bin_cnt_hf = int(ceil(npts_hf * fraction))
-    logging.debug('Creating tapers complete.')
-
-    logging.debug('Generating starting LF (mode=acc) response...')
-
-    freqs_lf = linspace(0, samp_rate_lf/2, npts_lf//2 + 1)  # count is to match behavior of np.fft.rfft below
-    resp_tmp_lf = ida.signals.utils.compute_response(freqs_lf, lf_paz_tpl.vertical, mode='acc')
-    resp_lf_v, _, _ = ida.signals.utils.normalize_response(resp_tmp_lf, freqs_lf, 0.05)
-    resp_tmp_lf = ida.signals.utils.compute_response(freqs_lf, lf_paz_tpl.north, mode='acc')
-    resp_lf_n, _, _ = ida.signals.utils.normalize_response(resp_tmp_lf, freqs_lf, 0.05)
-    resp_tmp_lf = ida.signals.utils.compute_response(freqs_lf, lf_paz_tpl.east, mode='acc')
-    resp_lf_e, _, _ = ida.signals.utils.normalize_response(resp_tmp_lf, freqs_lf, 0.05)
-
-    logging.debug('Generating starting  HF (acc) response...')
-
-    freqs_hf = linspace(0, samp_rate_hf/2, npts_hf//2 + 1)  # count is to match behavior of np.fft.rfft below
-    resp_tmp_hf = ida.signals.utils.compute_response(freqs_hf, hf_paz_tpl.vertical, mode='acc')
-    resp_hf_v, _, _ = ida.signals.utils.normalize_response(resp_tmp_hf, freqs_hf, 0.05)
-    resp_tmp_hf = ida.signals.utils.compute_response(freqs_hf, hf_paz_tpl.north, mode='acc')
-    resp_hf_n, _, _ = ida.signals.utils.normalize_response(resp_tmp_hf, freqs_hf, 0.05)
-    resp_tmp_hf = ida.signals.utils.compute_response(freqs_hf, hf_paz_tpl.east, mode='acc')
-    resp_hf_e, _, _ = ida.signals.utils.normalize_response(resp_tmp_hf, freqs_hf, 0.05)
-
-    logging.debug('Generating starting L/HF responses complete.')
-
-    resp_lf = ComponentsTpl(vertical=resp_lf_v, north=resp_lf_n, east=resp_lf_e)
-    resp_hf = ComponentsTpl(vertical=resp_hf_v, north=resp_hf_n, east=resp_hf_e)
-
-    #TODO: This should be generalized for to accommodate different strating paz for each component
-    # prep input signal: taper, fft, conv resp, ifft
-    logging.debug('Convolving LF input with nominal response...')
-    input_fft           = rfft(multiply(cal_lf_tpl.input.data[:npts_lf], taper_lf))
-    inp_freqs_cnv_resp  = multiply(input_fft, resp_lf_v)
-    lf_inp_wth_resp_v     = irfft(inp_freqs_cnv_resp, npts_lf)
-    lf_inp_wth_resp_v     = lf_inp_wth_resp_v[taper_bin_cnt_lf:-taper_bin_cnt_lf]
-    lf_inp_wth_resp_v.__itruediv__(lf_inp_wth_resp_v.std())
-    lf_inp_wth_resp_v.__isub__(lf_inp_wth_resp_v.mean())
-    inp_freqs_cnv_resp  = multiply(input_fft, resp_lf_n)
-    lf_inp_wth_resp_n     = irfft(inp_freqs_cnv_resp, npts_lf)
-    lf_inp_wth_resp_n     = lf_inp_wth_resp_n[taper_bin_cnt_lf:-taper_bin_cnt_lf]
-    lf_inp_wth_resp_n.__itruediv__(lf_inp_wth_resp_n.std())
-    lf_inp_wth_resp_n.__isub__(lf_inp_wth_resp_n.mean())
-    inp_freqs_cnv_resp  = multiply(input_fft, resp_lf_e)
-    lf_inp_wth_resp_e     = irfft(inp_freqs_cnv_resp, npts_lf)
-    lf_inp_wth_resp_e     = lf_inp_wth_resp_e[taper_bin_cnt_lf:-taper_bin_cnt_lf]
-    lf_inp_wth_resp_e.__itruediv__(lf_inp_wth_resp_e.std())
-    lf_inp_wth_resp_e.__isub__(lf_inp_wth_resp_e.mean())
-    logging.debug('Convolving LF input with nominal response complete')
-
-    logging.debug('Convolving HF input with nominal response...')
-    input_fft           = rfft(multiply(cal_hf_tpl.input.data, taper_hf))
-    inp_freqs_cnv_resp  = multiply(input_fft, resp_hf_v)
-    hf_inp_wth_resp_v     = irfft(inp_freqs_cnv_resp, npts_hf)
-    hf_inp_wth_resp_v     = hf_inp_wth_resp_v[taper_bin_cnt_hf:-taper_bin_cnt_hf]
-    hf_inp_wth_resp_v.__itruediv__(hf_inp_wth_resp_v.std())
-    hf_inp_wth_resp_v.__isub__(hf_inp_wth_resp_v.mean())
-    inp_freqs_cnv_resp  = multiply(input_fft, resp_hf_n)
-    hf_inp_wth_resp_n     = irfft(inp_freqs_cnv_resp, npts_hf)
-    hf_inp_wth_resp_n     = hf_inp_wth_resp_n[taper_bin_cnt_hf:-taper_bin_cnt_hf]
-    hf_inp_wth_resp_n.__itruediv__(hf_inp_wth_resp_n.std())
-    hf_inp_wth_resp_n.__isub__(hf_inp_wth_resp_n.mean())
-    inp_freqs_cnv_resp  = multiply(input_fft, resp_hf_e)
-    hf_inp_wth_resp_e     = irfft(inp_freqs_cnv_resp, npts_hf)
-    hf_inp_wth_resp_e     = hf_inp_wth_resp_e[taper_bin_cnt_hf:-taper_bin_cnt_hf]
-    hf_inp_wth_resp_e.__itruediv__(hf_inp_wth_resp_e.std())
-    hf_inp_wth_resp_e.__isub__(hf_inp_wth_resp_e.mean())
-    logging.debug('Convolving HF input with nominal response complete')
-
-    lf_inp_with_resp = ComponentsTpl(vertical=lf_inp_wth_resp_v, north=lf_inp_wth_resp_n, east=lf_inp_wth_resp_e)
-    hf_inp_with_resp = ComponentsTpl(vertical=hf_inp_wth_resp_v, north=hf_inp_wth_resp_n, east=hf_inp_wth_resp_e)
-
-    logging.debug('Input signals ready for coherence analysis.')
-
-    # prep output channels
-    logging.debug('Preparing LF output for coherence analysis...')
-    lf_out_e = cal_lf_tpl.east.data.copy()[taper_bin_cnt_lf:-taper_bin_cnt_lf]
-    lf_out_e.__itruediv__(lf_out_e.std())
-    lf_out_e.__isub__(lf_out_e.mean())
-    lf_out_n = cal_lf_tpl.north.data.copy()[taper_bin_cnt_lf:-taper_bin_cnt_lf]
-    lf_out_n.__itruediv__(lf_out_n.std())
-    lf_out_n.__isub__(lf_out_n.mean())
-    lf_out_v = cal_lf_tpl.vertical.data.copy()[taper_bin_cnt_lf:-taper_bin_cnt_lf]
-    lf_out_v.__itruediv__(lf_out_v.std())
-    lf_out_v.__isub__(lf_out_v.mean())
-    logging.debug('Preparing LF output for coherence analysis complete.')
-
-    logging.debug('Preparing HF output for coherence analysis...')
-    hf_out_e = cal_hf_tpl.east.data.copy()[taper_bin_cnt_hf:-taper_bin_cnt_hf]
-    hf_out_e.__itruediv__(hf_out_e.std())
-    hf_out_e.__isub__(hf_out_e.mean())
-    hf_out_n = cal_hf_tpl.north.data.copy()[taper_bin_cnt_hf:-taper_bin_cnt_hf]
-    hf_out_n.__itruediv__(hf_out_n.std())
-    hf_out_n.__isub__(hf_out_n.mean())
-    hf_out_v = cal_hf_tpl.vertical.data.copy()[taper_bin_cnt_hf:-taper_bin_cnt_hf]
-    hf_out_v.__itruediv__(hf_out_v.std())
-    hf_out_v.__isub__(hf_out_v.mean())
-    logging.debug('Preparing HF output for coherence analysis complete.')
-
-    lf_meas = ComponentsTpl(vertical=lf_out_v, north=lf_out_n, east=lf_out_e)
-    hf_meas = ComponentsTpl(vertical=hf_out_v, north=hf_out_n, east=hf_out_e)
-
-    logging.debug('SNR LF VER: {}'.format(1/subtract(lf_inp_wth_resp_v, lf_out_v).std()))
-    logging.debug('SNR LF NOR: {}'.format(1/subtract(lf_inp_wth_resp_n, lf_out_n).std()))
-    logging.debug('SNR LF EAS: {}'.format(1/subtract(lf_inp_wth_resp_e, lf_out_e).std()))
-    logging.debug('SNR HF VER: {}'.format(1/subtract(hf_inp_wth_resp_v, hf_out_v).std()))
-    logging.debug('SNR HF NOR: {}'.format(1/subtract(hf_inp_wth_resp_n, hf_out_n).std()))
-    logging.debug('SNR HF EAS: {}'.format(1/subtract(hf_inp_wth_resp_e, hf_out_e).std()))
+    logging.debug('Preparing LF cal data for coherence analysis...')
+    samp_rate_lf, start_time_lf, lf_inp_with_resp, lf_meas, resp_lf, freqs_lf = \
+        prepare_cal_band(cal_lf_tpl, lf_paz_tpl, workspace=workspace)
+    logging.debug('Preparing LF cal data for coherence analysis complete.')
+
+    logging.debug('Preparing HF cal data for coherence analysis...')
+    samp_rate_hf, start_time_hf, hf_inp_with_resp, hf_meas, resp_hf, freqs_hf = \
+        prepare_cal_band(cal_hf_tpl, hf_paz_tpl, workspace=workspace)
+    logging.debug('Preparing HF cal data for coherence analysis complete.')
+
+    # SNR estimates take a full length pass each, only compute when they will be logged
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for band, inputs, outputs in [('LF', lf_inp_with_resp, lf_meas), ('HF', hf_inp_with_resp, hf_meas)]:
+            for comp in ComponentsTpl._fields:
+                logging.debug('SNR {} {}: {}'.format(band, comp[:3].upper(),
+                                                     1/subtract(getattr(inputs, comp), getattr(outputs, comp)).std()))
 
     return samp_rate_lf, start_time_lf, lf_inp_with_resp, lf_meas, \
            samp_rate_hf, start_time_hf, hf_inp_with_resp, hf_meas, \
@@ -33,8 +33,13 @@ CTBTChannelResult = namedtuple('CTBTChannelResult', [
     'sample_rate',
     'in_spec',
     'paz',
-    'A0'
+    'A0',
+    'intervals'
 ])
+# intervals: bootstrap confidence intervals and biases of A0, CALIB and the fitted poles/zeros, as written to the
+# FITDIAG report, or None without a bootstrap. CALIBRATE_RESULT is a fixed IMS2.0 format, so they are not
+# written to the message text.
+CTBTChannelResult.__new__.__defaults__ = (None,)
 
 def calibration_result_msg(sta, loc, seis_model, cal_timestamp, channel_results, dig2_msg_fn=None, fir2_msg_fn=None, msgfn=None):
     """
@@ -21,26 +21,59 @@
 #######################################################################################################################
 
 import logging
+import json
 import os.path
 import sys
-from numpy import pi, linspace, abs
+from concurrent.futures import ProcessPoolExecutor
+from numpy import pi, linspace, abs, array
 import ida.calibration.plots
-from ida.calibration.process import analyze_cal_component, \
+from ida.calibration.process import analyze_cal_components, \
     compare_component_response, \
     prepare_cal_data, \
-    nominal_sys_sens_1hz
+    nominal_sys_sens_1hz, \
+    cal_fit_bands, \
+    cross_correlate_components, \
+    bootstrap_cal_components
+from ida.calibration.fitting import percentile_intervals, bootstrap_bias, FIT_STAGES_COARSE_TO_FINE
 import ida.signals.paz
-from ida.signals.utils import compute_response
+from ida.signals.utils import compute_responses, FrequencyGrid
+from ida.signals.fft import FFTWorkspace
 import ida.ctbto.messages
 from ida.instruments import ComponentsTpl, SEISMOMETER_RESPONSES
 
 """Methods for performing CTBTO/Sandia specific calibration analysis and data processing"""
 
-def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_model, full_paz_fn):
+
+def sys_sens_calibs(paz_list, seis_model, norm_freq=0.05):
+    """CALIB values (nm/ct at 1hz) of full responses normalized at norm_freq, as reported in CALIBRATE_RESULT.
+
+    :param paz_list: Full responses
+    :type paz_list: [PAZ]
+    :param seis_model: Seismometer model key
+    :type seis_model: str
+    :param norm_freq: Frequency at which the responses are normalized
+    :type norm_freq: float
+    :return: CALIB in nm/ct of each of paz_list
+    :rtype: ndarray
+    """
+
+    resps = compute_responses(array([norm_freq, 1.0]), paz_list)
+    sys_sens = nominal_sys_sens_1hz(resps[:, 1] / abs(resps[:, 0]), seis_model)
+
+    # convert cts/(m/s) to cts/m to nm/ct
+    return 1 / (sys_sens * (2 * pi) / 1e9)
+
+
+def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_model, full_paz_fn,
+                      max_workers=None, history=None, sensor_serial='', joint_fit=False, bootstrap_cnt=0,
+                      fit_stages=FIT_STAGES_COARSE_TO_FINE, fit_starts=1, seed=None):
     """Main method for analyzing random binary calibration data for Sandia/CTBTO STS2.5 (w/Q330HR digi) sensors.
     It processes both low and high frequency frequency random binary data sets. Supplied timeseries files must
     contain all 3 components plus input cal signal.
 
+    history, sensor_serial, joint_fit, bootstrap_cnt, fit_stages, fit_starts and seed are library options only:
+    the GUI runs the analysis with their defaults, as its configuration does not record sensor serial numbers.
+
     :param sta: Station code
     :type sta: str
     :param chancodes: ComponentsTpl tuple containing chan codes for each component.
@@ -57,6 +90,30 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
     :type seis_model: str
     :param full_paz_fn: PAZ FULL response filename or Tuple of filenames for each component
     :type full_paz_fn: str or ComponentsTpl
+    :param max_workers: Worker process count of the one process pool created for all response fits and
+        bootstrap refits. None (default) uses the CPU count, 1 fits sequentially in this process.
+    :type max_workers: int
+    :param history: Calibration history store. Fits start from the sensor's last accepted response and the new
+        responses are recorded, accepted if in spec. (Optional)
+    :type history: ida.calibration.history.CalHistory
+    :param sensor_serial: Sensor serial number identifying the sensor in history. Required with history.
+    :type sensor_serial: str
+    :param joint_fit: Fit the three components jointly, with the poles/zeros in
+        SEISMOMETER_RESPONSES[seis_model]['shared'] common to all components
+    :type joint_fit: bool
+    :param bootstrap_cnt: Number of bootstrap replicates used to estimate confidence intervals of the perturbed
+        poles/zeros, A0 and CALIB of each component. 0 skips the bootstrap.
+    :type bootstrap_cnt: int
+    :param fit_stages: Bins per decade of each coarse to fine fitting stage, None meaning every frequency bin.
+        The default fits on coarse log frequency grids first and finishes at full resolution; (None,) fits
+        every bin from the start.
+    :type fit_stages: [float]
+    :param fit_starts: Number of starting points of each LF and HF fit, run together in the process pool. Above 1,
+        the fits are also started from points spread over the fitting bounds and the lowest cost fits are kept.
+        Not supported with joint_fit when the model shares poles/zeros between components.
+    :type fit_starts: int
+    :param seed: Random seed for the multi-start starting points (Optional)
+    :type seed: int
     :return: Results: (IMS2.0_msg_filename, amp_plot_filename, pha_plot_filename)
     :rtype: (str, str, str)
     """
@@ -65,6 +122,11 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
         msg = 'full_paz_fn must be a response file name or ComponentsTpl with filenames of responses for each component'
         raise TypeError(msg)
 
+    if (history is not None) and not sensor_serial:
+        msg = 'sensor_serial is required to use calibration history.'
+        logging.error(msg)
+        raise ValueError(msg)
+
     if isinstance(full_paz_fn, str):
         full_paz_fn_tpl = ComponentsTpl(vertical=full_paz_fn, north=full_paz_fn, east=full_paz_fn)
     else:
@@ -110,6 +172,8 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
 
     logging.debug('Preparing cal data for coherence analysis...')
     # read, trim, transpose, invert and convolve input with response
+    # transform buffers are shared by all components of a run
+    workspace = FFTWorkspace()
 
     samp_rate_lf, lf_start_time, lfinput, lfmeas, \
     samp_rate_hf, hf_start_time, hfinput, hfmeas, \
@@ -117,7 +181,8 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
     _, freqs_hf = prepare_cal_data(os.path.abspath(data_dir),
                                    lf_fnames, hf_fnames,
                                    seis_model,
-                                   lf_fit_paz_tpl, hf_fit_paz_tpl)
+                                   lf_fit_paz_tpl, hf_fit_paz_tpl,
+                                   workspace=workspace)
 
     logging.debug('Preparing cal data for coherence analysis complete.')
 
@@ -127,38 +192,73 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
     hf_paz_pert_map = (SEISMOMETER_RESPONSES[seis_model]['perturb']['hf_poles'],
                        SEISMOMETER_RESPONSES[seis_model]['perturb']['hf_zeros'])
 
-    logging.debug('Analyzing cal data and calculating new VERTICAL response...')
+    paz_shared_maps = None
+    if joint_fit:
+        paz_shared_maps = ((SEISMOMETER_RESPONSES[seis_model]['shared']['lf_poles'],
+                            SEISMOMETER_RESPONSES[seis_model]['shared']['lf_zeros']),
+                           (SEISMOMETER_RESPONSES[seis_model]['shared']['hf_poles'],
+                            SEISMOMETER_RESPONSES[seis_model]['shared']['hf_zeros']))
 
     operating_sample_rate = 40.0
-    new_full_paz_v = analyze_cal_component(full_paz_tpl.vertical,
-                                          lf_paz_pert_map, hf_paz_pert_map,
-                                          samp_rate_lf, samp_rate_hf, operating_sample_rate,
-                                          lfinput.vertical, hfinput.vertical,
-                                          lfmeas.vertical, hfmeas.vertical)
-
-    logging.debug('Analyzing cal data and calculating new VERTICAL response complete.')
-    logging.debug('Analyzing cal data and calculating new NORTH response...')
-
-    new_full_paz_n = analyze_cal_component(full_paz_tpl.north,
-                                          lf_paz_pert_map, hf_paz_pert_map,
-                                          samp_rate_lf, samp_rate_hf, operating_sample_rate,
-                                          lfinput.north, hfinput.north,
-                                          lfmeas.north, hfmeas.north)
-
-    logging.debug('Analyzing cal data and calculating new NORTH response complete.')
-    logging.debug('Analyzing cal data and calculating new EAST response...')
-
-    new_full_paz_e = analyze_cal_component(full_paz_tpl.east,
-                                          lf_paz_pert_map, hf_paz_pert_map,
-                                          samp_rate_lf, samp_rate_hf, operating_sample_rate,
-                                          lfinput.east, hfinput.east,
-                                          lfmeas.east, hfmeas.east)
-
-    logging.debug('Analyzing cal data and calculating new EAST response complete.')
+    lf_band, hf_band = cal_fit_bands(operating_sample_rate)
+
+    # inputs shared between components are only transformed once
+    logging.debug('Computing coherence for all components...')
+    lf_cross = cross_correlate_components(samp_rate_lf, lfinput, lfmeas, band=lf_band, workspace=workspace)
+    hf_cross = cross_correlate_components(samp_rate_hf, hfinput, hfmeas, band=hf_band, workspace=workspace)
+    logging.debug('Computing coherence for all components complete.')
+
+    start_paz_tpl = None
+    if history is not None:
+        # only calibrations before this one, so reprocessing a run does not warm start from its own result
+        start_paz_tpl = ComponentsTpl(*[history.latest(sta, loc, getattr(chancodes, comp), sensor_serial, seis_model,
+                                                       before=hf_start_time.timestamp)
+                                        for comp in ComponentsTpl._fields])
+        logging.info('Warm starting fits from calibration history for: {}'.format(
+            [comp for comp in ComponentsTpl._fields if getattr(start_paz_tpl, comp) is not None]))
+
+    # LF and HF fits of all components are independent and run concurrently, in one pool that also serves the
+    # bootstrap refits
+    logging.debug('Analyzing cal data and calculating new responses...')
+
+    fit_diags = []
+    replicates_tpl = None
+    executor = ProcessPoolExecutor(max_workers=max_workers) if max_workers != 1 else None
+    try:
+        new_full_paz_tpl = analyze_cal_components(full_paz_tpl,
+                                                  lf_paz_pert_map, hf_paz_pert_map,
+                                                  operating_sample_rate,
+                                                  lf_cross, hf_cross,
+                                                  executor=executor,
+                                                  fit_stages=fit_stages,
+                                                  fit_starts=fit_starts,
+                                                  seed=seed,
+                                                  start_paz_tpl=start_paz_tpl,
+                                                  paz_shared_maps=paz_shared_maps,
+                                                  diagnostics=fit_diags)
+
+        if bootstrap_cnt > 0:
+            logging.info('Estimating fit uncertainties from {} bootstrap replicates...'.format(bootstrap_cnt))
+            replicates_tpl = bootstrap_cal_components(full_paz_tpl, new_full_paz_tpl,
+                                                      lf_paz_pert_map, hf_paz_pert_map,
+                                                      operating_sample_rate,
+                                                      lf_cross, hf_cross,
+                                                      replicate_cnt=bootstrap_cnt,
+                                                      executor=executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    new_full_paz_v = new_full_paz_tpl.vertical
+    new_full_paz_n = new_full_paz_tpl.north
+    new_full_paz_e = new_full_paz_tpl.east
+
+    logging.debug('Analyzing cal data and calculating new responses complete.')
 
     # lets find "nice" number for resp length: i.e. a multiple of 20 * sample rate. So 0.05 and 1 hz in freqs exactly.
     resp_len = ((hfinput.vertical.size * 2) // (20 * operating_sample_rate)) * (20 * operating_sample_rate)
     freqs, _ = linspace(0, operating_sample_rate/2, resp_len+1, retstep=True)  # must start with 0hz
+    freqs = FrequencyGrid(freqs)
     # resp_len = ((hfinput.size * 2) // (20 * 20)) * (20 * 20)
     # freqs = linspace(0, 20, resp_len)  # must start with 0hz
 
@@ -187,8 +287,7 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
 
     # sens X_resp responses normed at 0.05hz, need to get resp at 1hz
     # find 1hz bin
-    #todo: find the better way
-    bin_1hz_ndx = min([freq[0] for freq in enumerate(freqs) if freq[1] >= 1.0])
+    bin_1hz_ndx = freqs.index_at_or_above(1.0)
     n_sys_sens = nominal_sys_sens_1hz(n_resp[bin_1hz_ndx], seis_model)
     e_sys_sens = nominal_sys_sens_1hz(e_resp[bin_1hz_ndx], seis_model)
     v_sys_sens = nominal_sys_sens_1hz(v_resp[bin_1hz_ndx], seis_model)
@@ -201,14 +300,57 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
     logging.debug('Finding sensitivities @ 1hz... complete.')
 
     logging.debug('Finding A0 at 1hz...')
-    resp_1hz = compute_response(1.0, new_full_paz_v)
-    v_a0 = 1/abs(resp_1hz[0])
-    resp_1hz = compute_response(1.0, new_full_paz_n)
-    n_a0 = 1/abs(resp_1hz[0])
-    resp_1hz = compute_response(1.0, new_full_paz_e)
-    e_a0 = 1/abs(resp_1hz[0])
+    resp_1hz = compute_responses(1.0, [new_full_paz_v, new_full_paz_n, new_full_paz_e])
+    v_a0, n_a0, e_a0 = 1/abs(resp_1hz[:, 0])
     logging.debug('Finding A0 at 1hz complete.')
 
+    bootstrap_diags = {}
+    if replicates_tpl is not None:
+        pert_poles = sorted(set(lf_paz_pert_map[0] + hf_paz_pert_map[0]))
+        pert_zeros = sorted(set(lf_paz_pert_map[1] + hf_paz_pert_map[1]))
+        for comp in ComponentsTpl._fields:
+            replicates = getattr(replicates_tpl, comp)
+            fitted_paz = getattr(new_full_paz_tpl, comp)
+
+            # bias corrected intervals around the fitted values, with the bootstrap bias of each
+            estimates = {'A0': 1 / abs(compute_responses(1.0, [fitted_paz])[0, 0]),
+                         'CALIB': sys_sens_calibs([fitted_paz], seis_model)[0],
+                         'poles': fitted_paz.poles()[pert_poles],
+                         'zeros': fitted_paz.zeros()[pert_zeros]}
+            samples = {'A0': 1 / abs(compute_responses(1.0, replicates)[:, 0]),
+                       'CALIB': sys_sens_calibs(replicates, seis_model),
+                       'poles': [paz.poles()[pert_poles] for paz in replicates],
+                       'zeros': [paz.zeros()[pert_zeros] for paz in replicates]}
+            a0_lo, a0_hi = percentile_intervals(samples['A0'], estimate=estimates['A0'])
+            calib_lo, calib_hi = percentile_intervals(samples['CALIB'], estimate=estimates['CALIB'])
+            poles_lo, poles_hi = percentile_intervals(samples['poles'], estimate=estimates['poles'])
+            zeros_lo, zeros_hi = percentile_intervals(samples['zeros'], estimate=estimates['zeros'])
+            a0_bias = bootstrap_bias(samples['A0'], estimates['A0'])
+            calib_bias = bootstrap_bias(samples['CALIB'], estimates['CALIB'])
+            poles_bias = bootstrap_bias(samples['poles'], estimates['poles'])
+            zeros_bias = bootstrap_bias(samples['zeros'], estimates['zeros'])
+            logging.info('{} 95% intervals: A0 [{}, {}] bias {}, CALIB [{}, {}] bias {}'.format(
+                getattr(chancodes, comp), a0_lo, a0_hi, a0_bias, calib_lo, calib_hi, calib_bias))
+            logging.info('{} 95% intervals: poles {} [{}, {}] bias {}, zeros {} [{}, {}] bias {}'.format(
+                getattr(chancodes, comp), pert_poles, poles_lo, poles_hi, poles_bias,
+                pert_zeros, zeros_lo, zeros_hi, zeros_bias))
+            bootstrap_diags[getattr(chancodes, comp)] = {
+                'replicates': bootstrap_cnt,
+                'A0': [float(a0_lo), float(a0_hi)],
+                'A0_bias': float(a0_bias),
+                'CALIB': [float(calib_lo), float(calib_hi)],
+                'CALIB_bias': float(calib_bias),
+                'poles': {str(ndx): [[float(lo.real), float(lo.imag)], [float(hi.real), float(hi.imag)]]
+                          for ndx, lo, hi in zip(pert_poles, poles_lo, poles_hi)},
+                'poles_bias': {str(ndx): [float(bias.real), float(bias.imag)]
+                               for ndx, bias in zip(pert_poles, poles_bias)},
+                'zeros': {str(ndx): [[float(lo.real), float(lo.imag)], [float(hi.real), float(hi.imag)]]
+                          for ndx, lo, hi in zip(pert_zeros, zeros_lo, zeros_hi)},
+                'zeros_bias': {str(ndx): [float(bias.real), float(bias.imag)]
+                               for ndx, bias in zip(pert_zeros, zeros_bias)},
+            }
+        logging.info('Estimating fit uncertainties from {} bootstrap replicates complete.'.format(bootstrap_cnt))
+
     # logging.debug('Reprocessing with new response for snr analysis...')
     # # read, trim, transpose, invert and convolve input with response
     # samp_rate_lf, lf_start_time, lfinput, lfmeas, \
@@ -233,17 +375,27 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
         vert_inspec = 'NO'
 
     logging.debug('Computing IN_SPEC status... complete')
+
+    if history is not None:
+        inspec_tpl = ComponentsTpl(north=north_inspec, east=east_inspec, vertical=vert_inspec)
+        for comp in ComponentsTpl._fields:
+            history.add(sta, loc, getattr(chancodes, comp), sensor_serial, seis_model,
+                        getattr(new_full_paz_tpl, comp), cal_time=hf_start_time.timestamp,
+                        accepted=getattr(inspec_tpl, comp) == 'YES')
     logging.debug('Creating result tuples...')
 
     vert_chan_result = ida.ctbto.messages.CTBTChannelResult(channel=chancodes.vertical, calib=v_sys_sens, calper=1.0,
                                                         sample_rate=40.0,
-                                                        in_spec=vert_inspec, paz=new_full_paz_v, A0=v_a0)
+                                                        in_spec=vert_inspec, paz=new_full_paz_v, A0=v_a0,
+                                                        intervals=bootstrap_diags.get(chancodes.vertical))
     north_chan_result = ida.ctbto.messages.CTBTChannelResult(channel=chancodes.north, calib=n_sys_sens, calper=1.0,
                                                              sample_rate=40.0,
-                                                             in_spec=north_inspec, paz=new_full_paz_n, A0=n_a0)
+                                                             in_spec=north_inspec, paz=new_full_paz_n, A0=n_a0,
+                                                             intervals=bootstrap_diags.get(chancodes.north))
     east_chan_result = ida.ctbto.messages.CTBTChannelResult(channel=chancodes.east, calib=e_sys_sens, calper=1.0,
                                                         sample_rate=40.0,
-                                                        in_spec=east_inspec, paz=new_full_paz_e, A0=e_a0)
+                                                        in_spec=east_inspec, paz=new_full_paz_e, A0=e_a0,
+                                                        intervals=bootstrap_diags.get(chancodes.east))
     logging.debug('Creating result tuples... complete.')
 
     report_files_basename = os.path.splitext(lf_fnames[0])[0].replace('rblf-', '')
@@ -285,6 +437,20 @@ def process_qcal_data(sta, chancodes, loc, data_dir, lf_fnames, hf_fnames, seis_
     logging.debug(calres_msg)
     logging.info('Generating IMS 2.0 messages... complete.')
 
+    # optimizer diagnostics for tracking fit performance across stations
+    fit_diag_fn = os.path.join(data_dir, report_files_basename + '_FITDIAG.json')
+    with open(fit_diag_fn, 'wt') as ofl:
+        json.dump({'sta': sta,
+                   'loc': loc,
+                   'seis_model': seis_model,
+                   'cal_time': str(hf_start_time),
+                   'channels': dict(zip(ComponentsTpl._fields, [getattr(chancodes, comp)
+                                                                for comp in ComponentsTpl._fields])),
+                   'fits': fit_diags,
+                   'bootstrap': bootstrap_diags},
+                  ofl, indent=2)
+    logging.info('Fit diagnostics written to: ' + fit_diag_fn)
+
     return ims_calres_txt_fn, amp_fn, pha_fn
 
 
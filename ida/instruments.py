@@ -39,6 +39,7 @@ from numpy import sqrt
             a) Set embedded nominal full response file
             b) Set Fitting poles/zeros indices into full response paz
             c) Set (default) perturbing poles/zeros indices into full response paz
+            d) Set perturbed poles/zeros indices shared by all components in joint fits
         7) Add model entry to INSRTUMENT_NOMINAL_GAINS dict
         8) Add model entry to Q330_GCALIB_FOR_SEIS (for Q330 <=> sensor impedance adjustment)
 """
@@ -127,6 +128,8 @@ STS2_5_UVW2ENZ_ABS = [
 # indices are for python ZERO-based arrays
 # 'fit' indices are into FULL response PAZ
 # 'perturb' indices are into FULL response PAZ
+# 'shared' indices are into FULL response PAZ, a subset of 'perturb' fit in common for all components when
+#     components are fit jointly
 SEISMOMETER_RESPONSES = {
     SEISTYPE_STS25 : {
         'full_resp_file': SEISTYPE_STS25 + "_full.ida",
@@ -142,6 +145,12 @@ SEISMOMETER_RESPONSES = {
             'hf_poles': [4,5],
             'hf_zeros': [],
         },
+        'shared': {
+            'lf_poles': [0,1],
+            'lf_zeros': [],
+            'hf_poles': [],
+            'hf_zeros': [],
+        },
     },
     SEISTYPE_STS25F : {
         'full_resp_file': SEISTYPE_STS25 + "_full.ida",
@@ -157,6 +166,12 @@ SEISMOMETER_RESPONSES = {
             'hf_poles': [4,5],
             'hf_zeros': [],
         },
+        'shared': {
+            'lf_poles': [0,1],
+            'lf_zeros': [],
+            'hf_poles': [],
+            'hf_zeros': [],
+        },
     },
 }
 
@@ -0,0 +1,247 @@
+#######################################################################################################################
+# Copyright (C) 2016  Regents of the University of California
+#
+# This is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License (GNU GPL) as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# A copy of the GNU General Public License can be found in LICENSE.TXT in the root of the source code repository.
+# Additionally, it can be found at http://www.gnu.org/licenses/.
+#
+# NOTES: Per GNU GPLv3 terms:
+#   * This notice must be kept in this source file
+#   * Changes to the source must be clearly noted with date & time of change
+#
+# If you use this software in a product, an explicit acknowledgment in the product documentation of the contribution
+# by Project IDA, Institute of Geophysics and Planetary Physics, UCSD would be appreciated but is not required.
+#######################################################################################################################
+
+import logging
+from numpy import empty, zeros, dtype as np_dtype
+import numpy.fft as numpy_fft
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+"""FFT backend and reusable transform workspace for the calibration spectral routines.
+
+The module level fft(), ifft(), rfft() and irfft() functions take the same leading arguments as their
+numpy.fft counterparts plus an optional FFTWorkspace. Without a workspace they call numpy.fft directly.
+"""
+
+FFT_BACKEND_NUMPY = 'numpy'
+FFT_BACKEND_SCIPY = 'scipy'
+FFT_BACKENDS = [FFT_BACKEND_NUMPY, FFT_BACKEND_SCIPY]
+
+
+class FFTWorkspace(object):
+    """
+    Preallocated transform buffers and FFT backend shared by a batch of spectral computations.
+
+    Buffers are cached by (length, dtype, key), so repeated transforms of the same length (e.g. the
+    components of a calibration, or the segments of a streamed record) reuse the same memory, and
+    the backend's internal plan/twiddle cache is hit for every transform after the first. A buffer
+    is only valid until the next request for the same (length, dtype, key).
+
+    The scipy.fft backend is used when available, and can run each transform on several worker threads.
+    """
+
+    def __init__(self, workers=None, backend=None):
+        """
+        :param workers: Worker threads per transform (scipy.fft backend only). None for backend default,
+            negative values count back from the number of CPUs as in scipy.fft.
+        :type workers: int
+        :param backend: FFT_BACKEND_SCIPY or FFT_BACKEND_NUMPY. Default: scipy.fft if installed, else numpy.fft.
+        :type backend: str
+        """
+
+        if backend is None:
+            backend = FFT_BACKEND_SCIPY if scipy_fft is not None else FFT_BACKEND_NUMPY
+
+        if backend not in FFT_BACKENDS:
+            msg = "Invalid FFT backend: '{}'. Valid values: {}".format(backend, FFT_BACKENDS)
+            logging.error(msg)
+            raise ValueError(msg)
+
+        if (backend == FFT_BACKEND_SCIPY) and (scipy_fft is None):
+            msg = 'scipy.fft is not available (requires scipy >= 1.4). Use FFT_BACKEND_NUMPY.'
+            logging.error(msg)
+            raise ValueError(msg)
+
+        if (workers is not None) and (backend == FFT_BACKEND_NUMPY):
+            logging.debug('FFT workers ignored by numpy.fft backend.')
+
+        self.backend = backend
+        self.workers = workers
+        self._buffers = {}
+
+    @property
+    def nbytes(self):
+        """Total size of cached buffers in bytes."""
+        return sum([buf.nbytes for buf in self._buffers.values()])
+
+    def clear(self):
+        """Release all cached buffers."""
+        self._buffers.clear()
+
+    def empty(self, length, dtype, key=None):
+        """Cached uninitialized buffer.
+
+        :param length: Buffer length, or shape of an N-D buffer
+        :type length: int or (int, ...)
+        :param dtype: Buffer dtype
+        :type dtype: numpy.dtype
+        :param key: Distinguishes buffers of the same length and dtype that are needed at the same time
+        :type key: str
+        :return: Buffer
+        :rtype: ndarray
+        """
+
+        shape = tuple([int(dim) for dim in length]) if isinstance(length, tuple) else int(length)
+        buf_key = (shape, np_dtype(dtype), key)
+        buf = self._buffers.get(buf_key)
+        if buf is None:
+            buf = empty(shape, dtype=dtype)
+            self._buffers[buf_key] = buf
+
+        return buf
+
+    def zeros(self, length, dtype, key=None):
+        """Cached 1-D buffer filled with zeros. See empty()."""
+
+        buf = self.empty(length, dtype, key=key)
+        buf.fill(0)
+
+        return buf
+
+    def padded(self, x, length, key='padded'):
+        """x copied into the start of a cached buffer of the given length with the remainder zeroed.
+
+        :param x: 1-D data, len(x) <= length
+        :type x: ndarray
+        :param length: Padded length
+        :type length: int
+        :param key: Buffer key. See empty()
+        :type key: str
+        :return: Padded buffer
+        :rtype: ndarray
+        """
+
+        buf = self.empty(length, x.dtype, key=key)
+        buf[:x.size] = x
+        buf[x.size:] = 0
+
+        return buf
+
+    def _transform(self, name, x, n):
+
+        if self.backend == FFT_BACKEND_SCIPY:
+            return getattr(scipy_fft, name)(x, n, workers=self.workers)
+        else:
+            return getattr(numpy_fft, name)(x, n)
+
+    def fft(self, x, n=None):
+        """Complex FFT of 1-D x, zero padded to n in a workspace buffer if n > len(x)."""
+
+        if (n is not None) and (n > x.size):
+            x = self.padded(x, n, key='fft')
+        return self._transform('fft', x, n)
+
+    def ifft(self, x, n=None):
+        """Inverse complex FFT of 1-D x."""
+
+        return self._transform('ifft', x, n)
+
+    def rfft(self, x, n=None):
+        """Real input FFT of 1-D x, zero padded to n in a workspace buffer if n > len(x)."""
+
+        if (n is not None) and (n > x.size):
+            x = self.padded(x, n, key='rfft')
+        return self._transform('rfft', x, n)
+
+    def irfft(self, x, n=None):
+        """Inverse of rfft() with n output points, along the last axis of x."""
+
+        return self._transform('irfft', x, n)
+
+
+def fft(x, n=None, workspace=None):
+    """numpy.fft.fft(), or workspace.fft() if workspace is given."""
+
+    if workspace is None:
+        return numpy_fft.fft(x, n)
+    return workspace.fft(x, n)
+
+
+def ifft(x, n=None, workspace=None):
+    """numpy.fft.ifft(), or workspace.ifft() if workspace is given."""
+
+    if workspace is None:
+        return numpy_fft.ifft(x, n)
+    return workspace.ifft(x, n)
+
+
+def rfft(x, n=None, workspace=None):
+    """numpy.fft.rfft(), or workspace.rfft() if workspace is given."""
+
+    if workspace is None:
+        return numpy_fft.rfft(x, n)
+    return workspace.rfft(x, n)
+
+
+def irfft(x, n=None, workspace=None):
+    """numpy.fft.irfft(), or workspace.irfft() if workspace is given."""
+
+    if workspace is None:
+        return numpy_fft.irfft(x, n)
+    return workspace.irfft(x, n)
+
+
+def empty_buffer(length, dtype, key, workspace=None):
+    """Uninitialized array of the given length or shape, from workspace if given. See FFTWorkspace.empty()"""
+
+    if workspace is None:
+        return empty(length, dtype=dtype)
+    return workspace.empty(length, dtype, key=key)
+
+
+def zeros_buffer(length, dtype, key, workspace=None):
+    """Zero filled array of the given length or shape, from workspace if given. See FFTWorkspace.zeros()"""
+
+    if workspace is None:
+        return zeros(length, dtype=dtype)
+    return workspace.zeros(length, dtype, key=key)
+
+
+def next_fast_len(target):
+    """Smallest 5-smooth integer (2**a * 3**b * 5**c) >= target. FFTs are efficient at these lengths.
+
+    :param target: Minimum transform length
+    :type target: int
+    :return: Fast transform length
+    :rtype: int
+    """
+
+    if target <= 6:
+        return max(1, int(target))
+
+    best = 2 ** (int(target - 1).bit_length())
+    pow5 = 1
+    while pow5 < best:
+        pow35 = pow5
+        while pow35 < best:
+            # smallest power of 2 multiple of pow35 that reaches target
+            quotient = -(-target // pow35)
+            candidate = pow35 * 2 ** (int(quotient - 1).bit_length())
+            if candidate == target:
+                return candidate
+            best = min(best, candidate)
+            pow35 *= 3
+        pow5 *= 5
+
+    return best
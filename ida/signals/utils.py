@@ -22,11 +22,14 @@
 
 import logging
 import copy
+import hashlib
+from collections import OrderedDict
 from ida.signals.trace import IDATrace
 from scipy.signal import freqs
 from scipy.signal.ltisys import zpk2tf
-from numpy import array, ndarray, isclose, abs, divide, multiply, pi
-from numpy.fft import rfft
+from numpy import array, ndarray, isclose, abs, divide, multiply, pi, asarray, zeros as npzeros, complex128, \
+    float64, ascontiguousarray, searchsorted, diff, log, allclose, ceil, exp, newaxis, errstate, empty, ones, copyto
+from ida.signals.fft import rfft
 import ida.calibration.qcal_utils
 from ida.instruments import SEIS_INVERT_CAL_CHAN, SEIS_INVERT_NORTH_CHAN, SEIS_INVERT_EAST_CHAN
 import ida.signals.paz
@@ -36,6 +39,18 @@ TAPER_TYPES = [
     'tukey'
 ]
 
+# default ResponseCache size limit
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+
+# frequencies evaluated per block by compute_response_zpk(), bounding the (root x frequency) temporaries
+RESPONSE_CHUNK_SIZE = 4096
+
+# (PAZ x root x frequency) elements per stacked evaluation in iter_responses(), about 1 MB of complex128
+RESPONSE_BLOCK_ELEMENTS = 65536
+
+# relative tolerance on bin spacing for a FrequencyGrid to be treated as uniform or log-spaced
+FREQ_GRID_SPACING_RTOL = 1e-9
+
 def check_and_fix_polarities(strm, seis_model):
 
     for tr in strm:
@@ -103,8 +118,351 @@ def ntrim_stream(traces, left=0, right=0):
         trace.trim(left, right)
 
 
+class FrequencyGrid(object):
+    """
+    Ascending frequency list that knows whether it is uniform (e.g. rfft bins) or log-spaced, caches
+    2*pi*f and j*2*pi*f, and finds bins in O(1) (uniform, log-spaced) or O(log n) (otherwise).
+
+    Accepted wherever the response and normalization helpers take a frequency list.
+    """
+
+    def __init__(self, freqlist):
+        """
+        :param freqlist: Ascending frequencies in hz
+        :type freqlist: ndarray or list
+        """
+
+        freqs = array(freqlist, dtype=float64, ndmin=1)
+        if freqs.ndim != 1:
+            msg = 'FrequencyGrid frequencies must be one dimensional.'
+            logging.error(msg)
+            raise ValueError(msg)
+
+        steps = diff(freqs)
+        if (steps < 0).any():
+            msg = 'FrequencyGrid frequencies must be ascending.'
+            logging.error(msg)
+            raise ValueError(msg)
+
+        freqs.setflags(write=False)
+        self.freqs = freqs
+        self.step = None
+        self.log_step = None
+        if freqs.size > 1 and steps[0] > 0:
+            if allclose(steps, steps[0], rtol=FREQ_GRID_SPACING_RTOL, atol=0):
+                self.step = (freqs[-1] - freqs[0]) / (freqs.size - 1)
+            elif freqs[0] > 0:
+                log_steps = diff(log(freqs))
+                if allclose(log_steps, log_steps[0], rtol=FREQ_GRID_SPACING_RTOL, atol=0):
+                    self.log_step = (log(freqs[-1]) - log(freqs[0])) / (freqs.size - 1)
+
+        self._omega = None
+        self._jomega = None
+        self._fingerprint = None
+
+    def __len__(self):
+        return self.freqs.size
+
+    def __getitem__(self, ndx):
+        return self.freqs[ndx]
+
+    def __array__(self, dtype=None, copy=None):
+        # copy: True always copies, None copies only for a dtype change, False never copies (numpy 2 protocol)
+        needs_copy = dtype is not None and self.freqs.dtype != dtype
+        if copy is False and needs_copy:
+            msg = 'FrequencyGrid frequencies can not be converted to {} without a copy.'.format(dtype)
+            logging.error(msg)
+            raise ValueError(msg)
+        if copy or needs_copy:
+            return self.freqs.astype(self.freqs.dtype if dtype is None else dtype)
+        return self.freqs
+
+    @property
+    def size(self):
+        return self.freqs.size
+
+    @property
+    def uniform(self):
+        return self.step is not None
+
+    @property
+    def log_spaced(self):
+        return self.log_step is not None
+
+    @property
+    def omega(self):
+        """2*pi*f, computed once."""
+        if self._omega is None:
+            self._omega = self.freqs * (2 * pi)
+            self._omega.setflags(write=False)
+        return self._omega
+
+    @property
+    def jomega(self):
+        """j*2*pi*f, computed once."""
+        if self._jomega is None:
+            self._jomega = self.omega * 1j
+            self._jomega.setflags(write=False)
+        return self._jomega
+
+    @property
+    def fingerprint(self):
+        """Cache key of the grid, computed once: its size, end points and spacing if uniform or log-spaced,
+        else freqs_fingerprint() of the frequencies."""
+        if self._fingerprint is None:
+            if self.uniform:
+                self._fingerprint = 'uniform|{}|{!r}|{!r}|{!r}'.format(self.freqs.size, float(self.freqs[0]),
+                                                                       float(self.freqs[-1]), float(self.step))
+            elif self.log_spaced:
+                self._fingerprint = 'log|{}|{!r}|{!r}|{!r}'.format(self.freqs.size, float(self.freqs[0]),
+                                                                   float(self.freqs[-1]), float(self.log_step))
+            else:
+                self._fingerprint = freqs_fingerprint(self.freqs)
+        return self._fingerprint
+
+    def _estimate_index(self, freq):
+
+        if self.uniform:
+            return int(ceil((freq - self.freqs[0]) / self.step))
+        elif self.log_spaced and freq > 0:
+            return int(ceil((log(freq) - log(self.freqs[0])) / self.log_step))
+        else:
+            return None
+
+    def index_at_or_above(self, freq):
+        """Index of the first frequency >= freq, or size if there is none.
+
+        :param freq: Frequency in hz
+        :type freq: float
+        :return: Index into the grid
+        :rtype: int
+        """
+
+        freqs = self.freqs
+        ndx = self._estimate_index(freq)
+        if ndx is None or ndx <= 0:
+            return 0 if freq <= freqs[0] else int(searchsorted(freqs, freq, side='left'))
+        if ndx >= freqs.size:
+            return freqs.size if freq > freqs[-1] else int(searchsorted(freqs, freq, side='left'))
+
+        # the estimate can be off by one from rounding in the spacing
+        if freqs[ndx] < freq:
+            ndx += 1
+        elif freqs[ndx - 1] >= freq:
+            ndx -= 1
+        return ndx
+
+    def nearest_index(self, freq):
+        """Index of the frequency nearest to freq.
+
+        :param freq: Frequency in hz
+        :type freq: float
+        :return: Index into the grid
+        :rtype: int
+        """
+
+        ndx = self.index_at_or_above(freq)
+        if ndx == self.freqs.size:
+            return ndx - 1
+        if ndx > 0 and (freq - self.freqs[ndx - 1]) <= (self.freqs[ndx] - freq):
+            return ndx - 1
+        return ndx
+
+
+def frequency_grid(freqlist):
+    """freqlist as a FrequencyGrid, returned as is if it already is one.
+
+    :param freqlist: Ascending frequencies in hz
+    :type freqlist: FrequencyGrid or ndarray
+    :rtype: FrequencyGrid
+    """
+
+    if isinstance(freqlist, FrequencyGrid):
+        return freqlist
+    return FrequencyGrid(freqlist)
+
+
+def frequency_index(freqlist, freq):
+    """Index of the first of the ascending freqlist >= freq.
+
+    :param freqlist: Ascending frequencies in hz
+    :type freqlist: FrequencyGrid or ndarray
+    :param freq: Frequency in hz
+    :type freq: float
+    :return: Index into freqlist
+    :rtype: int
+    """
+
+    if isinstance(freqlist, FrequencyGrid):
+        ndx = freqlist.index_at_or_above(freq)
+        size = freqlist.size
+    else:
+        freqlist = asarray(freqlist)
+        ndx = int(searchsorted(freqlist, freq, side='left'))
+        size = freqlist.size
+
+    if ndx == size:
+        msg = 'Frequency {} is above all frequencies.'.format(freq)
+        logging.error(msg)
+        raise ValueError(msg)
+
+    return ndx
+
+
 def compute_response(freqlist, paz, mode='vel'):
 
+    return compute_response_zpk(freqlist, paz, mode=mode)
+
+
+def compute_response_zpk(freqlist, paz, mode='vel', chunk_size=RESPONSE_CHUNK_SIZE, log_accumulate=False):
+    """Response of paz evaluated directly in factored form, h0 * prod(s - z) / prod(s - p) with s = 2*pi*j*f.
+
+    Avoids expanding the roots into polynomial coefficients, which loses precision for responses with many
+    poles and zeros. Frequencies are evaluated in blocks of chunk_size against all roots at once, as
+    (root x frequency) arrays reduced over the roots.
+
+    :param freqlist: Frequencies in hz
+    :type freqlist: FrequencyGrid or ndarray
+    :param paz: Response
+    :type paz: PAZ
+    :param mode: Units to use when computing the response
+    :type mode: str ['disp', 'vel', 'acc']
+    :param chunk_size: Number of frequencies per block
+    :type chunk_size: int
+    :param log_accumulate: Accumulate log(s - z) - log(s - p) instead of products. Slower, but can not
+        overflow or underflow for very high order responses.
+    :type log_accumulate: bool
+    :return: Complex response at freqlist
+    :rtype: ndarray
+    """
+
+    if isinstance(freqlist, float) or isinstance(freqlist, int):
+        freqlist = array([freqlist])
+
+    if isinstance(freqlist, FrequencyGrid):
+        s = freqlist.jomega
+    else:
+        s = 2j * pi * asarray(freqlist, dtype=float64).reshape(-1)
+
+    zeros = paz.zeros(units='rad', mode=mode)[:, newaxis]
+    poles = paz.poles(units='rad', mode=mode)[:, newaxis]
+    gain = asarray(paz.h0, dtype=float64).flat[0]
+
+    h = empty(s.size, dtype=complex128)
+    for lo in range(0, s.size, max(1, chunk_size)):
+        s_blk = s[newaxis, lo:lo + chunk_size]
+        if log_accumulate:
+            # log(0) at a root on the frequency axis gives exp(-inf) == 0, as the product form does
+            with errstate(divide='ignore'):
+                log_h = log(s_blk - zeros).sum(axis=0) - log(s_blk - poles).sum(axis=0)
+            h[lo:lo + chunk_size] = gain * exp(log_h)
+        else:
+            h[lo:lo + chunk_size] = gain * (s_blk - zeros).prod(axis=0) / (s_blk - poles).prod(axis=0)
+
+    return h
+
+
+def _stack_roots(roots_list):
+    """(len(roots_list) x max root count) array of the roots, the root counts, and a mask of the padded entries."""
+
+    root_cnts = array([roots.size for roots in roots_list], dtype=int)
+    stacked = npzeros((len(roots_list), root_cnts.max() if root_cnts.size else 0), dtype=complex128)
+    padded = ones(stacked.shape, dtype=bool)
+    for ndx, roots in enumerate(roots_list):
+        stacked[ndx, :roots.size] = roots
+        padded[ndx, :roots.size] = False
+
+    return stacked[:, :, newaxis], root_cnts, padded[:, :, newaxis]
+
+
+def _stacked_factors(s_blk, roots, root_cnts, padded):
+    """Product over the roots of (s - root) for a group of stacked PAZ, with padded factors set to 1."""
+
+    root_cnt = root_cnts.max()
+    factors = s_blk - roots[:, :root_cnt]
+    if root_cnts.min() < root_cnt:
+        copyto(factors, 1.0, where=padded[:, :root_cnt])
+
+    return factors.prod(axis=1)
+
+
+def iter_responses(freqlist, paz_list, mode='vel', chunk_size=RESPONSE_CHUNK_SIZE):
+    """Responses of each of paz_list, streamed in blocks of chunk_size frequencies.
+
+    Poles and zeros of all the PAZ are stacked into (PAZ x root) arrays, padded to the largest root counts, and
+    evaluated in factored form as in compute_response_zpk() with padded factors set to 1. PAZ are evaluated
+    together in groups whose (PAZ x root x frequency) temporaries fit RESPONSE_BLOCK_ELEMENTS: many PAZ at a
+    few frequencies go in one evaluation, while dense blocks fall back to one PAZ at a time, which is faster
+    than one large, out of cache, evaluation.
+
+    :param freqlist: Frequencies in hz
+    :type freqlist: FrequencyGrid or ndarray
+    :param paz_list: Responses, with any number of poles and zeros
+    :type paz_list: [PAZ]
+    :param mode: Units to use when computing the responses
+    :type mode: str ['disp', 'vel', 'acc']
+    :param chunk_size: Number of frequencies per block
+    :type chunk_size: int
+    :return: Generator of (start index, (len(paz_list) x block size) complex responses)
+    :rtype: generator
+    """
+
+    if isinstance(freqlist, float) or isinstance(freqlist, int):
+        freqlist = array([freqlist])
+
+    if isinstance(freqlist, FrequencyGrid):
+        s = freqlist.jomega
+    else:
+        s = 2j * pi * asarray(freqlist, dtype=float64).reshape(-1)
+
+    zeros, zero_cnts, zeros_padded = _stack_roots([paz.zeros(units='rad', mode=mode) for paz in paz_list])
+    poles, pole_cnts, poles_padded = _stack_roots([paz.poles(units='rad', mode=mode) for paz in paz_list])
+    gains = array([asarray(paz.h0, dtype=float64).flat[0] for paz in paz_list])[:, newaxis]
+
+    chunk_size = max(1, chunk_size)
+    root_cnt = max(1, zeros.shape[1] + poles.shape[1])
+    for lo in range(0, s.size, chunk_size):
+        s_blk = s[newaxis, newaxis, lo:lo + chunk_size]
+        group_size = max(1, RESPONSE_BLOCK_ELEMENTS // (root_cnt * s_blk.size))
+
+        resp_blk = empty((len(paz_list), s_blk.size), dtype=complex128)
+        for g_lo in range(0, len(paz_list), group_size):
+            grp = slice(g_lo, g_lo + group_size)
+            resp_blk[grp] = gains[grp] * _stacked_factors(s_blk, zeros[grp], zero_cnts[grp], zeros_padded[grp]) / \
+                _stacked_factors(s_blk, poles[grp], pole_cnts[grp], poles_padded[grp])
+
+        yield lo, resp_blk
+
+
+def compute_responses(freqlist, paz_list, mode='vel', chunk_size=RESPONSE_CHUNK_SIZE):
+    """Responses of each of paz_list at freqlist, evaluated together by iter_responses().
+
+    :param freqlist: Frequencies in hz
+    :type freqlist: FrequencyGrid or ndarray
+    :param paz_list: Responses, with any number of poles and zeros
+    :type paz_list: [PAZ]
+    :param mode: Units to use when computing the responses
+    :type mode: str ['disp', 'vel', 'acc']
+    :param chunk_size: Number of frequencies per block
+    :type chunk_size: int
+    :return: (len(paz_list) x len(freqlist)) complex responses
+    :rtype: ndarray
+    """
+
+    if isinstance(freqlist, float) or isinstance(freqlist, int):
+        freqlist = array([freqlist])
+
+    resps = empty((len(paz_list), len(freqlist)), dtype=complex128)
+    for lo, resp_blk in iter_responses(freqlist, paz_list, mode=mode, chunk_size=chunk_size):
+        resps[:, lo:lo + resp_blk.shape[1]] = resp_blk
+
+    return resps
+
+
+def compute_response_tf(freqlist, paz, mode='vel'):
+    """Reference response of paz via zpk2tf() polynomial coefficients and scipy.signal.freqs(), as used before
+    compute_response_zpk(). Kept for benchmarking."""
+
     if isinstance(freqlist, float) or isinstance(freqlist, int):
         freqlist = array([freqlist])
 
@@ -116,30 +474,162 @@ def compute_response(freqlist, paz, mode='vel'):
     if not isinstance(a, ndarray) and a == 1.0:
         a = [1.0]
 
-    _, h = freqs(b, a, freqlist * 2 * pi)
+    if isinstance(freqlist, FrequencyGrid):
+        _, h = freqs(b, a, freqlist.omega)
+    else:
+        _, h = freqs(b, a, freqlist * 2 * pi)
 
     return h
 
 
-def compute_response_fir(fir_coeffs, fft_len):
+def paz_fingerprint(paz):
+    """Digest of the content of a PAZ: poles, zeros, h0, mode and units.
+
+    :param paz: Response
+    :type paz: PAZ
+    :return: Hex digest
+    :rtype: str
+    """
+
+    digest = hashlib.sha1()
+    digest.update(asarray(paz._poles, dtype=complex128).tobytes())
+    digest.update(b'|')
+    digest.update(asarray(paz._zeros, dtype=complex128).tobytes())
+    digest.update(b'|')
+    digest.update(asarray(paz.h0, dtype=float64).tobytes())
+    digest.update('|{}|{}'.format(paz.mode, paz.units).encode())
+
+    return digest.hexdigest()
+
+
+def freqs_fingerprint(freqlist):
+    """Digest of the content of a frequency grid. Arrays are hashed whole on every call, FrequencyGrid
+    fingerprints are computed once and are O(1) for uniform and log-spaced grids.
+
+    :param freqlist: Frequencies
+    :type freqlist: FrequencyGrid or ndarray
+    :return: Hex digest
+    :rtype: str
+    """
+
+    if isinstance(freqlist, FrequencyGrid):
+        return freqlist.fingerprint
+
+    freqlist = ascontiguousarray(freqlist, dtype=float64)
+    digest = hashlib.sha1(freqlist.tobytes())
+    digest.update('|{}'.format(freqlist.shape).encode())
+
+    return digest.hexdigest()
+
+
+class ResponseCache(object):
+    """
+    Memoized compute_response() results keyed by PAZ content, frequency grid content and mode (and optional
+    normalization frequency), with least recently used eviction once the cached arrays exceed max_bytes.
+
+    Cached responses are returned read only, as the same array is handed to every caller. Public functions
+    built on the cache copy them before handing them out.
+    """
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        """
+        :param max_bytes: Size limit of the cached responses
+        :type max_bytes: int
+        """
+
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._responses = OrderedDict()
+
+    def __len__(self):
+        return len(self._responses)
 
-    fir_fft = rfft(fir_coeffs, fft_len)
+    def clear(self):
+        self._responses.clear()
+        self.nbytes = 0
+
+    def response(self, freqlist, paz, mode='vel', norm_freq=None):
+        """compute_response(freqlist, paz, mode), normalized by normalize_response() at norm_freq if given.
+
+        :param freqlist: Frequencies in hz
+        :type freqlist: ndarray
+        :param paz: Response
+        :type paz: PAZ
+        :param mode: Units to use when computing the response
+        :type mode: str ['disp', 'vel', 'acc']
+        :param norm_freq: Normalization frequency (Optional)
+        :type norm_freq: float
+        :return: Read only complex response
+        :rtype: ndarray
+        """
+
+        if isinstance(freqlist, float) or isinstance(freqlist, int):
+            freqlist = array([freqlist])
+
+        key = (paz_fingerprint(paz), freqs_fingerprint(freqlist), mode, norm_freq)
+        resp = self._responses.get(key)
+        if resp is not None:
+            self._responses.move_to_end(key)
+            self.hits += 1
+            return resp
+
+        self.misses += 1
+        resp = compute_response(freqlist, paz, mode=mode)
+        if norm_freq is not None:
+            resp, _, _ = normalize_response(resp, freqlist, norm_freq)
+        resp.setflags(write=False)
+
+        if resp.nbytes <= self.max_bytes:
+            self._responses[key] = resp
+            self.nbytes += resp.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._responses.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+        return resp
+
+
+# shared by analyses in this process, e.g. stations with the same seismometer model
+RESPONSE_CACHE = ResponseCache()
+
+
+def cached_response(freqlist, paz, mode='vel', norm_freq=None, cache=None):
+    """ResponseCache.response() of cache, or of the shared RESPONSE_CACHE.
+
+    :param freqlist: Frequencies in hz
+    :type freqlist: ndarray
+    :param paz: Response
+    :type paz: PAZ
+    :param mode: Units to use when computing the response
+    :type mode: str ['disp', 'vel', 'acc']
+    :param norm_freq: Normalization frequency (Optional)
+    :type norm_freq: float
+    :param cache: Cache to use (Optional)
+    :type cache: ResponseCache
+    :return: Read only complex response
+    :rtype: ndarray
+    """
+
+    if cache is None:
+        cache = RESPONSE_CACHE
+    return cache.response(freqlist, paz, mode=mode, norm_freq=norm_freq)
+
+
+def compute_response_fir(fir_coeffs, fft_len, workspace=None):
+
+    fir_fft = rfft(fir_coeffs, fft_len, workspace=workspace)
 
     return fir_fft
 
 
 def normalize_response(freq_resp, freqlist, norm_freq):
 
-    normed = None
     # find the index in freqs of the first freq >= nom_freq
-
-    ndx = min([freq[0] for freq in enumerate(freqlist) if freq[1] >= norm_freq])
-    if not (ndx is None):
-
-        scale = abs(freq_resp[ndx])
-        normed = divide(freq_resp, scale)
-    else:
-        scale = 1.0
+    ndx = frequency_index(freqlist, norm_freq)
+    scale = abs(freq_resp[ndx])
+    normed = divide(freq_resp, scale)
 
     return normed, scale, ndx
 
@@ -285,3 +775,81 @@ def pack_paz(data, flags):
 #     print('Partial Poles:',paz_partial._poles)
 #     print('Partial Zeros:',paz_partial._zeros)
     return paz_partial
+
+
+def pack_paz_index_map(flags):
+    """Data vector indices used by pack_paz(data, flags) for each pole and zero.
+
+    Each row is [index of real part, index of imaginary part, sign of imaginary part].
+    Indices are -1 where the part is fixed ('zero' flags, imaginary part of real values).
+    """
+
+    maps = []
+    datandx = 0
+    for pz_flags in flags:
+        pz_map = npzeros((len(pz_flags), 3), dtype=int)
+        for ndx, flag in enumerate(pz_flags):
+            if flag == 'zero':
+                pz_map[ndx] = [-1, -1, 0]
+            elif flag == 'complex':
+                pz_map[ndx] = [datandx, datandx + 1, 1]
+                datandx += 2
+            elif flag == 'conjugate':
+                pz_map[ndx] = [datandx - 2, datandx - 1, -1]
+            elif flag == 'real':
+                pz_map[ndx] = [datandx, -1, 0]
+                datandx += 1
+            elif flag == 'real-double':
+                pz_map[ndx] = [datandx - 1, -1, 0]
+            else:
+                msg = 'Invalid pole/zero type: ' + flag
+                logging.error(msg)
+                raise ValueError(msg)
+        maps.append(pz_map)
+
+    return maps[0], maps[1]
+
+
+def compute_response_derivatives(freqlist, paz, index_map, param_cnt, mode='vel'):
+    """Derivatives of ln(compute_response(freqlist, paz)) with respect to each pack_paz() data parameter.
+
+    Poles and zeros are parameterized in hz, as produced by pack_paz(). With s = 2*pi*j*f and P = 2*pi*p,
+    d ln(H)/dP = 1/(s - P) for a pole and -1/(s - Z) for a zero. h0 cancels on normalization and its
+    column is left zero.
+
+    :param freqlist: Frequencies in hz
+    :type freqlist: FrequencyGrid or ndarray
+    :param paz: PAZ from pack_paz()
+    :type paz: PAZ
+    :param index_map: (pole_map, zero_map) from pack_paz_index_map()
+    :type index_map: (ndarray, ndarray)
+    :param param_cnt: Length of pack_paz() data vector
+    :type param_cnt: int
+    :param mode: Response mode as for compute_response(). Must not add or drop fitted zeros.
+    :type mode: str
+    :return: (len(freqlist) x param_cnt) complex derivatives
+    :rtype: ndarray
+    """
+
+    if isinstance(freqlist, FrequencyGrid):
+        s = freqlist.jomega
+    else:
+        s = 2j * pi * asarray(freqlist, dtype=float)
+    dlnh = npzeros((s.size, param_cnt), dtype=complex)
+
+    pole_map, zero_map = index_map
+    zeros = paz.zeros(mode=mode, units='rad')
+    zero_ofs = zeros.size - zero_map.shape[0]
+    for roots, pz_map, ofs, sign in ((paz.poles(mode=mode, units='rad'), pole_map, 0, 1.0),
+                                     (zeros, zero_map, zero_ofs, -1.0)):
+        for ndx in range(pz_map.shape[0]):
+            re_ndx, im_ndx, im_sign = pz_map[ndx]
+            if re_ndx < 0:
+                continue
+            # dP/d(re) = 2*pi, dP/d(im) = 2*pi*j
+            dterm = (sign * 2 * pi) / (s - roots[ndx + ofs])
+            dlnh[:, re_ndx] += dterm
+            if im_ndx >= 0:
+                dlnh[:, im_ndx] += (im_sign * 1j) * dterm
+
+    return dlnh
@@ -0,0 +1,256 @@
+#######################################################################################################################
+# Copyright (C) 2016  Regents of the University of California
+#
+# This is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License (GNU GPL) as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# A copy of the GNU General Public License can be found in LICENSE.TXT in the root of the source code repository.
+# Additionally, it can be found at http://www.gnu.org/licenses/.
+#
+# NOTES: Per GNU GPLv3 terms:
+#   * This notice must be kept in this source file
+#   * Changes to the source must be clearly noted with date & time of change
+#
+# If you use this software in a product, an explicit acknowledgment in the product documentation of the contribution
+# by Project IDA, Institute of Geophysics and Planetary Physics, UCSD would be appreciated but is not required.
+#######################################################################################################################
+
+import unittest
+from math import floor, sqrt
+from numpy import abs, convolve, float64, roll
+from numpy.random import RandomState
+from ida.calibration.cross import cross_correlate, cross_correlate_multi, cross_correlate_stream, \
+    cross_spectral_matrices, CrossSpectralAccumulator, array_blocks, coh_gain_phase, spcmat, spcmat_loop
+from ida.calibration.process import CalRunStack
+from ida.instruments import ComponentsTpl
+
+"""Regression tests of the vectorized cross spectral estimation against the original per frequency loop"""
+
+# 1994 and 2006 have large prime factors (997, 17 * 59) so the padded transforms are not 5-smooth
+SPCMAT_TEST_SIZES = [1000, 1994, 2006, 4096]
+REL_TOL = 1e-12
+
+
+def synthetic_cal_pair(size, seed=0):
+    """Random binary like input with a smoothed, noisy output."""
+
+    rng = RandomState(seed)
+    ts1 = rng.choice([-1.0, 1.0], size)
+    ts2 = convolve(ts1, [0.5, 0.3, 0.2], mode='same') + 0.1 * rng.standard_normal(size)
+
+    return ts1, ts2
+
+
+def max_rel_diff(actual, expected):
+
+    return abs(actual - expected).max() / abs(expected).max()
+
+
+class SpcmatTestCase(unittest.TestCase):
+    """Vectorized, real transform spcmat() against the per frequency loop, including lengths whose padded
+    transforms are not 5-smooth."""
+
+    def test_spcmat_matches_loop(self):
+        for size in SPCMAT_TEST_SIZES:
+            ts1, ts2 = synthetic_cal_pair(size)
+            ts1 -= ts1.mean()
+            ts2 -= ts2.mean()
+            taper_cnt = floor(floor((3.0 + 0.3 * sqrt(size))) * sqrt(2.0))
+
+            sxy_loop, len_loop = spcmat_loop(ts1, ts2, taper_cnt)
+            sxy_vect, len_vect = spcmat(ts1, ts2, taper_cnt)
+
+            self.assertEqual(len_vect, len_loop)
+            self.assertLess(max_rel_diff(sxy_vect, sxy_loop), REL_TOL, 'size {}'.format(size))
+
+    def test_spcmat_block_size(self):
+        ts1, ts2 = synthetic_cal_pair(2006)
+        sxy_full, _ = spcmat(ts1, ts2, 20)
+        sxy_blocked, _ = spcmat(ts1, ts2, 20, block_size=97)
+
+        self.assertLess(max_rel_diff(sxy_blocked, sxy_full), REL_TOL)
+
+
+class BandTestCase(unittest.TestCase):
+    """Band limited and bin masked estimates against slices of the full band estimate."""
+
+    def test_band_matches_full_band_slice(self):
+        for size in [4000, 4006]:
+            ts1, ts2 = synthetic_cal_pair(size)
+            freqs, gain, phase, coh = cross_correlate(20.0, ts1, ts2)
+            band_freqs, band_gain, band_phase, band_coh = cross_correlate(20.0, ts1, ts2, band=(0.5, 7.25))
+
+            in_band = (freqs >= 0.5) & (freqs <= 7.25)
+            self.assertEqual(band_freqs.size, in_band.sum())
+            self.assertLess(max_rel_diff(band_freqs, freqs[in_band]), REL_TOL)
+            self.assertLess(max_rel_diff(band_gain, gain[in_band]), REL_TOL)
+            self.assertLess(max_rel_diff(band_phase, phase[in_band]), REL_TOL)
+            self.assertLess(max_rel_diff(band_coh, coh[in_band]), REL_TOL)
+
+    def test_bin_mask_matches_full_band_slice(self):
+        ts1, ts2 = synthetic_cal_pair(3000)
+        freqs, gain, phase, coh = cross_correlate(20.0, ts1, ts2)
+        mask = RandomState(1).rand(freqs.size) < 0.2
+
+        mask_freqs, mask_gain, _, mask_coh = cross_correlate(20.0, ts1, ts2, bin_mask=mask)
+
+        self.assertLess(max_rel_diff(mask_freqs, freqs[mask]), REL_TOL)
+        self.assertLess(max_rel_diff(mask_gain, gain[mask]), REL_TOL)
+        self.assertLess(max_rel_diff(mask_coh, coh[mask]), REL_TOL)
+
+
+class MultiOutputTestCase(unittest.TestCase):
+    """cross_correlate_multi() sharing the input spectrum against one cross_correlate() per output."""
+
+    def test_multi_matches_single(self):
+        ts1, ts2 = synthetic_cal_pair(3000)
+        _, ts3 = synthetic_cal_pair(3000, seed=1)
+
+        _, gains, phases, cohs = cross_correlate_multi(20.0, ts1, [ts2, ts3])
+        for ndx, ts in enumerate([ts2, ts3]):
+            _, gain, phase, coh = cross_correlate(20.0, ts1, ts)
+            self.assertLess(max_rel_diff(gains[ndx], gain), REL_TOL)
+            self.assertLess(max_rel_diff(phases[ndx], phase), REL_TOL)
+            self.assertLess(max_rel_diff(cohs[ndx], coh), REL_TOL)
+
+
+class AccumulatorTestCase(unittest.TestCase):
+    """Segment accumulation of the cross spectral matrices against one-shot estimates and their averages."""
+
+    def test_single_segment_matches_cross_correlate(self):
+        ts1, ts2 = synthetic_cal_pair(3000)
+        freqs, gain, phase, coh = cross_correlate(20.0, ts1, ts2)
+
+        accum = CrossSpectralAccumulator(20.0)
+        accum.add(ts1, [ts2])
+        accum_freqs, accum_gain, accum_phase, accum_coh = accum.result()
+
+        self.assertEqual(accum.segment_cnt, 1)
+        self.assertLess(max_rel_diff(accum_freqs, freqs), REL_TOL)
+        self.assertLess(max_rel_diff(accum_gain[0], gain), REL_TOL)
+        self.assertLess(max_rel_diff(accum_phase[0], phase), REL_TOL)
+        self.assertLess(max_rel_diff(accum_coh[0], coh), REL_TOL)
+
+    def test_segments_average_cross_spectral_matrices(self):
+        ts1, ts2 = synthetic_cal_pair(6000)
+        segment_len = 2000
+
+        accum = CrossSpectralAccumulator(20.0, band=(0.1, 8.0))
+        added = accum.add_record(ts1, [ts2], segment_len, overlap=0.5)
+        self.assertEqual(added, 5)
+
+        expected = None
+        for start in range(0, 4001, 1000):
+            _, sxys = cross_spectral_matrices(20.0, ts1[start:start + segment_len], [ts2[start:start + segment_len]],
+                                              band=(0.1, 8.0))
+            expected = sxys[0] if expected is None else expected + sxys[0]
+        expected /= 5
+
+        self.assertLess(max_rel_diff(accum.cross_spectral_matrices()[0], expected), REL_TOL)
+
+        gain, phase, coh = coh_gain_phase(expected)
+        _, accum_gain, accum_phase, accum_coh = accum.result()
+        self.assertLess(max_rel_diff(accum_gain[0], gain), REL_TOL)
+        self.assertLess(max_rel_diff(accum_coh[0], coh), REL_TOL)
+
+    def test_merge_matches_single_accumulator(self):
+        ts1, ts2 = synthetic_cal_pair(8000)
+
+        whole = CrossSpectralAccumulator(20.0)
+        whole.add_record(ts1, [ts2], 2000, overlap=0.0)
+
+        first = CrossSpectralAccumulator(20.0)
+        first.add_record(ts1[:4000], [ts2[:4000]], 2000, overlap=0.0)
+        second = CrossSpectralAccumulator(20.0)
+        second.add_record(ts1[4000:], [ts2[4000:]], 2000, overlap=0.0)
+        first.merge(second)
+
+        self.assertEqual(first.segment_cnt, whole.segment_cnt)
+        self.assertLess(max_rel_diff(first.cross_spectral_matrices()[0], whole.cross_spectral_matrices()[0]),
+                        REL_TOL)
+
+    def test_segment_length_mismatch_raises(self):
+        ts1, ts2 = synthetic_cal_pair(3000)
+        accum = CrossSpectralAccumulator(20.0)
+        accum.add(ts1[:2000], [ts2[:2000]])
+
+        with self.assertRaises(ValueError):
+            accum.add(ts1[:1000], [ts2[:1000]])
+
+
+class StreamTestCase(unittest.TestCase):
+    """Streamed segment estimates against the one-shot estimate and the accumulator."""
+
+    def test_one_segment_stream_matches_cross_correlate(self):
+        ts1, ts2 = synthetic_cal_pair(3000)
+        freqs, gain, phase, coh = cross_correlate(20.0, ts1, ts2)
+
+        # blocks that do not divide the segment length are rebuffered
+        stream_freqs, stream_gain, stream_phase, stream_coh = \
+            cross_correlate_stream(20.0, array_blocks([ts1, ts2], block_len=701), 3000, overlap=0.0)
+
+        self.assertLess(max_rel_diff(stream_freqs, freqs), REL_TOL)
+        self.assertLess(max_rel_diff(stream_gain, gain), REL_TOL)
+        self.assertLess(max_rel_diff(stream_phase, phase), REL_TOL)
+        self.assertLess(max_rel_diff(stream_coh, coh), REL_TOL)
+
+    def test_stream_matches_accumulator(self):
+        ts1, ts2 = synthetic_cal_pair(10000)
+
+        accum = CrossSpectralAccumulator(20.0)
+        accum.add_record(ts1, [ts2], 2048, overlap=0.5)
+        _, gain, phase, coh = accum.result(dtype=float64)
+
+        _, stream_gain, stream_phase, stream_coh = \
+            cross_correlate_stream(20.0, array_blocks([ts1, ts2], block_len=1000), 2048, overlap=0.5)
+
+        self.assertLess(max_rel_diff(stream_gain, gain[0]), REL_TOL)
+        self.assertLess(max_rel_diff(stream_phase, phase[0]), REL_TOL)
+        self.assertLess(max_rel_diff(stream_coh, coh[0]), REL_TOL)
+
+
+class LagTestCase(unittest.TestCase):
+    """Phase slope delay returned by cross_correlate() and coh_gain_phase()."""
+
+    def test_lag_of_delayed_output(self):
+        ts1, _ = synthetic_cal_pair(4000)
+        ts2 = roll(ts1, 3)  # output lags input by 3 samples
+        freqs, gain, phase, coh, lag = cross_correlate(20.0, ts1, ts2, band=(0.1, 8.0), lag=True)
+        self.assertAlmostEqual(lag, 3 / 20.0, delta=0.01)
+
+        _, sxys = cross_spectral_matrices(20.0, ts1, [ts2], band=(0.1, 8.0))
+        sxy_gain, sxy_phase, sxy_coh, sxy_lag = coh_gain_phase(sxys[0], freqs=freqs)
+        self.assertEqual(sxy_lag, lag)
+        self.assertEqual(len(coh_gain_phase(sxys[0])), 3)
+
+
+class CalRunStackTestCase(unittest.TestCase):
+    """Stacking of repeated runs, which must each fill at least one segment."""
+
+    def run_tpls(self, size, seed):
+        ts1, ts2 = synthetic_cal_pair(size, seed=seed)
+        return ComponentsTpl(ts1, ts1, ts1), ComponentsTpl(ts2, ts2, ts2)
+
+    def test_short_run_raises(self):
+        stack = CalRunStack(20.0, 2000, band=(0.1, 8.0))
+        stack.add_run(20.0, *self.run_tpls(4000, 0))
+        segment_cnt = stack._accums.vertical.segment_cnt
+
+        with self.assertRaises(ValueError):
+            stack.add_run(20.0, *self.run_tpls(1999, 1))
+        # nothing from the short run is stacked
+        self.assertEqual(stack.run_cnt, 1)
+        self.assertEqual([accum.segment_cnt for accum in stack._accums], [segment_cnt] * 3)
+
+        stack.add_run(20.0, *self.run_tpls(2000, 2))
+        self.assertEqual(stack.run_cnt, 2)
+        self.assertEqual(stack._accums.north.segment_cnt, segment_cnt + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
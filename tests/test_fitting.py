@@ -0,0 +1,457 @@
+#######################################################################################################################
+# Copyright (C) 2016  Regents of the University of California
+#
+# This is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License (GNU GPL) as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# A copy of the GNU General Public License can be found in LICENSE.TXT in the root of the source code repository.
+# Additionally, it can be found at http://www.gnu.org/licenses/.
+#
+# NOTES: Per GNU GPLv3 terms:
+#   * This notice must be kept in this source file
+#   * Changes to the source must be clearly noted with date & time of change
+#
+# If you use this software in a product, an explicit acknowledgment in the product documentation of the contribution
+# by Project IDA, Institute of Geophysics and Planetary Physics, UCSD would be appreciated but is not required.
+#######################################################################################################################
+
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+from numpy import abs, angle, pi, array, linspace, ones, concatenate, zeros, floor, log10, int64, allclose, \
+    array_equal, percentile, column_stack, sqrt, median
+from numpy.random import RandomState
+import ida.signals.paz
+import ida.signals.utils
+from ida.calibration.fitting import PAZResidualKernel, PAZFitTask, JointPAZFitTask, log_bin_tf, paz_fit_params, \
+    fit_paz, fit_paz_joint, run_fit_tasks, run_multi_start_fits, percentile_intervals, bootstrap_bias, \
+    FIT_JAC_ANALYTIC, FIT_BINS_PER_DECADE, LOG_BIN_MAX_COH
+from ida.calibration.process import resp_cost, resp_cost_jac, analyze_cal_components, bootstrap_cal_components
+from ida.calibration.history import CalHistory
+from ida.instruments import ComponentsTpl
+
+"""Tests of the response fitting kernels against the reference resp_cost() and of the fit drivers"""
+
+NORM_FREQ = 1.0
+FIT_FREQS = linspace(0.2, 15.0, 500)
+
+# high frequency partial PAZ: complex pole pair and a real pole, in hz
+NOMINAL_POLES = [-1.59 + 2.39j, -1.59 - 2.39j, -9.55]
+TRUE_POLE_SCALE = [1.04, 1.04, 0.97]
+
+
+def partial_paz(poles, norm_freq=NORM_FREQ):
+    """Partial velocity PAZ with the given poles, normalized at norm_freq."""
+
+    paz = ida.signals.paz.PAZ('vel', 'hz')
+    for pole in poles:
+        paz.add_pole(pole)
+    resp = ida.signals.utils.compute_response(array([norm_freq]), paz)
+    paz.h0 = 1.0 / abs(resp[0])
+
+    return paz
+
+
+def synthetic_task(label='test', pole_scale=TRUE_POLE_SCALE, noise=0.0, seed=0, stages=(None,), jac=FIT_JAC_ANALYTIC):
+    """Fit task whose measured TF is the response of scaled nominal poles relative to the nominal response."""
+
+    nominal = partial_paz(NOMINAL_POLES)
+    true = partial_paz([pole * scale for pole, scale in zip(NOMINAL_POLES, pole_scale)])
+
+    resp_nom = ida.signals.utils.compute_response(FIT_FREQS, nominal)
+    resp_true, _, _ = ida.signals.utils.normalize_response(ida.signals.utils.compute_response(FIT_FREQS, true),
+                                                           FIT_FREQS, NORM_FREQ)
+    tf = resp_true / resp_nom
+    if noise:
+        rng = RandomState(seed)
+        tf = tf + noise * (rng.standard_normal(tf.size) + 1j * rng.standard_normal(tf.size))
+    coh = 0.95 * ones(FIT_FREQS.size)
+
+    return PAZFitTask(label, nominal, NORM_FREQ, FIT_FREQS, tf, coh, None, jac, None, tuple(stages)), true
+
+
+def max_rel_diff(actual, expected):
+
+    return abs(actual - expected).max() / abs(expected).max()
+
+
+class KernelTestCase(unittest.TestCase):
+    """PAZResidualKernel residuals and analytic jacobian against resp_cost(), resp_cost_jac() and finite
+    differences."""
+
+    def setUp(self):
+        self.task, self.true = synthetic_task(noise=0.01)
+        self.paz_x, self.flags, self.lb, self.ub = paz_fit_params(self.task.paz)
+        self.resp0 = ida.signals.utils.compute_response(FIT_FREQS, self.task.paz)
+        self.target = concatenate((self.task.tf.real, self.task.tf.imag))
+        self.kernel = PAZResidualKernel(self.flags, FIT_FREQS, NORM_FREQ, self.target, self.resp0)
+        rng = RandomState(1)
+        self.samples = [self.paz_x] + [self.lb + rng.random_sample(self.paz_x.size) * (self.ub - self.lb)
+                                       for _ in range(3)]
+
+    def test_residuals_match_resp_cost(self):
+        for p in self.samples:
+            expected = resp_cost(p, self.flags, FIT_FREQS, NORM_FREQ, self.target, self.resp0)
+            self.assertLess(max_rel_diff(self.kernel.residuals(p), expected), 1e-10)
+
+    def test_jacobian_matches_resp_cost_jac(self):
+        for p in self.samples:
+            expected = resp_cost_jac(p, self.flags, FIT_FREQS, NORM_FREQ, self.target, self.resp0)
+            self.assertLess(max_rel_diff(self.kernel.jacobian(p), expected), 1e-10)
+
+    def test_jacobian_matches_finite_difference(self):
+        for p in self.samples:
+            jac = self.kernel.jacobian(p)
+            fd_jac = zeros(jac.shape)
+            for ndx in range(p.size):
+                step = 1e-6 * max(1.0, abs(p[ndx]))
+                p_hi = p.copy()
+                p_hi[ndx] += step
+                p_lo = p.copy()
+                p_lo[ndx] -= step
+                fd_jac[:, ndx] = (self.kernel.residuals(p_hi) - self.kernel.residuals(p_lo)) / (2 * step)
+            self.assertLess(max_rel_diff(jac, fd_jac), 1e-6)
+
+    def test_weights_scale_residuals_and_jacobian(self):
+        weights = linspace(0.5, 1.0, FIT_FREQS.size)
+        weighted = PAZResidualKernel(self.flags, FIT_FREQS, NORM_FREQ, self.target, self.resp0, weights=weights)
+        p = self.samples[1]
+        row_wts = concatenate((weights, weights))
+
+        self.assertLess(max_rel_diff(weighted.residuals(p), row_wts * self.kernel.residuals(p)), 1e-12)
+        self.assertLess(max_rel_diff(weighted.jacobian(p), row_wts[:, None] * self.kernel.jacobian(p)), 1e-12)
+
+
+class LogBinTestCase(unittest.TestCase):
+    """Coherence weighted log frequency decimation of the fitting target."""
+
+    def setUp(self):
+        rng = RandomState(2)
+        self.freqs = linspace(0.01, 20.0, 20000)
+        self.tf = 1.0 + 0.1 * (rng.standard_normal(self.freqs.size) + 1j * rng.standard_normal(self.freqs.size))
+        self.coh = rng.uniform(0.2, 1.0, self.freqs.size)
+        self.coh[:50] = 1.0  # clipped to LOG_BIN_MAX_COH
+
+    def test_weighted_means_preserved(self):
+        bins_per_decade = 30
+        bin_freqs, bin_tf, bin_wts = log_bin_tf(self.freqs, self.tf, self.coh, bins_per_decade)
+
+        coh = self.coh.clip(0.0, LOG_BIN_MAX_COH)
+        wts = coh / (1.0 - coh)
+        bin_ids = floor(log10(self.freqs) * bins_per_decade).astype(int64)
+        ids = sorted(set(bin_ids))
+        self.assertEqual(len(ids), bin_freqs.size)
+
+        wt_sums = array([wts[bin_ids == bin_id].sum() for bin_id in ids])
+        for ndx, bin_id in enumerate(ids):
+            members = bin_ids == bin_id
+            self.assertAlmostEqual(bin_tf[ndx], (wts[members] * self.tf[members]).sum() / wt_sums[ndx], places=12)
+            self.assertAlmostEqual(bin_freqs[ndx], (wts[members] * self.freqs[members]).sum() / wt_sums[ndx],
+                                   places=12)
+            self.assertAlmostEqual(bin_wts[ndx], sqrt(wt_sums[ndx] / median(wts)), places=9)
+
+        # the weighted mean over all frequencies is unchanged by binning
+        self.assertAlmostEqual((wt_sums * bin_tf).sum() / wt_sums.sum(), (wts * self.tf).sum() / wts.sum(),
+                               places=12)
+
+    def test_weights_count_frequencies(self):
+        coh = 0.9 * ones(self.freqs.size)
+        bin_freqs, _, bin_wts = log_bin_tf(self.freqs, self.tf, coh, 30)
+
+        # equal coherence: a bin weighs as the square root of the frequencies it holds
+        bin_ids = floor(log10(self.freqs) * 30).astype(int64)
+        counts = array([(bin_ids == bin_id).sum() for bin_id in sorted(set(bin_ids))])
+        self.assertTrue(allclose(bin_wts, counts ** 0.5, rtol=1e-12, atol=0))
+
+    def test_decimated_fit_matches_full_resolution(self):
+        task, true = synthetic_task()
+        rng = RandomState(5)
+        coh = rng.uniform(0.5, 0.99, FIT_FREQS.size)
+        noise = 0.02 * ((1.0 - coh) / coh) ** 0.5
+        tf = task.tf + noise * (rng.standard_normal(coh.size) + 1j * rng.standard_normal(coh.size))
+        task = task._replace(tf=tf, coh=coh)
+
+        full = fit_paz(task)
+        for bins_per_decade in [30, FIT_BINS_PER_DECADE]:
+            decimated = fit_paz(task._replace(stages=(bins_per_decade,)))
+            self.assertLess(decimated.stages[0].freq_cnt, FIT_FREQS.size)
+            self.assertLess(max_rel_diff(decimated.paz._poles, full.paz._poles), 5e-3)
+
+    def test_single_frequency_bins_unchanged(self):
+        bin_freqs, bin_tf, _ = log_bin_tf(self.freqs, self.tf, self.coh, 1000)
+
+        # below ~0.5 hz every bin holds one frequency at this density
+        low = self.freqs < 0.1
+        self.assertTrue(allclose(bin_freqs[:low.sum()], self.freqs[low], rtol=1e-14, atol=0))
+        self.assertTrue(allclose(bin_tf[:low.sum()], self.tf[low], rtol=1e-14, atol=0))
+
+
+class FitTestCase(unittest.TestCase):
+    """fit_paz() of synthetic targets, with analytic and finite difference jacobians."""
+
+    def test_fit_recovers_poles(self):
+        task, true = synthetic_task()
+        result = fit_paz(task)
+
+        self.assertLess(max_rel_diff(result.paz._poles, true._poles), 1e-3)
+        self.assertEqual(len(result.stages), 1)
+        self.assertEqual(result.stages[0].freq_cnt, FIT_FREQS.size)
+
+    def test_finite_difference_jacobian_fit_matches_analytic(self):
+        task, _ = synthetic_task(noise=0.01)
+        analytic = fit_paz(task)
+        finite_diff = fit_paz(task._replace(jac='3-point'))
+
+        # h0 normalizes out of the residuals, so only the poles are determined
+        self.assertLess(max_rel_diff(finite_diff.paz._poles, analytic.paz._poles), 1e-3)
+
+    def test_invalid_jacobian_mode_raises(self):
+        task, _ = synthetic_task()
+
+        with self.assertRaises(ValueError):
+            fit_paz(task._replace(jac='bogus'))
+
+
+class StagedFitTestCase(unittest.TestCase):
+    """Coarse to fine fit stages on log_bin_tf() decimated targets."""
+
+    def test_stages_end_at_full_resolution(self):
+        task, true = synthetic_task(noise=0.01)
+        single = fit_paz(task)
+        staged = fit_paz(task._replace(stages=(10, 30, None)))
+
+        self.assertEqual([stage.bins_per_decade for stage in staged.stages], [10, 30, None])
+        self.assertEqual(staged.stages[-1].freq_cnt, FIT_FREQS.size)
+        self.assertLess(staged.stages[0].freq_cnt, staged.stages[1].freq_cnt)
+        self.assertEqual(staged.nfev, sum([stage.nfev for stage in staged.stages]))
+        self.assertLess(max_rel_diff(staged.paz._poles, single.paz._poles), 1e-2)
+
+    def test_costs_are_accepted_iterates(self):
+        for has_callback in [True, False]:
+            with mock.patch('ida.calibration.fitting.LSQ_HAS_CALLBACK', has_callback):
+                for jac in [FIT_JAC_ANALYTIC, '2-point']:
+                    task, true = synthetic_task(noise=0.01, stages=(10, None), jac=jac)
+                    for stage in fit_paz(task).stages:
+                        # start plus one cost per accepted step, each lower than the last: no rejected trial
+                        # steps or finite difference probes
+                        self.assertEqual(stage.costs[0], stage.initial_cost)
+                        self.assertEqual(stage.costs[-1], stage.cost)
+                        self.assertLessEqual(len(stage.costs), stage.njev)
+                        self.assertTrue(all(cost < prev for prev, cost in zip(stage.costs, stage.costs[1:])))
+
+
+class WarmStartTestCase(unittest.TestCase):
+    """Fits started from a previous result, and the calibration history that supplies it."""
+
+    def test_warm_start(self):
+        task, true = synthetic_task()
+        cold = fit_paz(task)
+        warm = fit_paz(task._replace(start_paz=cold.paz))
+
+        self.assertLessEqual(warm.nfev, cold.nfev)
+        self.assertLess(max_rel_diff(warm.paz._poles, cold.paz._poles), 1e-3)
+
+    def test_history_latest_before(self):
+        task, true = synthetic_task()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with CalHistory(os.path.join(tmp_dir, 'history.db')) as history:
+                self.assertIsNone(history.latest('STA', '00', 'BHZ', 'S1'))
+                history.add('STA', '00', 'BHZ', 'S1', 'STS2_5', task.paz, cal_time=100.0)
+                history.add('STA', '00', 'BHZ', 'S1', 'STS2_5', true, cal_time=200.0)
+                history.add('STA', '00', 'BHZ', 'S1', 'STS2_5', task.paz, cal_time=300.0, accepted=False)
+
+                self.assertTrue(array_equal(history.latest('STA', '00', 'BHZ', 'S1')._poles, true._poles))
+                # a reprocessed run only sees calibrations before it
+                self.assertTrue(array_equal(history.latest('STA', '00', 'BHZ', 'S1', before=200.0)._poles,
+                                            task.paz._poles))
+                self.assertIsNone(history.latest('STA', '00', 'BHZ', 'S2'))
+
+
+class RunFitTasksTestCase(unittest.TestCase):
+    """Running fit tasks through run_fit_tasks()."""
+
+    def test_serial_results_in_task_order(self):
+        tasks = [synthetic_task(label=str(ndx), noise=0.01, seed=ndx)[0] for ndx in range(3)]
+        results = run_fit_tasks(fit_paz, tasks, max_workers=1)
+
+        self.assertEqual([result.label for result in results], ['0', '1', '2'])
+        for task, result in zip(tasks, results):
+            self.assertTrue(array_equal(result.x, fit_paz(task).x))
+
+
+    def test_pool_matches_serial(self):
+        tasks = [synthetic_task(label=str(ndx), noise=0.01, seed=ndx)[0] for ndx in range(3)]
+        serial = run_fit_tasks(fit_paz, tasks, max_workers=1)
+        pooled = run_fit_tasks(fit_paz, tasks, max_workers=2)
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            shared = run_fit_tasks(fit_paz, tasks, executor=executor)
+
+        for serial_result, pooled_result, shared_result in zip(serial, pooled, shared):
+            self.assertEqual(pooled_result.label, serial_result.label)
+            self.assertTrue(array_equal(pooled_result.x, serial_result.x))
+            self.assertTrue(array_equal(shared_result.x, serial_result.x))
+
+
+class MultiStartTestCase(unittest.TestCase):
+    """Multi-start fits from Latin hypercube starting points."""
+
+    def test_multi_start_is_reproducible(self):
+        task, _ = synthetic_task(noise=0.01)
+        first = run_multi_start_fits([task], start_cnt=4, seed=3, max_workers=1)[0]
+        second = run_multi_start_fits([task], start_cnt=4, seed=3, max_workers=1)[0]
+
+        self.assertEqual(len(first.results), 4)
+        self.assertTrue(array_equal(first.costs, second.costs))
+        self.assertEqual(first.best.cost, first.costs.min())
+        # the first start is the task's own
+        self.assertTrue(array_equal(first.results[0].x, fit_paz(task).x))
+
+    def test_shared_pool_matches_serial(self):
+        task, _ = synthetic_task(noise=0.01)
+        serial = run_multi_start_fits([task], start_cnt=4, seed=3, max_workers=1)[0]
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            pooled = run_multi_start_fits([task], start_cnt=4, seed=3, executor=executor)[0]
+
+        self.assertTrue(array_equal(pooled.costs, serial.costs))
+
+
+class JointFitTestCase(unittest.TestCase):
+    """Joint component fits with shared poles and a sparse jacobian."""
+
+    def setUp(self):
+        self.tasks = []
+        self.trues = []
+        for ndx, scale in enumerate([1.02, 1.04, 1.06]):
+            task, true = synthetic_task(label=str(ndx), pole_scale=[scale, scale, 0.97], noise=0.005, seed=ndx)
+            self.tasks.append(task)
+            self.trues.append(true)
+
+    def test_nothing_shared_matches_independent_fits(self):
+        joint = fit_paz_joint(JointPAZFitTask('joint', self.tasks, ([], [])))
+        for task, result in zip(self.tasks, joint):
+            self.assertLess(max_rel_diff(result.paz._poles, fit_paz(task).paz._poles), 1e-2)
+
+    def test_shared_poles_are_tied(self):
+        joint = fit_paz_joint(JointPAZFitTask('joint', self.tasks, ([2], [])))
+        shared = [result.paz._poles[2] for result in joint]
+
+        self.assertEqual(shared[0], shared[1])
+        self.assertEqual(shared[0], shared[2])
+        self.assertLess(abs(shared[0] - self.trues[0]._poles[2]) / abs(self.trues[0]._poles[2]), 1e-2)
+        for true, result in zip(self.trues, joint):
+            self.assertLess(max_rel_diff(result.paz._poles[:2], true._poles[:2]), 1e-2)
+
+    def test_finite_difference_jacobian_matches_analytic(self):
+        analytic = fit_paz_joint(JointPAZFitTask('joint', self.tasks, ([2], [])))
+        tasks = [task._replace(jac='2-point') for task in self.tasks]
+        finite_diff = fit_paz_joint(JointPAZFitTask('joint', tasks, ([2], [])))
+
+        for analytic_result, fd_result in zip(analytic, finite_diff):
+            self.assertLess(max_rel_diff(fd_result.paz._poles, analytic_result.paz._poles), 1e-3)
+
+
+class IntervalTestCase(unittest.TestCase):
+    """Bootstrap percentile intervals and bias."""
+
+    def setUp(self):
+        rand = RandomState(3)
+        # first column's replicates are offset from the estimate by half a standard deviation, as from a biased fit
+        self.estimate = array([1.0, -2.0])
+        self.samples = column_stack([1.025 + 0.05 * rand.randn(4000), -2.0 + 0.5 * rand.randn(4000)])
+
+    def test_plain_percentiles(self):
+        lo, hi = percentile_intervals(self.samples, level=0.9)
+        self.assertTrue(allclose(lo, percentile(self.samples, 5.0, axis=0)))
+        self.assertTrue(allclose(hi, percentile(self.samples, 95.0, axis=0)))
+
+    def test_bias_corrected(self):
+        lo, hi = percentile_intervals(self.samples, estimate=self.estimate)
+        self.assertTrue(all(lo <= self.estimate))
+        self.assertTrue(all(hi >= self.estimate))
+        # the offset column's interval is centered on the estimate less its bias
+        self.assertAlmostEqual(lo[0], 1.0 - 0.025 - 1.96 * 0.05, delta=0.01)
+        self.assertAlmostEqual(hi[0], 1.0 - 0.025 + 1.96 * 0.05, delta=0.01)
+        # the unbiased column keeps close to its plain interval
+        plain_lo, plain_hi = percentile_intervals(self.samples[:, 1])
+        self.assertAlmostEqual(lo[1], plain_lo, delta=0.05)
+        self.assertAlmostEqual(hi[1], plain_hi, delta=0.05)
+
+    def test_complex(self):
+        samples = self.samples[:, 0] + 1j * self.samples[:, 1]
+        estimate = self.estimate[0] + 1j * self.estimate[1]
+        lo, hi = percentile_intervals(samples, estimate=estimate)
+        re_lo, re_hi = percentile_intervals(self.samples[:, 0], estimate=self.estimate[0])
+        im_lo, im_hi = percentile_intervals(self.samples[:, 1], estimate=self.estimate[1])
+        self.assertEqual(lo, re_lo + 1j * im_lo)
+        self.assertEqual(hi, re_hi + 1j * im_hi)
+
+    def test_bias(self):
+        bias = bootstrap_bias(self.samples, self.estimate)
+        self.assertTrue(allclose(bias, self.samples.mean(axis=0) - self.estimate))
+        self.assertAlmostEqual(bias[0], 0.025, delta=0.005)
+
+
+class AnalyzeComponentsTestCase(unittest.TestCase):
+    """analyze_cal_components() with joint fits of only the bands that share poles/zeros."""
+
+    # full response: LF pole pair (0, 1), HF real pole (2) and HF pole pair (3, 4), in hz
+    FULL_POLES = [-0.01 + 0.01j, -0.01 - 0.01j, -5.0, -20.0 + 20.0j, -20.0 - 20.0j]
+    LF_PERT_MAP = ([0, 1], [])
+    HF_PERT_MAP = ([2], [])
+
+    def setUp(self):
+        self.full_paz = partial_paz(self.FULL_POLES)
+        lf_freqs = linspace(0.002, 0.3, 300)
+        hf_freqs = linspace(0.3, 18.0, 600)
+        lf_cross = []
+        hf_cross = []
+        for lf_scale, hf_scale in [(1.05, 1.02), (1.05, 0.98), (1.05, 1.04)]:
+            true = partial_paz([self.FULL_POLES[0] * lf_scale, self.FULL_POLES[1] * lf_scale,
+                                self.FULL_POLES[2] * hf_scale] + self.FULL_POLES[3:])
+            for freqs, crosses in [(lf_freqs, lf_cross), (hf_freqs, hf_cross)]:
+                tf = ida.signals.utils.compute_response(freqs, true) / \
+                     ida.signals.utils.compute_response(freqs, self.full_paz)
+                crosses.append((freqs, abs(tf), angle(tf) * 180 / pi, 0.95 * ones(freqs.size)))
+        self.lf_cross = ComponentsTpl(*lf_cross)
+        self.hf_cross = ComponentsTpl(*hf_cross)
+        self.full_paz_tpl = ComponentsTpl(self.full_paz, self.full_paz, self.full_paz)
+
+    def analyze(self, paz_shared_maps):
+
+        return analyze_cal_components(self.full_paz_tpl, self.LF_PERT_MAP, self.HF_PERT_MAP, 40.0,
+                                      self.lf_cross, self.hf_cross, paz_shared_maps=paz_shared_maps)
+
+    def test_empty_shared_band_fits_independently(self):
+        independent = self.analyze(None)
+        # nothing shared in either band is the independent fit
+        for comp_paz, indep_paz in zip(self.analyze((([], []), ([], []))), independent):
+            self.assertTrue(array_equal(comp_paz._poles, indep_paz._poles))
+        # LF is joint, HF has nothing shared and is fit per component as before
+        lf_joint = self.analyze((([0, 1], []), ([], [])))
+        for comp_paz, indep_paz in zip(lf_joint, independent):
+            self.assertEqual(comp_paz._poles[2], indep_paz._poles[2])
+            self.assertLess(max_rel_diff(comp_paz._poles[:2], indep_paz._poles[:2]), 1e-2)
+        self.assertTrue(array_equal(lf_joint.north._poles[:2], lf_joint.vertical._poles[:2]))
+        self.assertTrue(array_equal(lf_joint.east._poles[:2], lf_joint.vertical._poles[:2]))
+
+    def test_bootstrap_refits_decimated_from_fit(self):
+        fitted = self.analyze(None)
+        replicates = bootstrap_cal_components(self.full_paz_tpl, fitted, self.LF_PERT_MAP, self.HF_PERT_MAP, 40.0,
+                                              self.lf_cross, self.hf_cross, replicate_cnt=3, seed=1)
+
+        # noise free TFs leave nothing to resample: the decimated refits stay at the full resolution fit
+        for comp_replicates, comp_paz in zip(replicates, fitted):
+            self.assertEqual(len(comp_replicates), 3)
+            for replicate in comp_replicates:
+                self.assertLess(max_rel_diff(replicate._poles, comp_paz._poles), 1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#######################################################################################################################
+# Copyright (C) 2016  Regents of the University of California
+#
+# This is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License (GNU GPL) as published by the Free Software Foundation, either version 3 of the License,
+# or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY;
+# without even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# A copy of the GNU General Public License can be found in LICENSE.TXT in the root of the source code repository.
+# Additionally, it can be found at http://www.gnu.org/licenses/.
+#
+# NOTES: Per GNU GPLv3 terms:
+#   * This notice must be kept in this source file
+#   * Changes to the source must be clearly noted with date & time of change
+#
+# If you use this software in a product, an explicit acknowledgment in the product documentation of the contribution
+# by Project IDA, Institute of Geophysics and Planetary Physics, UCSD would be appreciated but is not required.
+#######################################################################################################################
+
+import unittest
+from numpy import abs, array, asarray, linspace, logspace, log10, vstack, float32
+import ida.signals.paz
+import ida.signals.utils
+from ida.signals.utils import compute_response, compute_response_zpk, compute_response_tf, compute_responses, \
+    iter_responses, FrequencyGrid, ResponseCache, cached_response
+from ida.calibration.process import compare_component_response
+
+"""Tests of the response evaluators in ida.signals.utils"""
+
+# broadband velocity response, in hz: 8 zeros, 7 poles
+FULL_ZEROS = [0, 0, -1.5, -5.0, -20.0, -30.0, -50.0, -80.0]
+FULL_POLES = [-0.00589 + 0.00589j, -0.00589 - 0.00589j, -2.5, -30.0, -10.0 + 15.0j, -10.0 - 15.0j, -60.0]
+RESP_MODES = ['disp', 'vel', 'acc']
+
+
+def make_paz(poles, zeros, h0=1.0):
+
+    paz = ida.signals.paz.PAZ('vel', 'hz')
+    for pole in poles:
+        paz.add_pole(pole)
+    for zero in zeros:
+        paz.add_zero(zero)
+    paz.h0 = h0
+
+    return paz
+
+
+def max_rel_diff(actual, expected):
+
+    return (abs(actual - expected) / abs(expected)).max()
+
+
+class ResponseTestCase(unittest.TestCase):
+    """compute_response_zpk() in factored form against the zpk2tf reference compute_response_tf()."""
+
+    def setUp(self):
+        self.paz = make_paz(FULL_POLES, FULL_ZEROS, h0=3.5)
+        self.freqs = logspace(-4, log10(50.0), 5000)
+
+    def test_zpk_matches_tf(self):
+        for mode in RESP_MODES:
+            expected = compute_response_tf(self.freqs, self.paz, mode=mode)
+            self.assertLess(max_rel_diff(compute_response_zpk(self.freqs, self.paz, mode=mode), expected), 1e-12)
+            self.assertLess(max_rel_diff(compute_response(self.freqs, self.paz, mode=mode), expected), 1e-12)
+
+    def test_zpk_chunks_and_log_accumulation(self):
+        expected = compute_response_zpk(self.freqs, self.paz)
+
+        self.assertLess(max_rel_diff(compute_response_zpk(self.freqs, self.paz, chunk_size=333), expected), 1e-15)
+        self.assertLess(max_rel_diff(compute_response_zpk(self.freqs, self.paz, log_accumulate=True), expected),
+                        1e-12)
+
+    def test_scalar_frequency(self):
+        resp = compute_response(1.0, self.paz)
+
+        self.assertEqual(resp.shape, (1,))
+        self.assertLess(max_rel_diff(resp, compute_response_tf(array([1.0]), self.paz)), 1e-12)
+
+
+class BatchResponseTestCase(unittest.TestCase):
+    """compute_responses() and iter_responses() of many PAZ against one compute_response() each."""
+
+    def setUp(self):
+        # different pole and zero counts exercise the padding
+        self.paz_list = [make_paz(FULL_POLES, FULL_ZEROS, h0=3.5),
+                         make_paz(FULL_POLES[:3], FULL_ZEROS[:2], h0=0.5),
+                         make_paz([-1.0 + 1.0j, -1.0 - 1.0j], [0]),
+                         make_paz(FULL_POLES[:5], FULL_ZEROS)]
+        self.freqs = linspace(0.0, 20.0, 10001)
+
+    def test_batch_matches_single(self):
+        for mode in RESP_MODES:
+            resps = compute_responses(self.freqs, self.paz_list, mode=mode)
+
+            self.assertEqual(resps.shape, (len(self.paz_list), self.freqs.size))
+            for resp, paz in zip(resps, self.paz_list):
+                expected = compute_response(self.freqs, paz, mode=mode)
+                self.assertTrue((resp == expected).all())
+
+    def test_streamed_blocks_match_batch(self):
+        expected = compute_responses(self.freqs, self.paz_list)
+
+        starts = []
+        blocks = []
+        for start, block in iter_responses(self.freqs, self.paz_list, chunk_size=999):
+            starts.append(start)
+            blocks.append(block.T)
+
+        self.assertEqual(starts, list(range(0, self.freqs.size, 999)))
+        self.assertTrue((vstack(blocks).T == expected).all())
+
+    def test_frequency_grid_input(self):
+        grid = ida.signals.utils.FrequencyGrid(self.freqs)
+
+        self.assertTrue((compute_responses(grid, self.paz_list) == compute_responses(self.freqs, self.paz_list)).all())
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    """FrequencyGrid keys and array conversion, the response cache and the copies handed to callers."""
+
+    def setUp(self):
+        self.paz = make_paz(FULL_POLES, FULL_ZEROS, h0=3.5)
+        self.freqs = linspace(0, 20.0, 4097)
+
+    def test_grid_fingerprints(self):
+        # equal grids share a key without hashing the frequencies, different grids do not
+        self.assertEqual(FrequencyGrid(self.freqs).fingerprint, FrequencyGrid(self.freqs.copy()).fingerprint)
+        self.assertNotEqual(FrequencyGrid(self.freqs).fingerprint, FrequencyGrid(self.freqs[:-1]).fingerprint)
+        self.assertNotEqual(FrequencyGrid(self.freqs).fingerprint, FrequencyGrid(self.freqs * 2).fingerprint)
+        log_freqs = logspace(-3, 1, 400)
+        self.assertEqual(FrequencyGrid(log_freqs).fingerprint, FrequencyGrid(log_freqs.copy()).fingerprint)
+        irregular = self.freqs ** 2
+        self.assertEqual(FrequencyGrid(irregular).fingerprint,
+                         ida.signals.utils.freqs_fingerprint(irregular))
+
+    def test_grid_array_copy(self):
+        grid = FrequencyGrid(self.freqs)
+        self.assertIs(grid.__array__(), grid.freqs)
+        self.assertIs(grid.__array__(copy=False), grid.freqs)
+        copied = grid.__array__(copy=True)
+        self.assertIsNot(copied, grid.freqs)
+        self.assertTrue(copied.flags.writeable)
+        self.assertEqual(grid.__array__(dtype='float32').dtype, float32)
+        with self.assertRaises(ValueError):
+            grid.__array__(dtype='float32', copy=False)
+        self.assertTrue(array(grid).flags.writeable)
+        self.assertFalse(asarray(grid).flags.writeable)
+
+    def test_cache_hits(self):
+        cache = ResponseCache()
+        resp = cached_response(FrequencyGrid(self.freqs), self.paz, norm_freq=0.05, cache=cache)
+        again = cached_response(FrequencyGrid(self.freqs), self.paz, norm_freq=0.05, cache=cache)
+        self.assertIs(again, resp)
+        self.assertFalse(resp.flags.writeable)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_compare_returns_copies(self):
+        freqs = FrequencyGrid(self.freqs)
+        for phase_detrend in [False, True]:
+            resp1, resp2 = compare_component_response(freqs, self.paz, self.paz, phase_detrend=phase_detrend)[:2]
+            self.assertTrue(resp1.flags.writeable)
+            self.assertTrue(resp2.flags.writeable)
+            resp1[:] = 0
+            self.assertNotEqual(abs(cached_response(freqs, self.paz, norm_freq=0.05)).max(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()